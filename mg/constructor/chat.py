@@ -22,11 +22,15 @@ from uuid import uuid4
 import datetime
 import re
 import logging
+import zlib
 
 old_messages_limit = 10
 old_private_messages_limit = 100
 max_chat_message = 1000
 debug_chat_to_syslog = False
+members_ttl = 600
+# online characters are spread over several memcached entries to keep them small
+online_members_shards = 64
 
 re_chat_characters = re.compile(r'\[(chf|cht|ch):([a-f0-9]{32})\]')
 re_chat_command = re.compile(r'^\s*/(\S+)\s*(.*)')
@@ -710,25 +714,18 @@ class Chat(ConstructorModule):
         if channel == "sys":
             viewers = None
         else:
-            # preparing list of characters to receive
-            characters = []
             if private:
-                characters = recipients
-            elif channel == "wld" or channel == "trd" or channel == "dip":
-                characters = self.characters.tech_online
+                # loading list of sessions corresponding to the recipients
+                sessions = self.objlist(SessionList, query_index="authorized_user", query_equal=["1-%s" % char.uuid for char in recipients])
+                # loading list of characters able to view the message
+                viewers = {}
+                for char_uuid, sess_uuid in sessions.index_values(2):
+                    try:
+                        viewers[char_uuid].append(sess_uuid)
+                    except KeyError:
+                        viewers[char_uuid] = [sess_uuid]
             else:
-                lst = self.objlist(DBChatChannelCharacterList, query_index="channel", query_equal=channel)
-                character_uuids = [re_after_dash.sub('', uuid) for uuid in lst.uuids()]
-                characters = [self.character(uuid) for uuid in character_uuids]
-            # loading list of sessions corresponding to the characters
-            sessions = self.objlist(SessionList, query_index="authorized_user", query_equal=["1-%s" % char.uuid for char in characters])
-            # loading list of characters able to view the message
-            viewers = {}
-            for char_uuid, sess_uuid in sessions.index_values(2):
-                try:
-                    viewers[char_uuid].append(sess_uuid)
-                except KeyError:
-                    viewers[char_uuid] = [sess_uuid]
+                viewers = self.channel_members(channel)
         tokens = []
         mentioned_uuids = set()         # characters uuids mentioned in the message
         mentioned = set()               # characters mentioned in the message
@@ -816,6 +813,121 @@ class Chat(ConstructorModule):
             message["html"] = utf2str(html_head) + ''.join([utf2str(self.render_token(token, None)) for token in tokens]) + utf2str(html_tail)
             self.call("stream.packet", "global", "chat", "msg", **message)
 
+    def members_channel(self, channel):
+        "Channels wld, trd and dip are delivered to all online characters"
+        if channel == "wld" or channel == "trd" or channel == "dip":
+            return "online"
+        return channel
+
+    def members_mcid(self, channel):
+        return "ChatMembers-%s" % channel
+
+    def members_shard(self, channel, char_uuid):
+        "Returns name of the membership entry keeping the character"
+        if channel == "online":
+            return "online/%d" % ((zlib.crc32(char_uuid) & 0xffffffff) % online_members_shards)
+        return channel
+
+    def channel_members(self, channel):
+        """
+        Returns dict: char_uuid => [session_uuid, ...] of the characters receiving
+        messages in the given channel. Membership is kept in memcached and
+        rebuilt from the database when missing
+        """
+        channel = self.members_channel(channel)
+        if channel == "online":
+            return self.online_members()
+        mcid = self.members_mcid(channel)
+        members = self.app().mc.get(mcid)
+        if members is None:
+            with self.lock(["chat-channel.%s" % channel]):
+                members = self.app().mc.get(mcid)
+                if members is None:
+                    members = self.channel_members_load(channel)
+                    self.app().mc.set(mcid, members, members_ttl)
+        return members
+
+    def online_members(self):
+        "Collects membership of all online characters from the shards"
+        mc = self.app().mc
+        shards = ["online/%d" % i for i in xrange(online_members_shards)]
+        got = mc.get_multi([self.members_mcid(shard) for shard in shards])
+        members = {}
+        for shard_members in got.itervalues():
+            members.update(shard_members)
+        missing = [shard for shard in shards if self.members_mcid(shard) not in got]
+        if missing:
+            with self.lock(["chat-channel.%s" % shard for shard in missing]):
+                got = mc.get_multi([self.members_mcid(shard) for shard in missing])
+                for shard_members in got.itervalues():
+                    members.update(shard_members)
+                missing = [shard for shard in missing if self.members_mcid(shard) not in got]
+                if missing:
+                    # rebuilding missing shards from the database
+                    shards_members = dict([(shard, {}) for shard in missing])
+                    for char_uuid, sessions in self.channel_members_load("online").iteritems():
+                        shard_members = shards_members.get(self.members_shard("online", char_uuid))
+                        if shard_members is not None:
+                            shard_members[char_uuid] = sessions
+                    for shard_members in shards_members.itervalues():
+                        members.update(shard_members)
+                    mc.set_multi(dict([(self.members_mcid(shard), shard_members) for shard, shard_members in shards_members.iteritems()]), members_ttl)
+        return members
+
+    def channel_members_load(self, channel):
+        if channel == "online":
+            character_uuids = [char.uuid for char in self.characters.tech_online]
+        else:
+            lst = self.objlist(DBChatChannelCharacterList, query_index="channel", query_equal=channel)
+            character_uuids = [re_after_dash.sub('', uuid) for uuid in lst.uuids()]
+        members = {}
+        if character_uuids:
+            sessions = self.objlist(SessionList, query_index="authorized_user", query_equal=["1-%s" % uuid for uuid in character_uuids])
+            for char_uuid, sess_uuid in sessions.index_values(2):
+                try:
+                    members[char_uuid].append(sess_uuid)
+                except KeyError:
+                    members[char_uuid] = [sess_uuid]
+        return members
+
+    def channel_members_set(self, channel, char_uuid, sessions):
+        """
+        Updates character sessions in the channel membership (empty sessions list removes
+        the character). Must be called under "chat-channel.<shard>" lock
+        """
+        mcid = self.members_mcid(self.members_shard(channel, char_uuid))
+        members = self.app().mc.get(mcid)
+        if members is None:
+            # membership will be loaded from the database on demand
+            return
+        if sessions:
+            members[char_uuid] = list(sessions)
+        else:
+            try:
+                del members[char_uuid]
+            except KeyError:
+                return
+        self.app().mc.set(mcid, members, members_ttl)
+
+    def channel_members_add_session(self, channel, char_uuid, session_uuid):
+        shard = self.members_shard(channel, char_uuid)
+        with self.lock(["chat-channel.%s" % shard]):
+            mcid = self.members_mcid(shard)
+            members = self.app().mc.get(mcid)
+            if members is None:
+                return
+            sessions = members.get(char_uuid)
+            if sessions is None:
+                if channel != "online":
+                    # character is not joined to this channel
+                    return
+                members[char_uuid] = [session_uuid]
+            elif session_uuid in sessions:
+                return
+            else:
+                sessions.append(session_uuid)
+            self.app().mc.set(mcid, members, members_ttl)
+
     def render_token(self, token, viewer_uuid, private=False):
         html = token.get("html")
         if html:
@@ -891,6 +1003,8 @@ class Chat(ConstructorModule):
         return [[".", ["glob", "char"], "chatname"], " ", ["index", [".", ["glob", "char"], "sex"], self._("male///has gone"), self._("female///has gone")], " ", self._("gone///to"), " ", [".", ["glob", "loc_to"], "name_t"]]
 
     def character_online(self, character):
+        with self.lock(["chat-channel.%s" % self.members_shard("online", character.uuid)]):
+            self.channel_members_set("online", character.uuid, character.sessions)
         msg = self.msg_went_online()
         if msg:
             self.call("chat.message", html=self.call("script.evaluate-text", msg, {"char": character}, description=self._("Character went online")), channel=self.auth_msg_channel(character), cls="auth")
@@ -906,6 +1020,14 @@ class Chat(ConstructorModule):
         self.call("stream.packet", syschannel, "chat", "clear")
         channels = []
         self.call("chat.character-channels", character, channels)
+        # new session must receive messages in all joined channels
+        self.channel_members_add_session("online", character.uuid, session_uuid)
+        for channel in channels:
+            if channel["id"] == "loc":
+                channel_id = "loc-%s" % (character.location.uuid if character.location else None)
+            else:
+                channel_id = channel["id"]
+            self.channel_members_add_session(channel_id, character.uuid, session_uuid)
         # reload_channels resets destroyes all channels not listed in the 'channels' list and unconditionaly clears online lists
         show_channels = []
         for ch in channels:
@@ -962,6 +1084,8 @@ class Chat(ConstructorModule):
         self.call("stream.character", character, "chat", "open_default_channel")
 
     def character_offline(self, character):
+        with self.lock(["chat-channel.%s" % self.members_shard("online", character.uuid)]):
+            self.channel_members_set("online", character.uuid, None)
         msg = self.msg_went_offline()
         if msg:
             self.call("chat.message", html=self.call("script.evaluate-text", msg, {"char": character}, description=self._("Character went offline")), channel=self.auth_msg_channel(character), cls="auth")
@@ -993,6 +1117,7 @@ class Chat(ConstructorModule):
                 obj.set("roster", True)
                 obj.set("roster_info", self.roster_info(character))
             obj.store()
+            self.channel_members_set(channel_id, character.uuid, character.sessions)
             if channel.get("roster"):
                 #self.debug("Character %s is joining channel %s with roster", character.name, channel_id)
                 # list of characters subscribed to this channel
@@ -1027,6 +1152,7 @@ class Chat(ConstructorModule):
                             #self.debug("Unjoining offline character %s from channel %s", char_uuid, channel_id)
                             obj = self.obj(DBChatChannelCharacter, "%s-%s" % (char_uuid, channel_id), silent=True)
                             obj.remove()
+                            self.channel_members_set(channel_id, char_uuid, None)
             else:
                 self.call("stream.character", character, "chat", "channel_create", **channel)
 
@@ -1061,10 +1187,12 @@ class Chat(ConstructorModule):
                             #self.debug("Unjoining offline character %s from channel %s", char_uuid, channel_id)
                             obj = self.obj(DBChatChannelCharacter, "%s-%s" % (char_uuid, channel_id), silent=True)
                             obj.remove()
+                            self.channel_members_set(channel_id, char_uuid, None)
             # dropping database record
             #self.debug("Unjoining character %s from channel %s", character.uuid, channel_id)
             obj = self.obj(DBChatChannelCharacter, "%s-%s" % (character.uuid, channel_id), silent=True)
             obj.remove()
+            self.channel_members_set(channel_id, character.uuid, None)
 
     def headmenu_chat_debug(self, args):
         if args == "join":
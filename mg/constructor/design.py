@@ -21,6 +21,8 @@ from mg.core.common import StaticUploadError
 import re
 import zipfile
 import cStringIO
+import hashlib
+import os
 import HTMLParser
 from PIL import Image, ImageDraw, ImageEnhance, ImageFont, ImageOps, ImageFilter
 import dircache
@@ -32,6 +34,10 @@ from concurrence import Tasklet
 
 max_design_size = 10000000
 max_design_files = 100
+# design templates kept in memory by every process
+design_files_cache_size = 500
+# local directory keeping downloaded design templates (global.design_cache_dir overrides it)
+design_cache_dir = "/var/lib/metagam/designs"
 permitted_extensions = {
     "gif": "image/gif",
     "png": "image/png",
@@ -1147,6 +1153,36 @@ class DesignSocioSubmarine(DesignSocioCommonBlocks):
     def name(self): return self._("Submarine")
     def preview(self): return "/st/constructor/design/gen/socio-submarine.jpg"
 
+class DesignFilesCache(object):
+    """
+    Per-process LRU cache of design templates downloaded from the storage:
+    uri => (name in the local design cache, None) or (None, content).
+    Every design upload gets a new uri, so content under the same uri never changes
+    and the cache is shared by all applications using the design
+    """
+    def __init__(self, size=design_files_cache_size):
+        self.size = size
+        self.entries = {}
+        self.serial = 0
+
+    def get(self, uri):
+        ent = self.entries.get(uri)
+        if ent is None:
+            return None
+        self.serial += 1
+        ent[0] = self.serial
+        return ent[1]
+
+    def set(self, uri, data):
+        self.serial += 1
+        self.entries[uri] = [self.serial, data]
+        if len(self.entries) > self.size:
+            entries = sorted(self.entries.iteritems(), key=lambda ent: ent[1][0])
+            for key, ent in entries[0:len(entries) - self.size / 2]:
+                del self.entries[key]
+
+design_files = DesignFilesCache()
+
 class DesignMod(Module):
     def register(self):
         self.rhook("design.response", self.response)
@@ -1154,6 +1190,7 @@ class DesignMod(Module):
         self.rhook("objclasses.list", self.objclasses_list)
         self.rhook("design.get", self.get)
         self.rhook("design.prepare_button", self.prepare_button)
+        self.rhook("core.template_path", self.template_path)
 
     def objclasses_list(self, objclasses):
         objclasses["Design"] = (Design, DesignList)
@@ -1177,7 +1214,7 @@ class DesignMod(Module):
         vars["content"] = content
         if design and template in design.get("files"):
             try:
-                return self.call("web.parse_layout", self.httpfile("%s/%s" % (design.get("uri"), template)), vars)
+                return self.call("web.parse_layout", self.design_file("%s/%s" % (design.get("uri"), template)), vars)
             except TemplateException as e:
                 return htmlescape(e)
         else:
@@ -1193,6 +1230,75 @@ class DesignMod(Module):
                         raise e
                     raise TemplateNotFound("NotFound", e.info())
 
+    def design_file(self, uri):
+        """
+        Design template for the template engine. Templates are downloaded once
+        and stored to the local design cache, so template engines compile them
+        once and keep them by name. Without the local cache the template is
+        returned as StringIO and compiled on every render
+        """
+        ent = design_files.get(uri)
+        if ent is None:
+            ent = self.design_file_load(uri)
+            if ent is None:
+                return cStringIO.StringIO("")
+            design_files.set(uri, ent)
+        name, data = ent
+        if name is not None:
+            return name
+        return cStringIO.StringIO(data)
+
+    def design_file_load(self, uri):
+        "Returns (name, None) or (None, content) of the design template. None on errors"
+        cache_dir = self.design_cache_dir()
+        if cache_dir is not None:
+            name = "design-%s.html" % hashlib.md5(uri.encode("utf-8") if type(uri) == unicode else uri).hexdigest()
+            filename = "%s/%s" % (cache_dir, name)
+            # stored by another process
+            if os.path.exists(filename) and self.app().inst.path_trusted(filename):
+                return (name, None)
+        try:
+            data = self.download(uri)
+        except DownloadError:
+            return None
+        # download() returns empty string on storage errors. They must not stick in the cache
+        if not data:
+            return None
+        if cache_dir is None:
+            return (None, data)
+        tmpname = "%s.%d" % (filename, os.getpid())
+        try:
+            f = open(tmpname, "w")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            self.warning("Error storing design template %s to %s: %s", uri, filename, e)
+            return (None, data)
+        return (name, None)
+
+    def design_cache_dir(self):
+        "Local directory of design templates (None if not available)"
+        inst = self.app().inst
+        try:
+            return inst.design_cache_dir
+        except AttributeError:
+            pass
+        try:
+            path = inst.private_dir("design_cache_dir", design_cache_dir)
+        except (IOError, OSError) as e:
+            self.warning("Local design cache disabled: %s", e)
+            path = None
+        inst.design_cache_dir = path
+        return path
+
+    def template_path(self, include_path):
+        path = self.design_cache_dir()
+        if path is not None:
+            include_path.append(path)
+
     def response(self, design, template, content, vars, design_type="game"):
         self.call("web.setup_design", vars)
         self.call("web.response", self.parse(design, template, content, vars, design_type))
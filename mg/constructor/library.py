@@ -105,6 +105,22 @@ class Library(ConstructorModule):
     def library_page(self, code):
         if not re_valid_code.match(code):
             self.call("web.not_found")
+        # page texts are cached before bracket hooks are expanded: hooks may show per-user content
+        page = self.call("web.fragment", "library", code, lambda: self.library_page_data(code))
+        vars = {
+            "title": page["title"],
+            "keywords": page["keywords"],
+            "description": page["description"],
+            "allow_bracket_hooks": True,
+        }
+        vars["library_content"] = self.call("web.parse_inline_layout", page["content"], vars)
+        if page["blocks"]:
+            vars["library_blocks"] = [self.call("web.parse_inline_layout", content, vars) for content in page["blocks"]]
+        vars["menu_left"] = page["menu_left"]
+        self.call("socio.response_template", "library.html", vars)
+
+    def library_page_data(self, code):
+        "Library page texts with unexpanded bracket hooks"
         lst = self.objlist(DBLibraryPageList, query_index="code", query_equal=code)
         lst.load()
         if len(lst):
@@ -113,13 +129,12 @@ class Library(ConstructorModule):
             pent = self.call("library-page-%s.content" % code, render_content=True)
             if not pent:
                 self.call("web.not_found")
-        vars = {
+        page = {
             "title": htmlescape(pent.get("title")),
             "keywords": htmlescape(pent.get("keywords")),
             "description": htmlescape(pent.get("description")),
-            "allow_bracket_hooks": True,
+            "content": pent.get("content"),
         }
-        vars["library_content"] = self.call("web.parse_inline_layout", pent.get("content"), vars)
         # loading blocks
         blocks = {}
         lst = self.objlist(DBLibraryGroupList, query_index="everywhere", query_equal="1")
@@ -143,12 +158,11 @@ class Library(ConstructorModule):
                             "content": grp.get("block_content"),
                             "order": grp.get("block_order"),
                         }
-        if len(blocks):
-            blocks = blocks.values()
-            blocks.sort(cmp=lambda x, y: cmp(x.get("order"), y.get("order")) or cmp(x.get("code"), y.get("code")))
-            vars["library_blocks"] = [self.call("web.parse_inline_layout", blk["content"], vars) for blk in blocks]
+        blocks = blocks.values()
+        blocks.sort(cmp=lambda x, y: cmp(x.get("order"), y.get("order")) or cmp(x.get("code"), y.get("code")))
+        page["blocks"] = [blk["content"] for blk in blocks]
         # loading parents
-        menu_left = [{"html": vars["title"], "lst": True}]
+        menu_left = [{"html": page["title"], "lst": True}]
         parent = pent.get("parent")
         shown = set()
         shown.add(pent.get("code"))
@@ -164,9 +178,8 @@ class Library(ConstructorModule):
                     break
             menu_left.insert(0, {"html": htmlescape(parent_ent.get("title")), "href": "/library" if parent == "index" else "/library/%s" % parent})
             parent = parent_ent.get("parent")
-        if menu_left:
-            vars["menu_left"] = menu_left
-        self.call("socio.response_template", "library.html", vars)
+        page["menu_left"] = menu_left
+        return page
 
     def buttons(self, buttons):
         buttons.append({
@@ -284,6 +297,7 @@ class LibraryAdmin(ConstructorModule):
             else:
                 page.remove()
                 self.objlist(DBLibraryPageGroupList, query_index="page", query_equal=page.get("code")).remove()
+                self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "library/pages")
         if req.args:
             if req.args != "new":
@@ -345,6 +359,7 @@ class LibraryAdmin(ConstructorModule):
                         obj.set("grp", grp.get("code"))
                         obj.set("order", intz(order))
                         obj.store()
+                self.call("web.fragments_invalidate", "library")
                 self.call("admin.redirect", "library/pages")
             fields = [
                 {"name": "code", "label": self._("Page code (latin letters, slashes, digits and '-'). This page code is practically a component of the page URL. This library page will be available as '/library/&lt;code&gt;'. You may use slashes. For example, 'clans/wars' will be available at '/library/clans/wars'. Special code 'index' means library index page: '/library'"), "value": page.get("code")},
@@ -421,6 +436,7 @@ class LibraryAdmin(ConstructorModule):
             else:
                 page_group.remove()
                 self.objlist(DBLibraryPageGroupList, query_index="grp", query_equal=page_group.get("code")).remove()
+                self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "library/page-groups")
         if req.args:
             if req.args != "new":
@@ -466,6 +482,7 @@ class LibraryAdmin(ConstructorModule):
                 if len(errors):
                     self.call("web.response_json", {"success": False, "errors": errors})
                 page_group.store()
+                self.call("web.fragments_invalidate", "library")
                 self.call("admin.redirect", "library/page-groups")
             fields = [
                 {"name": "code", "label": self._("Page group code (must start with u_ and contain latin letters, digits and '_' symbols)"), "value": page_group.get("code")},
@@ -25,6 +25,48 @@ class ParametrizedObject(object):
         except AttributeError:
             pass
 
+    def _param_depends(self, key, deps, pure):
+        """
+        Record dependencies of the formula param 'key' on params 'deps'.
+        Impure formulas read something besides params of this object
+        """
+        try:
+            dependents = self._param_dependents
+        except AttributeError:
+            dependents = {}
+            self._param_dependents = dependents
+            self._param_impure = set()
+        for dep in deps:
+            try:
+                dependents[dep].add(key)
+            except KeyError:
+                dependents[dep] = set([key])
+        if pure:
+            self._param_impure.discard(key)
+        else:
+            self._param_impure.add(key)
+
+    def _param_changed(self, key):
+        """
+        Drop cached values of the param, of all formulas depending on it
+        and of all impure formulas (they may read the param indirectly)
+        """
+        try:
+            cache = self._param_cache
+        except AttributeError:
+            return
+        dependents = getattr(self, "_param_dependents", {})
+        queue = [key]
+        queue.extend(getattr(self, "_param_impure", []))
+        dropped = set()
+        while queue:
+            key = queue.pop()
+            if key in dropped:
+                continue
+            dropped.add(key)
+            cache.pop(key, None)
+            queue.extend(dependents.get(key, []))
+
     def _param(self, key, handle_exceptions=True):
         param = self.call("%s.param" % self._param_cls, key)
         if not param:
@@ -24,6 +24,63 @@ re_visual_table = re.compile(r'^(-?(?:\d+|\d+\.\d+))\s*:\s*(.+)$')
 re_copy = re.compile(r'^copy/(.+)$')
 re_del = re.compile(r'^del/(.+)$')
 re_paramedit_args = re.compile(r'^([0-9a-f]+)/([a-zA-Z_][a-zA-Z0-9_]*)$')
+re_param_attr = re.compile(r'^p_(.+)')
+
+# Max number of memoized results per formula
+formula_memo_size = 1000
+# Types of values allowed in the formula memo
+memo_types = set([int, long, float, str, unicode, bool, type(None)])
+
+def formula_dependencies(val, glob):
+    """
+    Analyze parameter expression. Returns tuple (deps, pure) where deps is set
+    of codes of params of the object 'glob' the expression reads and pure
+    is True when the expression reads nothing else (other attributes, other
+    globals, time, random numbers)
+    """
+    deps = set()
+    state = {"pure": True}
+    def walk(val):
+        if type(val) is not list:
+            return
+        cmd = val[0]
+        if cmd == ".":
+            obj = val[1]
+            if type(obj) is list and obj[0] == "glob" and obj[1] == glob:
+                m = re_param_attr.match(val[2])
+                if m:
+                    deps.add(m.group(1))
+                    return
+            state["pure"] = False
+            walk(obj)
+        elif cmd == "glob" or cmd == "now" or cmd == "random":
+            state["pure"] = False
+        elif cmd == "index" or cmd == "numdecl":
+            if len(val) >= 3:
+                walk(val[1])
+        elif cmd == "call":
+            if val[1] == "selrand":
+                state["pure"] = False
+            for arg in val[2:]:
+                walk(arg)
+        else:
+            for arg in val[1:]:
+                walk(arg)
+    walk(val)
+    return deps, state["pure"]
+
+class ParamFormula(object):
+    """
+    Dependency information of the parameter formula and memoized results
+    of pure formulas: tuple of dependencies values => result
+    """
+    def __init__(self, param, glob):
+        self.param = param
+        self.glob = glob
+        self.deps, self.pure = formula_dependencies(param["expression"], glob)
+        self.deps = sorted(self.deps)
+        self.memo = {}
+
 max_code_len = 30
 
 class Fake(ConstructorModule):
@@ -457,7 +514,7 @@ class Params(ConstructorModule):
             raise AttributeError(param_code)
         old_value = obj.db_params.get(param["code"], param.get("default", 0))
         obj.db_params.set(param["code"], value)
-        obj._param_cache = {}
+        obj._param_changed(param["code"])
         return old_value
 
     def value(self, obj, param_code, handle_exceptions=True):
@@ -480,6 +537,52 @@ class Params(ConstructorModule):
             value = res
         return value
 
+    def formula(self, obj, param):
+        "Returns ParamFormula for the parameter of the given object"
+        glob = obj.script_params().keys()[0]
+        try:
+            formulas = self._formulas
+        except AttributeError:
+            formulas = {}
+            self._formulas = formulas
+        key = (param["code"], glob)
+        formula = formulas.get(key)
+        # param descriptions are replaced on configuration reload
+        if formula is None or formula.param is not param:
+            formula = ParamFormula(param, glob)
+            formulas[key] = formula
+        return formula
+
+    def formula_memo_key(self, obj, formula):
+        """
+        Returns values of params the pure formula depends on
+        (None if some of them can't be used as a memo key)
+        """
+        # protection from circular references
+        evaluating = getattr(obj, "_param_evaluating", None)
+        if evaluating is None:
+            evaluating = set()
+            obj._param_evaluating = evaluating
+        code = formula.param["code"]
+        if code in evaluating:
+            return None
+        evaluating.add(code)
+        try:
+            key = []
+            for dep in formula.deps:
+                try:
+                    param, value = obj._param(dep, False)
+                except Exception:
+                    # formula evaluation will handle the error
+                    return None
+                if type(value) not in memo_types:
+                    return None
+                # 1, 1.0 and True hash equal but may evaluate differently
+                key.append((type(value), value))
+            return tuple(key)
+        finally:
+            evaluating.discard(code)
+
     def value_rec(self, obj, param, handle_exceptions=True):
         # trying to return cached parameter value
         try:
@@ -495,6 +598,18 @@ class Params(ConstructorModule):
         if param["type"] == 0:
             value = obj.db_params.get(param["code"], param.get("default", 0))
         elif param["type"] == 1 or param["type"] == 2:
+            formula = self.formula(obj, param)
+            obj._param_depends(param["code"], formula.deps, formula.pure)
+            # pure formulas are functions of other params values
+            memo_key = self.formula_memo_key(obj, formula) if formula.pure else None
+            if memo_key is not None:
+                try:
+                    value = formula.memo[memo_key]
+                except KeyError:
+                    pass
+                else:
+                    cache[param["code"]] = value
+                    return value
             if handle_exceptions:
                 try:
                     value = self._evaluate(obj, param)
@@ -503,6 +618,10 @@ class Params(ConstructorModule):
                     return None
             else:
                 value = self._evaluate(obj, param)
+            if memo_key is not None and type(value) in memo_types:
+                if len(formula.memo) >= formula_memo_size:
+                    formula.memo.clear()
+                formula.memo[memo_key] = value
         # storing in the cache
         cache[param["code"]] = value
         return value
@@ -37,6 +37,12 @@ class ConstructorApplicationFactory(ApplicationFactory):
         # to avoid garbage collection
         self.main_app = self.get_by_tag("main")
         self.main_host = self.main_app.main_host
+        # application pool
+        self.pool_size = inst.confint("global", "app_pool_size", self.pool_size)
+        self.pool_max_age = inst.confint("global", "app_pool_max_age", self.pool_max_age)
+        preload = inst.conf("global", "app_preload")
+        if preload:
+            self.preload([tag.strip() for tag in preload.split(",") if tag.strip()])
 
     def tag_by_domain(self, domain):
         if domain is None:
@@ -29,6 +29,46 @@ re_shorten = re.compile(r'^(.{100}).{3,}$')
 re_del = re.compile(r'^del/([a-z0-9_]+)$', re.IGNORECASE)
 re_valid_selector = re.compile(r'^[\.#]')
 
+# compiled expressions kept by every script module (least recently used are dropped)
+compiled_expressions_cache_size = 10000
+
+expression_leaf_types = set([str, unicode, int, long, float, bool, type(None)])
+
+def expression_plain(val):
+    "Check whether the expression consists of lists and plain values only"
+    if type(val) is list:
+        for v in val:
+            if not expression_plain(v):
+                return False
+        return True
+    return type(val) in expression_leaf_types
+
+def expression_key(val):
+    """
+    Returns cache key of the expression or None if the expression contains
+    objects (they are captured by the compiled closures and can't be shared)
+    """
+    if not expression_plain(val):
+        return None
+    return repr(val)
+
+math_functions = {
+    "floor": math.floor,
+    "round": round,
+    "ceil": math.ceil,
+    "abs": abs,
+    "sqrt": math.sqrt,
+    "sqr": lambda v: v * v,
+    "log": math.log,
+    "exp": math.exp,
+    "sin": math.sin,
+    "cos": math.cos,
+    "tan": math.tan,
+    "asin": math.asin,
+    "acos": math.acos,
+    "atan": math.atan,
+}
+
 class HTMLFormatter(object):
     @staticmethod
     def clsbegin(clsname):
@@ -95,12 +135,7 @@ class ScriptEngine(ConstructorModule):
 
     @property
     def parser_spec(self):
-        inst = self.app().inst
-        try:
-            return inst._parser_spec
-        except AttributeError:
-            inst._parser_spec = Parsing.Spec(sys.modules["mg.constructor.script_classes"], skinny=False)
-            return inst._parser_spec
+        return self.app().inst.parser_spec("mg.constructor.script_classes", skinny=False)
 
     def parse_expression(self, text):
         parser = ScriptParser(self.app(), self.parser_spec)
@@ -410,277 +445,479 @@ class ScriptEngine(ConstructorModule):
         else:
             # this is a real error
             raise ScriptRuntimeError(self._("Max recursion depth exceeded"), env)
+        try:
+            return self.compiled_expression(val)(env)
+        except RuntimeError as e:
+            # compiled closures call each other directly, so deep expressions overflow the stack here
+            if "recursion" not in str(e):
+                raise
+            raise ScriptRuntimeError(self._("Max recursion depth exceeded"), env)
+
+    def compiled_expression(self, val):
+        """
+        Returns function(env) evaluating the expression. Compiled functions
+        are cached by the expression text, so equal expressions built on
+        every call (quest scripts, copies of cached objects) are compiled once
+        """
+        key = expression_key(val)
+        if key is None:
+            return self._compile(val)
+        try:
+            cache = self._compiled_expressions
+        except AttributeError:
+            cache = {}
+            self._compiled_expressions = cache
+            self._compiled_expressions_serial = 0
+        self._compiled_expressions_serial += 1
+        ent = cache.get(key)
+        if ent is not None:
+            ent[0] = self._compiled_expressions_serial
+            return ent[1]
+        fn = self._compile(val)
+        cache[key] = [self._compiled_expressions_serial, fn]
+        if len(cache) > compiled_expressions_cache_size:
+            # dropping least recently used half of the cache
+            entries = sorted(cache.iteritems(), key=lambda ent: ent[1][0])
+            for k, ent in entries[0:len(entries) - compiled_expressions_cache_size / 2]:
+                del cache[k]
+        return fn
+
+    def _compile(self, val):
+        "Translate expression to the tree of closures. Every closure takes env and returns the value"
+        if type(val) is not list:
+            return lambda env: val
         cmd = val[0]
+        compile = self._compile
+        isString = self.isString
+        toNumber = self.toNumber
         if cmd == '+':
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Adding None does not affect the value
-            if arg1 is None:
-                return arg2
-            if arg2 is None:
-                return arg1
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            # Strings are concatenated
-            if self.isString(arg1) and self.isString(arg2):
-                return arg1 + arg2
-            # Vectors can be added only to vectors
-            if isinstance(arg1, Vec3):
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Adding None does not affect the value
+                if arg1 is None:
+                    return arg2
+                if arg2 is None:
+                    return arg1
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
+                # Strings are concatenated
+                if isString(arg1) and isString(arg2):
+                    return arg1 + arg2
+                # Vectors can be added only to vectors
+                if isinstance(arg1, Vec3):
+                    if isinstance(arg2, Vec3):
+                        return Vec3(arg1.x + arg2.x, arg1.y + arg2.y, arg1.z + arg2.z)
+                    else:
+                        return None
                 if isinstance(arg2, Vec3):
-                    return Vec3(arg1.x + arg2.x, arg1.y + arg2.y, arg1.z + arg2.z)
-                else:
                     return None
-            if isinstance(arg2, Vec3):
-                return None
-            # Numeric operation
-            arg1 = self.toNumber(arg1)
-            arg2 = self.toNumber(arg2)
-            return arg1 + arg2
+                # Numeric operation
+                return toNumber(arg1) + toNumber(arg2)
+            return evaluate
         if cmd == '-':
             if len(val) == 2:
-                arg1 = None
-                arg2 = self._evaluate(val[1], env)
-                # Partial evaluation
-                if env.keep_globs and type(arg2) is list:
-                    return [cmd, arg2]
-            else:
-                arg1 = self._evaluate(val[1], env)
-                arg2 = self._evaluate(val[2], env)
+                ev2 = compile(val[1])
+                def evaluate(env):
+                    arg2 = ev2(env)
+                    # Partial evaluation
+                    if env.keep_globs and type(arg2) is list:
+                        return [cmd, arg2]
+                    # Substracting None does not affect the value
+                    if arg2 is None:
+                        return None
+                    if isinstance(arg2, Vec3):
+                        return Vec3(-arg2.x, -arg2.y, -arg2.z)
+                    # Numeric operation
+                    return toNumber(None) - toNumber(arg2)
+                return evaluate
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
                 # Partial evaluation
                 if env.keep_globs and (type(arg1) is list or type(arg2) is list):
                     return [cmd, arg1, arg2]
-            # Substracting None does not affect the value
-            if arg2 is None:
-                return arg1
-            # Vectors are substracted only from vectors
-            if isinstance(arg1, Vec3):
+                # Substracting None does not affect the value
+                if arg2 is None:
+                    return arg1
+                # Vectors are substracted only from vectors
+                if isinstance(arg1, Vec3):
+                    if isinstance(arg2, Vec3):
+                        return Vec3(arg1.x - arg2.x, arg1.y - arg2.y, arg1.z - arg2.z)
+                    else:
+                        return None
                 if isinstance(arg2, Vec3):
-                    return Vec3(arg1.x - arg2.x, arg1.y - arg2.y, arg1.z - arg2.z)
-                else:
-                    return None
-            if isinstance(arg2, Vec3):
-                if arg1 is None:
-                    return Vec3(-arg2.x, -arg2.y, -arg2.z)
-                else:
-                    return None
-            # Numeric operation
-            arg1 = self.toNumber(arg1)
-            arg2 = self.toNumber(arg2)
-            return arg1 - arg2
+                    if arg1 is None:
+                        return Vec3(-arg2.x, -arg2.y, -arg2.z)
+                    else:
+                        return None
+                # Numeric operation
+                return toNumber(arg1) - toNumber(arg2)
+            return evaluate
         if cmd == '*':
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            # Vectors may be multiplied by numbers only
-            if isinstance(arg1, Vec3):
-                arg2 = self.toNumber(arg2)
-                return Vec3(arg1.x * arg2, arg1.y * arg2, arg1.z * arg2)
-            if isinstance(arg2, Vec3):
-                arg1 = self.toNumber(arg1)
-                return Vec3(arg2.x * arg1, arg2.y * arg1, arg2.z * arg1)
-            # Numeric operation
-            arg1 = self.toNumber(arg1)
-            arg2 = self.toNumber(arg2)
-            return arg1 * arg2
-        if cmd == '/':
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                if arg2 == 0:
-                    return None
-                else:
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
                     return [cmd, arg1, arg2]
-            # Vectors may be divided by numbers only
-            if isinstance(arg1, Vec3):
-                arg2 = self.toNumber(arg2)
+                # Vectors may be multiplied by numbers only
+                if isinstance(arg1, Vec3):
+                    arg2 = toNumber(arg2)
+                    return Vec3(arg1.x * arg2, arg1.y * arg2, arg1.z * arg2)
+                if isinstance(arg2, Vec3):
+                    arg1 = toNumber(arg1)
+                    return Vec3(arg2.x * arg1, arg2.y * arg1, arg2.z * arg1)
+                # Numeric operation
+                return toNumber(arg1) * toNumber(arg2)
+            return evaluate
+        if cmd == '/':
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    if arg2 == 0:
+                        return None
+                    else:
+                        return [cmd, arg1, arg2]
+                # Vectors may be divided by numbers only
+                if isinstance(arg1, Vec3):
+                    arg2 = toNumber(arg2)
+                    if arg2 == 0:
+                        return None
+                    else:
+                        return Vec3(float(arg1.x) / arg2, float(arg1.y) / arg2, float(arg1.z) / arg2)
+                # Numeric operation
+                arg1 = toNumber(arg1)
+                arg2 = toNumber(arg2)
                 if arg2 == 0:
                     return None
                 else:
-                    return Vec3(float(arg1.x) / arg2, float(arg1.y) / arg2, float(arg1.z) / arg2)
-            # Numeric operation
-            arg1 = self.toNumber(arg1)
-            arg2 = self.toNumber(arg2)
-            if arg2 == 0:
-                return None
-            else:
-                return float(arg1) / arg2
+                    return float(arg1) / arg2
+            return evaluate
         if cmd == '%':
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    if arg2 == 0:
+                        return None
+                    else:
+                        return [cmd, arg1, arg2]
+                arg1 = int(toNumber(arg1))
+                arg2 = int(toNumber(arg2))
                 if arg2 == 0:
                     return None
                 else:
-                    return [cmd, arg1, arg2]
-            arg1 = int(self.toNumber(arg1))
-            arg2 = int(self.toNumber(arg2))
-            if arg2 == 0:
-                return None
-            else:
-                return arg1 % arg2
-        elif cmd == "==" or cmd == "!=":
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            if isinstance(arg1, Vec3):
-                if isinstance(arg2, Vec3):
-                    equals = (arg1.x == arg2.x) and (arg1.y == arg2.y) and (arg1.z == arg2.z)
-                else:
-                    equals = False
-            elif isinstance(arg2, Vec3):
-                equals = False
-            else:
-                s1 = self.isString(arg1)
-                s2 = self.isString(arg2)
-                # Validating type of the left operand
-                if s1 and not s2:
-                    arg1 = floatz(arg1)
-                # Validating type of the right operand
-                if s2 and not s1:
-                    arg2 = floatz(arg2)
-                equals = arg1 == arg2
-            # Evaluating
+                    return arg1 % arg2
+            return evaluate
+        if cmd == "==" or cmd == "!=":
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
             if cmd == "==":
-                return 1 if equals else 0
+                results = (0, 1)
             else:
-                return 0 if equals else 1
-        elif cmd == "in":
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            arg1 = str2unicode(arg1)
-            arg2 = str2unicode(arg2)
-            return 1 if arg2.find(arg1) >= 0 else 0
-        elif cmd == "<" or cmd == ">" or cmd == "<=" or cmd == ">=":
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            if isinstance(arg1, Vec3) and isinstance(arg2, Vec3):
-                if arg1.x < arg2.x:
-                    res = -1
-                elif arg1.x > arg2.x:
-                    res = 1
-                elif arg1.y < arg2.y:
-                    res = -1
-                elif arg1.y > arg2.y:
-                    res = 1
-                elif arg1.z < arg2.z:
-                    res = -1
-                elif arg1.z > arg2.z:
-                    res = 1
-                else:
-                    res = 0
-            else:
-                arg1 = self.toNumber(arg1)
-                arg2 = self.toNumber(arg2)
-                if arg1 < arg2:
-                    res = -1
-                elif arg1 > arg2:
-                    res = 1
+                results = (1, 0)
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
+                if isinstance(arg1, Vec3):
+                    if isinstance(arg2, Vec3):
+                        equals = (arg1.x == arg2.x) and (arg1.y == arg2.y) and (arg1.z == arg2.z)
+                    else:
+                        equals = False
+                elif isinstance(arg2, Vec3):
+                    equals = False
                 else:
-                    res = 0
+                    s1 = isString(arg1)
+                    s2 = isString(arg2)
+                    # Validating type of the left operand
+                    if s1 and not s2:
+                        arg1 = floatz(arg1)
+                    # Validating type of the right operand
+                    if s2 and not s1:
+                        arg2 = floatz(arg2)
+                    equals = arg1 == arg2
+                return results[1 if equals else 0]
+            return evaluate
+        if cmd == "in":
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
+                arg1 = str2unicode(arg1)
+                arg2 = str2unicode(arg2)
+                return 1 if arg2.find(arg1) >= 0 else 0
+            return evaluate
+        if cmd == "<" or cmd == ">" or cmd == "<=" or cmd == ">=":
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            # results for comparison results -1, 0, 1
             if cmd == "<":
-                return 1 if res == -1 else 0
-            if cmd == ">":
-                return 1 if res == 1 else 0
-            if cmd == "<=":
-                return 1 if res <= 0 else 0
-            if cmd == ">=":
-                return 1 if res >= 0 else 0
-        elif cmd == "~":
-            arg1 = self._evaluate(val[1], env)
-            # Partial evaluation
-            if env.keep_globs and type(arg1) is list:
-                return [cmd, arg1]
-            arg1 = intz(arg1)
-            return ~arg1
-        elif cmd == "&":
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            arg1 = intz(arg1)
-            arg2 = intz(arg2)
-            return arg1 & arg2
-        elif cmd == "|":
-            arg1 = self._evaluate(val[1], env)
-            arg2 = self._evaluate(val[2], env)
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            arg1 = intz(arg1)
-            arg2 = intz(arg2)
-            return arg1 | arg2
-        elif cmd == "not":
-            arg1 = self._evaluate(val[1], env)
-            # Partial evaluation
-            if env.keep_globs and type(arg1) is list:
-                return [cmd, arg1]
-            return 0 if arg1 else 1
-        elif cmd == "and":
-            arg1 = self._evaluate(val[1], env)
-            # Full boolean eval
-            if not arg1 and env.used_globs is None:
-                return arg1
-            arg2 = self._evaluate(val[2], env)
-            if not arg1:
-                return arg1
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            return arg2
-        elif cmd == "or":
-            arg1 = self._evaluate(val[1], env)
-            # Full boolean eval
-            if arg1 and env.used_globs is None and type(arg1) is not list:
-                return arg1
-            arg2 = self._evaluate(val[2], env)
-            if arg1 and type(arg1) is not list:
-                return arg1
-            # Partial evaluation
-            if env.keep_globs and (type(arg1) is list or type(arg2) is list):
-                return [cmd, arg1, arg2]
-            if arg1:
-                return arg1
-            return arg2
-        elif cmd == '?':
-            arg1 = self._evaluate(val[1], env)
-            # Partial evaluation
-            if env.keep_globs and type(arg1) is list:
-                arg2 = self._evaluate(val[2], env)
-                arg3 = self._evaluate(val[3], env)
-                return [cmd, arg1, arg2, arg3]
-            if env.used_globs is None:
-                if arg1:
-                    return self._evaluate(val[2], env)
+                results = (1, 0, 0)
+            elif cmd == ">":
+                results = (0, 0, 1)
+            elif cmd == "<=":
+                results = (1, 1, 0)
+            else:
+                results = (0, 1, 1)
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
+                if isinstance(arg1, Vec3) and isinstance(arg2, Vec3):
+                    if arg1.x < arg2.x:
+                        res = -1
+                    elif arg1.x > arg2.x:
+                        res = 1
+                    elif arg1.y < arg2.y:
+                        res = -1
+                    elif arg1.y > arg2.y:
+                        res = 1
+                    elif arg1.z < arg2.z:
+                        res = -1
+                    elif arg1.z > arg2.z:
+                        res = 1
+                    else:
+                        res = 0
                 else:
-                    return self._evaluate(val[3], env)
+                    arg1 = toNumber(arg1)
+                    arg2 = toNumber(arg2)
+                    if arg1 < arg2:
+                        res = -1
+                    elif arg1 > arg2:
+                        res = 1
+                    else:
+                        res = 0
+                return results[res + 1]
+            return evaluate
+        if cmd == "~":
+            ev1 = compile(val[1])
+            def evaluate(env):
+                arg1 = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(arg1) is list:
+                    return [cmd, arg1]
+                return ~intz(arg1)
+            return evaluate
+        if cmd == "&" or cmd == "|":
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            if cmd == "&":
+                op = lambda arg1, arg2: arg1 & arg2
             else:
-                arg2 = self._evaluate(val[2], env)
-                arg3 = self._evaluate(val[3], env)
+                op = lambda arg1, arg2: arg1 | arg2
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
+                return op(intz(arg1), intz(arg2))
+            return evaluate
+        if cmd == "not":
+            ev1 = compile(val[1])
+            def evaluate(env):
+                arg1 = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(arg1) is list:
+                    return [cmd, arg1]
+                return 0 if arg1 else 1
+            return evaluate
+        if cmd == "and":
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                # Full boolean eval
+                if not arg1 and env.used_globs is None:
+                    return arg1
+                arg2 = ev2(env)
+                if not arg1:
+                    return arg1
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
+                return arg2
+            return evaluate
+        if cmd == "or":
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            def evaluate(env):
+                arg1 = ev1(env)
+                # Full boolean eval
+                if arg1 and env.used_globs is None and type(arg1) is not list:
+                    return arg1
+                arg2 = ev2(env)
+                if arg1 and type(arg1) is not list:
+                    return arg1
+                # Partial evaluation
+                if env.keep_globs and (type(arg1) is list or type(arg2) is list):
+                    return [cmd, arg1, arg2]
                 if arg1:
-                    return arg2
+                    return arg1
+                return arg2
+            return evaluate
+        if cmd == '?':
+            ev1 = compile(val[1])
+            ev2 = compile(val[2])
+            ev3 = compile(val[3])
+            def evaluate(env):
+                arg1 = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(arg1) is list:
+                    return [cmd, arg1, ev2(env), ev3(env)]
+                if env.used_globs is None:
+                    if arg1:
+                        return ev2(env)
+                    else:
+                        return ev3(env)
                 else:
-                    return arg3
-        elif cmd == "call":
-            fname = val[1]
-            if fname == "min" or fname == "max":
+                    arg2 = ev2(env)
+                    arg3 = ev3(env)
+                    if arg1:
+                        return arg2
+                    else:
+                        return arg3
+            return evaluate
+        if cmd == "call":
+            return self._compile_call(val)
+        if cmd == "random":
+            return lambda env: random.random()
+        if cmd == "now":
+            return lambda env: Date(self.app())
+        if cmd == "glob":
+            name = val[1]
+            def evaluate(env):
+                # Partial evaluation
+                if env.keep_globs and env.keep_globs.get(name):
+                    return [cmd, name]
+                globs = env.globs
+                if name not in globs:
+                    if name == "t" or name == "T":
+                        now = self.time()
+                        if "t" not in globs:
+                            globs["t"] = now
+                        if "T" not in globs:
+                            globs["T"] = now
+                    else:
+                        return None
+                obj = globs.get(name)
+                if env.used_globs is not None:
+                    env.used_globs.add(name)
+                if callable(obj):
+                    obj = obj()
+                    globs[name] = obj
+                return obj
+            return evaluate
+        if cmd == ".":
+            ev1 = compile(val[1])
+            field = val[2]
+            def evaluate(env):
+                obj = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(obj) is list:
+                    return [cmd, obj, field]
+                if obj is None:
+                    raise ScriptTypeError(self._("Empty value '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
+                if type(obj) is int:
+                    raise ScriptTypeError(self._("Integer '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
+                if type(obj) is float:
+                    raise ScriptTypeError(self._("Float '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
+                if type(obj) is str or type(obj) is str:
+                    raise ScriptTypeError(self._("String '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
+                getter = getattr(obj, "script_attr", None)
+                if getter is None:
+                    raise ScriptTypeError(self._("Object '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
+                try:
+                    attval = getter(field, handle_exceptions=False)
+                except AttributeError as e:
+                    raise ScriptTypeError(self._("Object '{val}' has no attribute '{att}'").format(val=self.unparse_expression(val[1]), att=field), env)
+                return self.call("script.evaluate-dynamic", attval)
+            return evaluate
+        if cmd == "index":
+            if len(val) < 3:
+                return lambda env: None
+            ev1 = compile(val[1])
+            def evaluate(env):
+                index = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(index) is list:
+                    return [cmd, index] + val[2:]
+                index = intz(index) + 2
+                if index < 2:
+                    index = 2
+                if index >= len(val):
+                    index = len(val) - 1
+                return val[index]
+            return evaluate
+        if cmd == "numdecl":
+            if len(val) < 3:
+                return lambda env: None
+            ev1 = compile(val[1])
+            def evaluate(env):
+                arg = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(arg) is list:
+                    return [cmd, arg] + val[2:]
+                return self.call("l10n.literal_value", intz(arg), val[2:])
+            return evaluate
+        if cmd == "clsbegin":
+            ev1 = compile(val[1])
+            def evaluate(env):
+                arg = ev1(env)
+                # Partial evaluation
+                if env.keep_globs and type(arg) is list:
+                    return [cmd, arg]
+                return self.formatter(env).clsbegin(arg)
+            return evaluate
+        if cmd == "clsend":
+            return lambda env: self.formatter(env).clsend()
+        def evaluate(env):
+            raise ScriptRuntimeError(self._("Unknown script engine operation: {op}").format(op=cmd), env)
+        return evaluate
+
+    def _compile_call(self, val):
+        "Compile function call"
+        cmd = val[0]
+        fname = val[1]
+        compile = self._compile
+        toNumber = self.toNumber
+        def error(message):
+            "message - function returning localized error message"
+            def evaluate(env):
+                raise ScriptRuntimeError(message().format(fname=fname), env)
+            return evaluate
+        if fname == "min" or fname == "max":
+            evs = [compile(arg) for arg in val[2:]]
+            better = (lambda v, res: v < res) if fname == "min" else (lambda v, res: v > res)
+            def evaluate(env):
                 res = None
                 res_unprocessed = []
-                for i in xrange(2, len(val)):
-                    v = self._evaluate(val[i], env)
+                for ev in evs:
+                    v = ev(env)
                     # Partial evaluation
                     if env.keep_globs and type(v) is list:
                         res_unprocessed.append(v)
@@ -689,50 +926,48 @@ class ScriptEngine(ConstructorModule):
                         v = floatz(v)
                     elif type(v) is not int and type(v) is not float:
                         v = 0
-                    if fname == "min":
-                        if res is None or v < res:
-                            res = v
-                    elif fname == "max":
-                        if res is None or v > res:
-                            res = v
+                    if res is None or better(v, res):
+                        res = v
                 if res_unprocessed:
                     if res is not None:
                         res_unprocessed.append(res)
                     return [cmd, fname] + res_unprocessed
                 return res
-            elif fname == "lc" or fname == "uc":
-                if len(val) != 3:
-                    raise ScriptRuntimeError(self._("Function {fname} must be called with single argument").format(fname=fname), env)
-                v = self._evaluate(val[2], env)
+            return evaluate
+        if fname == "lc" or fname == "uc" or fname == "length":
+            if len(val) != 3:
+                return error(lambda: self._("Function {fname} must be called with single argument"))
+            ev = compile(val[2])
+            if fname == "lc":
+                op = lambda v: v.lower()
+            elif fname == "uc":
+                op = lambda v: v.upper()
+            else:
+                op = len
+            def evaluate(env):
+                v = ev(env)
                 # Partial evaluation
                 if env.keep_globs and type(v) is list:
                     return [cmd, fname, v]
-                v = str2unicode(v)
-                if fname == "lc":
-                    return v.lower()
-                elif fname == "uc":
-                    return v.upper()
-            elif fname == "length":
-                if len(val) != 3:
-                    raise ScriptRuntimeError(self._("Function {fname} must be called with single argument").format(fname=fname), env)
-                v = self._evaluate(val[2], env)
+                return op(str2unicode(v))
+            return evaluate
+        if fname == "selrand":
+            if len(val) < 3:
+                return lambda env: None
+            evs = [compile(arg) for arg in val[2:]]
+            def evaluate(env):
                 # Partial evaluation
                 if env.keep_globs:
-                    if env.keep_globs and type(v) is list:
-                        return [cmd, fname, v]
-                return len(str2unicode(v))
-            elif fname == "selrand":
-                if len(val) >= 3:
-                    args = val[2:]
-                    # Partial evaluation
-                    if env.keep_globs:
-                        return [cmd, fname] + [self._evaluate(v, env) for v in args]
-                    return self._evaluate(random.choice(args), env)
-                return None
-            elif fname == "floor" or fname == "round" or fname == "ceil" or fname == "abs" or fname == "sqrt" or fname == "sqr" or fname == "log" or fname == "exp" or fname == "sin" or fname == "cos" or fname == "tan" or fname == "asin" or fname == "acos" or fname == "atan":
-                if len(val) != 3:
-                    raise ScriptRuntimeError(self._("Function {fname} must be called with single argument").format(fname=fname), env)
-                v = self._evaluate(val[2], env)
+                    return [cmd, fname] + [ev(env) for ev in evs]
+                return random.choice(evs)(env)
+            return evaluate
+        op = math_functions.get(fname)
+        if op is not None:
+            if len(val) != 3:
+                return error(lambda: self._("Function {fname} must be called with single argument"))
+            ev = compile(val[2])
+            def evaluate(env):
+                v = ev(env)
                 # Partial evaluation
                 if env.keep_globs and type(v) is list:
                     return [cmd, fname, v]
@@ -741,41 +976,18 @@ class ScriptEngine(ConstructorModule):
                 elif type(v) is not int and type(v) is not float:
                     v = 0
                 try:
-                    if fname == "floor":
-                        return math.floor(v)
-                    elif fname == "round":
-                        return round(v)
-                    elif fname == "ceil":
-                        return math.ceil(v)
-                    elif fname == "abs":
-                        return abs(v)
-                    elif fname == "sqrt":
-                        return math.sqrt(v)
-                    elif fname == "sqr":
-                        return v * v
-                    elif fname == "log":
-                        return math.log(v)
-                    elif fname == "exp":
-                        return math.exp(v)
-                    elif fname == "sin":
-                        return math.sin(v)
-                    elif fname == "cos":
-                        return math.cos(v)
-                    elif fname == "tan":
-                        return math.tan(v)
-                    elif fname == "asin":
-                        return math.asin(v)
-                    elif fname == "acos":
-                        return math.acos(v)
-                    elif fname == "atan":
-                        return math.atan(v)
+                    return op(v)
                 except ValueError:
                     return float('nan')
-            elif fname == "pow":
-                if len(val) != 4:
-                    raise ScriptRuntimeError(self._("Function {fname} must be called with two arguments").format(fname=fname), env)
-                v1 = self._evaluate(val[2], env)
-                v2 = self._evaluate(val[3], env)
+            return evaluate
+        if fname == "pow":
+            if len(val) != 4:
+                return error(lambda: self._("Function {fname} must be called with two arguments"))
+            ev1 = compile(val[2])
+            ev2 = compile(val[3])
+            def evaluate(env):
+                v1 = ev1(env)
+                v2 = ev2(env)
                 # Partial evaluation
                 if env.keep_globs and (type(v1) is list or type(v2) is list):
                     return [cmd, fname, v1, v2]
@@ -791,105 +1003,28 @@ class ScriptEngine(ConstructorModule):
                     return math.pow(v1, v2)
                 except ValueError:
                     return float('nan')
-            elif fname == "vec3":
-                if len(val) != 5:
-                    raise ScriptRuntimeError(self._("Function {fname} must be called with three arguments").format(fname=fname), env)
-                arg1 = self._evaluate(val[2], env)
-                arg2 = self._evaluate(val[3], env)
-                arg3 = self._evaluate(val[4], env)
+            return evaluate
+        if fname == "vec3":
+            if len(val) != 5:
+                return error(lambda: self._("Function {fname} must be called with three arguments"))
+            ev1 = compile(val[2])
+            ev2 = compile(val[3])
+            ev3 = compile(val[4])
+            def evaluate(env):
+                arg1 = ev1(env)
+                arg2 = ev2(env)
+                arg3 = ev3(env)
                 # Partial evaluation
                 if env.keep_globs and (type(arg1) is list or type(arg2) is list or type(arg3) is list):
                     return [cmd, fname, arg1, arg2, arg3]
-                arg1 = self.toNumber(arg1)
-                arg2 = self.toNumber(arg2)
-                arg3 = self.toNumber(arg3)
-                return Vec3(arg1, arg2, arg3)
-            elif fname == "str":
-                if len(val) != 3:
-                    raise ScriptRuntimeError(self._("Function {fname} must be called with single argument").format(fname=fname), env)
-                arg = self._evaluate(val[2], env)
-                return utf2str(arg)
-            else:
-                raise ScriptRuntimeError(self._("Function {fname} is not supported in expression context").format(fname=fname), env)
-        elif cmd == "random":
-            return random.random()
-        elif cmd == "now":
-            return Date(self.app())
-        elif cmd == "glob":
-            name = val[1]
-            # Partial evaluation
-            if env.keep_globs and env.keep_globs.get(name):
-                return [cmd, name]
-            if name not in env.globs:
-                if name == "t" or name == "T":
-                    now = self.time()
-                    if "t" not in env.globs:
-                        env.globs["t"] = now
-                    if "T" not in env.globs:
-                        env.globs["T"] = now
-                else:
-                    return None
-            obj = env.globs.get(name)
-            if env.used_globs is not None:
-                env.used_globs.add(name)
-            if callable(obj):
-                obj = obj()
-                env.globs[name] = obj
-            return obj
-        elif cmd == ".":
-            obj = self._evaluate(val[1], env)
-            field = val[2]
-            # Partial evaluation
-            if env.keep_globs and type(obj) is list:
-                return [cmd, obj, field]
-            if obj is None:
-                raise ScriptTypeError(self._("Empty value '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
-            if type(obj) is int:
-                raise ScriptTypeError(self._("Integer '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
-            if type(obj) is float:
-                raise ScriptTypeError(self._("Float '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
-            if type(obj) is str or type(obj) is str:
-                raise ScriptTypeError(self._("String '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
-            getter = getattr(obj, "script_attr", None)
-            if getter is None:
-                raise ScriptTypeError(self._("Object '{val}' has no attributes").format(val=self.unparse_expression(val[1])), env)
-            try:
-                attval = getter(field, handle_exceptions=False)
-            except AttributeError as e:
-                raise ScriptTypeError(self._("Object '{val}' has no attribute '{att}'").format(val=self.unparse_expression(val[1]), att=field), env)
-            attval = self.call("script.evaluate-dynamic", attval)
-            return attval
-        elif cmd == "index":
-            if len(val) < 3:
-                return None
-            index = self._evaluate(val[1], env)
-            # Partial evaluation
-            if env.keep_globs and type(index) is list:
-                return [cmd, index] + val[2:]
-            index = intz(index) + 2
-            if index < 2:
-                index = 2
-            if index >= len(val):
-                index = len(val) - 1
-            return val[index]
-        elif cmd == "numdecl":
-            if len(val) < 3:
-                return None
-            arg = self._evaluate(val[1], env)
-            # Partial evaluation
-            if env.keep_globs and type(arg) is list:
-                return [cmd, arg] + val[2:]
-            return self.call("l10n.literal_value", intz(arg), val[2:])
-        elif cmd == "clsbegin":
-            arg = self._evaluate(val[1], env)
-            # Partial evaluation
-            if env.keep_globs and type(arg) is list:
-                return [cmd, arg]
-            return self.formatter(env).clsbegin(arg)
-        elif cmd == "clsend":
-            return self.formatter(env).clsend()
-        else:
-            raise ScriptRuntimeError(self._("Unknown script engine operation: {op}").format(op=cmd), env)
+                return Vec3(toNumber(arg1), toNumber(arg2), toNumber(arg3))
+            return evaluate
+        if fname == "str":
+            if len(val) != 3:
+                return error(lambda: self._("Function {fname} must be called with single argument"))
+            ev = compile(val[2])
+            return lambda env: utf2str(ev(env))
+        return error(lambda: self._("Function {fname} is not supported in expression context"))
 
     def formatter(self, env):
         return getattr(env, "formatter", HTMLFormatter)
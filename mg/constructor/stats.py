@@ -61,10 +61,10 @@ class GameReporter(ConstructorModule):
         sessions_online = {}
         # list of characters currently online
         online_lst = self.objlist(DBCharacterOnlineList, query_index="all")
-        # auth logs since yesterday
-        logs = self.objlist(AuthLogList, query_index="performed", query_start=since)
-        logs.load(silent=True)
+        # number of auth log records since yesterday
+        logs_cnt = 0
         # mapping: time => number. number is +1 when somebody online, -1 when offline
+        # (sweep line over the day: one entry per second at most)
         events = {}
         # player_stats
         player_stats = {}
@@ -74,7 +74,6 @@ class GameReporter(ConstructorModule):
             st = unix_timestamp(s)
             tt = unix_timestamp(t)
             elapsed = tt - st
-            self.debug("a=%s: pl=%s online %s - %s (%d sec, %s)", app_tag, pl, s, t, elapsed, comment)
             try:
                 player_stats[pl] += elapsed
             except KeyError:
@@ -87,92 +86,94 @@ class GameReporter(ConstructorModule):
                 events[tt] -= 1
             except KeyError:
                 events[tt] = -1
-        for ent in logs:
-            performed = ent.get("performed")
-            act = ent.get("act")
-            char_uuid = ent.get("user")
-            player_uuid = ent.get("player")
-            session_uuid = ent.get("session")
-            active_players.add(player_uuid)
-            self.debug("a=%s %s char=%s, player=%s, sess=%s", performed, act, char_uuid, player_uuid, session_uuid)
-            if performed < till:
-                # actual date
-                went_online = False
-                went_offline = False
-                if char_uuid and player_uuid:
-                    character_players[char_uuid] = player_uuid
-                    # online events
-                    if (act == "login" or act == "reconnect") and char_uuid and player_uuid:
+        # auth logs are processed page by page in the order of 'performed'
+        for logs in self.objlist_pages(AuthLogList, query_index="performed", query_start=since, silent=True):
+            logs_cnt += len(logs)
+            for ent in logs:
+                performed = ent.get("performed")
+                act = ent.get("act")
+                char_uuid = ent.get("user")
+                player_uuid = ent.get("player")
+                session_uuid = ent.get("session")
+                active_players.add(player_uuid)
+                if performed < till:
+                    # actual date
+                    went_online = False
+                    went_offline = False
+                    if char_uuid and player_uuid:
+                        character_players[char_uuid] = player_uuid
+                        # online events
+                        if (act == "login" or act == "reconnect") and char_uuid and player_uuid:
+                            try:
+                                char = characters_online[char_uuid]
+                                # character already online
+                                if char[0] != session_uuid:
+                                    # session of the character changed
+                                    del sessions_online[char[0]]
+                                    sessions_online[session_uuid] = char_uuid
+                                    char[0] = session_uuid
+                            except KeyError:
+                                went_online = True
+                        # offline events
+                        if (act == "logout" or act == "disconnect") and char_uuid and player_uuid:
+                            if not characters_online.get(char_uuid):
+                                # logout without login. assuming login was at the "since" time
+                                characters_online[char_uuid] = [session_uuid, since]
+                                try:
+                                    players_online[player_uuid][0] += 1
+                                except KeyError:
+                                    players_online[player_uuid] = [1, since]
+                            went_offline = True
+                    # log into cabinet
+                    if act == "login" and player_uuid and not char_uuid:
                         try:
+                            char_uuid = sessions_online[session_uuid]
                             char = characters_online[char_uuid]
-                            # character already online
-                            if char[0] != session_uuid:
-                                # session of the character changed
-                                del sessions_online[char[0]]
-                                sessions_online[session_uuid] = char_uuid
-                                char[0] = session_uuid
                         except KeyError:
-                            went_online = True
-                    # offline events
-                    if (act == "logout" or act == "disconnect") and char_uuid and player_uuid:
-                        if not characters_online.get(char_uuid):
-                            # logout without login. assuming login was at the "since" time
-                            characters_online[char_uuid] = [session_uuid, since]
-                            try:
-                                players_online[player_uuid][0] += 1
-                            except KeyError:
-                                players_online[player_uuid] = [1, since]
-                        went_offline = True
-                # log into cabinet
-                if act == "login" and player_uuid and not char_uuid:
-                    try:
-                        char_uuid = sessions_online[session_uuid]
+                            pass
+                        else:
+                            went_offline = True
+                    #self.debug("   went_online=%s, went_offline=%s", went_online, went_offline)
+                    # processing online/offline events
+                    if went_online:
+                        characters_online[char_uuid] = [session_uuid, performed]
+                        try:
+                            if players_online[player_uuid][0] == 0:
+                                players_online[player_uuid][1] = performed
+                            players_online[player_uuid][0] += 1
+                        except KeyError:
+                            players_online[player_uuid] = [1, performed]
+                        sessions_online[session_uuid] = char_uuid
+                    if went_offline:
                         char = characters_online[char_uuid]
-                    except KeyError:
-                        pass
-                    else:
-                        went_offline = True
-                #self.debug("   went_online=%s, went_offline=%s", went_online, went_offline)
-                # processing online/offline events
-                if went_online:
-                    characters_online[char_uuid] = [session_uuid, performed]
-                    try:
-                        if players_online[player_uuid][0] == 0:
-                            players_online[player_uuid][1] = performed
-                        players_online[player_uuid][0] += 1
-                    except KeyError:
-                        players_online[player_uuid] = [1, performed]
-                    sessions_online[session_uuid] = char_uuid
-                if went_offline:
-                    char = characters_online[char_uuid]
-                    try:
-                        del sessions_online[char[0]]
-                    except KeyError:
-                        pass
-                    try:
-                        del characters_online[char_uuid]
-                    except KeyError:
-                        pass
-                    try:
-                        players_online[player_uuid][0] -= 1
-                    except KeyError:
-                        pass
-                    else:
-                        if players_online[player_uuid][0] == 0:
-                            player_stat(player_uuid, players_online[player_uuid][1], performed, "regular")
-                #self.debug("   current characters_online=%s, players_online=%s, sessions_online=%s", characters_online, players_online, sessions_online)
-            else:
-                # the next day
-                if char_uuid and player_uuid and not character_players.get(char_uuid):
-                    if act == "login" or act == "reconnect": 
-                        # this character first appeared in the logs on the next day with "login" event.
-                        # it means he was offline yesterday
-                        character_players[char_uuid] = player_uuid
-                    if act == "logout" or act == "disconnect":
-                        # this character first apparead in the logs on the next day with "logout" event.
-                        # it means he was online yesterday all the day
-                        character_players[char_uuid] = player_uuid
-                        player_stat(player_uuid, since, till, "afterlog")
+                        try:
+                            del sessions_online[char[0]]
+                        except KeyError:
+                            pass
+                        try:
+                            del characters_online[char_uuid]
+                        except KeyError:
+                            pass
+                        try:
+                            players_online[player_uuid][0] -= 1
+                        except KeyError:
+                            pass
+                        else:
+                            if players_online[player_uuid][0] == 0:
+                                player_stat(player_uuid, players_online[player_uuid][1], performed, "regular")
+                    #self.debug("   current characters_online=%s, players_online=%s, sessions_online=%s", characters_online, players_online, sessions_online)
+                else:
+                    # the next day
+                    if char_uuid and player_uuid and not character_players.get(char_uuid):
+                        if act == "login" or act == "reconnect": 
+                            # this character first appeared in the logs on the next day with "login" event.
+                            # it means he was offline yesterday
+                            character_players[char_uuid] = player_uuid
+                        if act == "logout" or act == "disconnect":
+                            # this character first apparead in the logs on the next day with "logout" event.
+                            # it means he was online yesterday all the day
+                            character_players[char_uuid] = player_uuid
+                            player_stat(player_uuid, since, till, "afterlog")
         # getting characters online till the end of the day
         for player_uuid, ent in players_online.iteritems():
             if ent[0] > 0:
@@ -256,7 +257,7 @@ class GameReporter(ConstructorModule):
         new_users = len(lst)
         lst.remove()
         # don't store information about abandoned games
-        if len(online_lst) or len(logs) or active > 0:
+        if len(online_lst) or logs_cnt or active > 0:
             self.call("dbexport.add", "online", since=since, till=till, players=player_stats, peak_ccu=peak_ccu, ccu_dist=hours, registered=registered, returned=returned, left=left, active=active, new_users=new_users)
             self.call("stats.daily", peak_ccu=peak_ccu, ccu_dist=hours, registered=registered, returned=returned, left=left, active=active, new_users=new_users)
 
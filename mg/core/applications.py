@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Metagam.  If not, see <http://www.gnu.org/licenses/>.
 
-from mg.core.cass import CassandraObject, CassandraObjectList
+from mg.core.cass import CassandraObject, CassandraObjectList, CassandraBatch
 from concurrence import Tasklet, Timeout, TimeoutError
 from concurrence.extra import Lock
 from concurrence.http import HTTPConnection, HTTPError, HTTPRequest
@@ -24,6 +24,7 @@ from mg.core.common import *
 from mg.core.memcached import Memcached, MemcachedLock
 from mg.core.config import Config
 from operator import itemgetter
+import bisect
 import weakref
 import re
 import cStringIO
@@ -38,6 +39,15 @@ re_hook_path = re.compile(r'^(.+?)\.(.+)$')
 re_module_path = re.compile(r'^(.+)\.(.+)$')
 re_remove_domain = re.compile(r'^.{,20}///')
 
+# maximal number of hook names in the dispatch cache (hook names may come from URLs)
+max_dispatch_cache = 10000
+# upper bounds (in seconds) of the hook timing histogram buckets
+hook_timing_buckets = (0.0001, 0.001, 0.01, 0.1, 1.0)
+# number of recently used applications kept loaded when nobody references them
+app_pool_size = 100
+# dynamic applications are reloaded when they are older than this number of seconds
+app_pool_max_age = 3600
+
 class DBHookGroupModules(CassandraObject):
     clsname = "HookGroupModules"
     indexes = {
@@ -47,6 +57,18 @@ class DBHookGroupModules(CassandraObject):
 class DBHookGroupModulesList(CassandraObjectList):
     objcls = DBHookGroupModules
 
+class HookStats(object):
+    "Number of calls and timing histogram of a single hook"
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.histogram = [0] * (len(hook_timing_buckets) + 1)
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.time += elapsed
+        self.histogram[bisect.bisect_right(hook_timing_buckets, elapsed)] += 1
+
 class Hooks(object):
     """
     This class is a hook manager for an application. It keeps list of loaded handlers
@@ -63,6 +85,10 @@ class Hooks(object):
         self.loaded_groups = set()
         self.app = weakref.ref(app)
         self.dynamic = False
+        # hook name => (hook group, tuple of handlers sorted by priority)
+        self.dispatch = dict()
+        # hook name => HookStats. None when profiling is disabled
+        self.stats = dict() if getattr(app.inst, "hooks_profiling", False) else None
 
     def load_groups(self, groups):
         """
@@ -110,12 +136,43 @@ class Hooks(object):
             lst = []
             self.handlers[hook_name] = lst
         lst.append((handler, priority, module_name, priv))
-        lst.sort(key=itemgetter(1), reverse=True)
+        try:
+            del self.dispatch[hook_name]
+        except KeyError:
+            pass
 
     def clear(self):
         "Unregister all registered hooks"
         self.handlers.clear()
         self.loaded_groups.clear()
+        self.dispatch.clear()
+
+    def _dispatch(self, name):
+        "Prepare dispatch cache entry for the hook"
+        m = re_hook_path.match(name)
+        if not m:
+            raise HookFormatError("Invalid hook name: %s" % name)
+        handlers = self.handlers.get(name)
+        if handlers:
+            handlers = tuple(sorted(handlers, key=itemgetter(1), reverse=True))
+        else:
+            handlers = ()
+        if len(self.dispatch) >= max_dispatch_cache:
+            self.dispatch.clear()
+        entry = (m.group(1), handlers)
+        self.dispatch[name] = entry
+        return entry
+
+    def profiling_start(self):
+        "Start counting hook calls and their timing"
+        if self.stats is None:
+            self.stats = dict()
+
+    def profiling_stop(self):
+        "Stop profiling and return collected statistics: hook name => HookStats"
+        stats = self.stats
+        self.stats = None
+        return stats
 
     def call(self, name, *args, **kwargs):
         """
@@ -124,44 +181,62 @@ class Hooks(object):
         *args, **kwargs - arbitrary parameters passed to the handlers
         Some special kwargs (they are not passed to the handlers):
         check_priv - require permission setting for the habdler
+        load_handlers - if False don't load modules handling the hook group
         """
-        if "check_priv" in kwargs:
-            check_priv = kwargs["check_priv"]
-            del kwargs["check_priv"]
+        try:
+            hook_group, handlers = self.dispatch[name]
+        except KeyError:
+            hook_group, handlers = self._dispatch(name)
+        if kwargs:
+            check_priv = kwargs.pop("check_priv", None)
+            load_handlers = kwargs.pop("load_handlers", None)
         else:
             check_priv = None
-        m = re_hook_path.match(name)
-        if not m:
-            raise HookFormatError("Invalid hook name: %s" % name)
-        (hook_group, hook_name) = m.group(1, 2)
+            load_handlers = None
         # ensure handling modules are loaded. "core" handlers are not loaded automatically
-        if self.dynamic and hook_group != "core" and hook_group not in self.loaded_groups and kwargs.get("load_handlers") is not False:
+        if self.dynamic and hook_group != "core" and hook_group not in self.loaded_groups and load_handlers is not False:
             self.load_groups([hook_group])
-        if "load_handlers" in kwargs:
-            del kwargs["load_handlers"]
+            try:
+                hook_group, handlers = self.dispatch[name]
+            except KeyError:
+                hook_group, handlers = self._dispatch(name)
         # call handlers
-        handlers = self.handlers.get(name)
-        ret = None
-        if handlers is not None:
-            for handler, priority, module_name, priv in handlers:
-                if check_priv:
-                    if priv is None:
-                        raise HandlerPermissionError("No privilege information in handler %s of module %s" % (name, module_name))
-                    if priv == "public":
-                        pass
-                    elif priv == "logged":
-                        self.call("session.require_login")
-                    else:
-                        self.call("session.require_login")
-                        self.call("session.require_permission", priv)
+        if self.stats is None:
+            return self._call(name, handlers, check_priv, args, kwargs)
+        started = time.time()
+        try:
+            return self._call(name, handlers, check_priv, args, kwargs)
+        finally:
+            stats = self.stats
+            if stats is not None:
                 try:
-                    res = handler(*args, **kwargs)
-                    if type(res) == tuple:
-                        args = res
-                    elif res is not None:
-                        ret = res
-                except Hooks.Return as e:
-                    return e.value
+                    hook_stats = stats[name]
+                except KeyError:
+                    hook_stats = HookStats()
+                    stats[name] = hook_stats
+                hook_stats.add(time.time() - started)
+
+    def _call(self, name, handlers, check_priv, args, kwargs):
+        ret = None
+        for handler, priority, module_name, priv in handlers:
+            if check_priv:
+                if priv is None:
+                    raise HandlerPermissionError("No privilege information in handler %s of module %s" % (name, module_name))
+                if priv == "public":
+                    pass
+                elif priv == "logged":
+                    self.call("session.require_login")
+                else:
+                    self.call("session.require_login")
+                    self.call("session.require_permission", priv)
+            try:
+                res = handler(*args, **kwargs)
+                if type(res) == tuple:
+                    args = res
+                elif res is not None:
+                    ret = res
+            except Hooks.Return as e:
+                return e.value
         return ret
 
     def store(self):
@@ -281,6 +356,12 @@ class Module(Loggable):
     def objlist(self, *args, **kwargs):
         return self.app().objlist(*args, **kwargs)
 
+    def objlist_pages(self, *args, **kwargs):
+        return self.app().objlist_pages(*args, **kwargs)
+
+    def batch(self):
+        return self.app().batch()
+
     def time(self):
         try:
             req = self.req()
@@ -694,6 +775,14 @@ class Application(Loggable):
         "Create CassandraObjectList instance"
         return cls(self.db, uuids=uuids, **kwargs)
 
+    def objlist_pages(self, cls, query_index, **kwargs):
+        "Iterate over CassandraObjectList pages of the index"
+        return cls.pages(self.db, query_index, **kwargs)
+
+    def batch(self):
+        "Create CassandraBatch collecting all stores made by the current tasklet"
+        return CassandraBatch(self.db)
+
     def lock(self, keys, patience=20, delay=0.1, ttl=30, reason=None):
         return MemcachedLock(self.mc, keys, patience, delay, ttl, value_prefix=str(self.inst.instid) + "-", reason=reason)
 
@@ -772,13 +861,67 @@ class ApplicationFactory(object):
     def __init__(self, inst):
         self.inst = inst
         self.applications = weakref.WeakValueDictionary()
-        self.lock = TaskletLock()
+        # tag => TaskletLock. Lock exists while somebody is loading the application
+        self.locks = weakref.WeakValueDictionary()
+        # tag => [app, loaded, used]. Strong references to the recently used applications.
+        # 'used' is a value of the use counter
+        self.pool = {}
+        self.pool_counter = 0
+        self.pool_size = app_pool_size
+        self.pool_max_age = app_pool_max_age
+
+    def tag_lock(self, tag):
+        "Lock serializing loading of the given application"
+        lock = self.locks.get(tag)
+        if lock is None:
+            lock = TaskletLock()
+            self.locks[tag] = lock
+        return lock
 
     def add(self, app):
         "Add application to the factory"
         self.applications[app.tag] = app
+        self.pool_counter += 1
+        self.pool[app.tag] = [app, time.time(), self.pool_counter]
+        if len(self.pool) > self.pool_size:
+            self.pool_evict()
         self.added(app)
 
+    def pool_evict(self):
+        "Drop least recently used applications from the pool"
+        entries = sorted(self.pool.iteritems(), key=lambda ent: ent[1][2])
+        for tag, ent in entries[:len(entries) - self.pool_size]:
+            del self.pool[tag]
+
+    def pool_get(self, tag, app):
+        """
+        Mark application as recently used. Returns False if the application is too old
+        and must be reloaded
+        """
+        ent = self.pool.get(tag)
+        now = time.time()
+        self.pool_counter += 1
+        if ent is None or ent[0] is not app:
+            # application was evicted from the pool but still referenced
+            self.pool[tag] = [app, now, self.pool_counter]
+            if len(self.pool) > self.pool_size:
+                self.pool_evict()
+            return True
+        if app.hooks.dynamic and now > ent[1] + self.pool_max_age:
+            return False
+        ent[2] = self.pool_counter
+        return True
+
+    def preload(self, tags):
+        "Load given applications in background"
+        def load():
+            for tag in tags:
+                try:
+                    self.get_by_tag(tag)
+                except Exception as e:
+                    self.inst.exception(e)
+        Tasklet.new(load)()
+
     def added(self, app):
         pass
 
@@ -796,18 +939,26 @@ class ApplicationFactory(object):
             del self.applications[app.tag]
         except KeyError:
             pass
+        ent = self.pool.get(app.tag)
+        if ent is not None and ent[0] is app:
+            del self.pool[app.tag]
 
     def get_by_tag(self, tag, load=True):
         "Find application by tag and load it"
         tag = utf2str(tag)
         # Query without locking
+        app = self.applications.get(tag)
         if not load:
-            return self.applications.get(tag)
-        with self.lock:
-            try:
-                return self.applications[tag]
-            except KeyError:
-                pass
+            return app
+        if app is not None and self.pool_get(tag, app):
+            return app
+        with self.tag_lock(tag):
+            app = self.applications.get(tag)
+            if app is not None:
+                if self.pool_get(tag, app):
+                    return app
+                # too old
+                self.remove(app)
             app = self.load(tag)
             if app is None:
                 return None
@@ -24,6 +24,7 @@ from PIL import Image, ImageDraw, ImageFilter, ImageEnhance
 from mg.core.bezier import make_bezier
 from mg.core.tools import *
 from operator import itemgetter
+from concurrence import Tasklet
 import cStringIO
 import time
 import re
@@ -32,6 +33,14 @@ import hashlib
 import cgi
 
 log_per_page = 50000
+# sessions are prolonged after this number of seconds since the last update
+session_refresh_interval = 3600
+# plus random per session delay up to this number of seconds spreading refreshes in time
+session_refresh_jitter = 1800
+# refreshes are collected and stored in background this often
+session_refresh_delay = 10
+# number of sessions stored at once
+session_refresh_batch = 100
 
 re_newline = re.compile(r'\n')
 re_permissions_args = re.compile(r'^([a-f0-9]+)(?:(.+)|)$', re.DOTALL)
@@ -149,6 +158,9 @@ class Sessions(Module):
         self.rhook("session.find_user", self.find_user)
         self.rhook("session.require_permission", self.require_permission)
         self.rhook("session.log", self.log)
+        # session id => last seen remote address
+        self.refresh_pending = {}
+        self.refresh_running = False
 
     def log(self, **kwargs):
         self.call("session.log-fix", kwargs)
@@ -180,18 +192,9 @@ class Sessions(Module):
         if sid is not None:
             session = self.find_session(sid)
             if session is not None:
-                # update session every hour
-                if session.get("updated") < self.now(-3600):
-                    with self.lock(["session.%s" % session.uuid]):
-                        session.load()
-                        session.set("valid_till", "%020d" % (self.time() + 90 * 86400))
-                        session.set("updated", self.now())
-                        if session.get("ip") != req.remote_addr():
-                            session.set("ip", req.remote_addr())
-                            user = session.get("user")
-                            if user:
-                                self.call("session.log", act="change", session=session.uuid, ip=req.remote_addr(), user=user)
-                        session.store()
+                # update session every hour (plus jitter)
+                if session.get("updated") < self.now(-session_refresh_interval - hash(session.uuid) % session_refresh_jitter):
+                    self.refresh_session(session.uuid, req.remote_addr())
                 if cache:
                     req._session = session
                 return session
@@ -214,12 +217,52 @@ class Sessions(Module):
             session.set("valid_till", "%020d" % (self.time() + 86400))
             session.set("ip", req.remote_addr())
             # Time in the past. This guarantees that get_session will properly update valid_till on the next get
-            session.set("updated", self.now(-3601))
+            session.set("updated", self.now(-session_refresh_interval - session_refresh_jitter - 1))
             session.store()
         if cache:
             req._session = session
         return session
 
+    def refresh_session(self, sid, ip):
+        "Schedule prolongation of the session in background"
+        self.refresh_pending[sid] = ip
+        if not self.refresh_running:
+            self.refresh_running = True
+            Tasklet.new(self.refresh_sessions)()
+
+    def refresh_sessions(self):
+        "Store collected session refreshes in batches"
+        try:
+            while self.refresh_pending:
+                Tasklet.sleep(session_refresh_delay)
+                pending = self.refresh_pending
+                self.refresh_pending = {}
+                sids = pending.keys()
+                for i in xrange(0, len(sids), session_refresh_batch):
+                    try:
+                        self.refresh_sessions_batch(sids[i:i + session_refresh_batch], pending)
+                    except Exception as e:
+                        self.exception(e)
+        finally:
+            self.refresh_running = False
+
+    def refresh_sessions_batch(self, sids, ips):
+        with self.lock(["session.%s" % sid for sid in sids]):
+            lst = self.objlist(SessionList, sids)
+            lst.load(silent=True)
+            valid_till = "%020d" % (self.time() + 90 * 86400)
+            now = self.now()
+            for session in lst:
+                session.set("valid_till", valid_till)
+                session.set("updated", now)
+                ip = ips[session.uuid]
+                if session.get("ip") != ip:
+                    session.set("ip", ip)
+                    user = session.get("user")
+                    if user:
+                        self.call("session.log", act="change", session=session.uuid, ip=ip, user=user)
+            lst.store()
+
     def require_login(self):
         req = self.req()
         session = req.session()
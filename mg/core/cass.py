@@ -20,6 +20,7 @@ import json
 import re
 from mg.core.tools import *
 from mg.core.memcached import MemcachedLock
+from concurrence.memcache.client import MemcacheResult
 from concurrence.thr import Socket
 from thrift.transport import TTransport
 from cassandra.Cassandra import Client
@@ -33,11 +34,18 @@ import random
 import stackless
 import concurrence
 import re
+import copy
 
 cache_interval = 300
 max_index_length = 10000000
 max_memcached_list_store = 1000
 max_chunk_size = 1000
+max_parallel_chunks = 4
+local_cache_size = 10000
+index_lease_timeout = 5
+index_lease_wait = 2
+index_lease_poll = 0.05
+index_read_wait = 10
 
 re_unconfigured_ks_1 = re.compile(r'^Keyspace (.+) does not exist$')
 re_unconfigured_ks_2 = re.compile(r'^There is no ring for the keyspace: (.+)$')
@@ -258,6 +266,13 @@ class Cassandra(object):
     def get_range_slices(self, *args, **kwargs):
         return self.execute("get_range_slices", {"space": True}, *args, **kwargs)
 
+    def current_batch(self):
+        "Returns CassandraBatch opened by the current tasklet for this database (or None)"
+        try:
+            return Tasklet.current().cassandra_batches.get(self)
+        except AttributeError:
+            return None
+
     def get_time(self):
         now = time.time() * 1000
         if now > self._last_time:
@@ -485,10 +500,143 @@ class CassandraConnection(object):
         self.actual_keyspace = keyspace
         self.cass.set_keyspace(keyspace)
 
+class LocalObjectCache(object):
+    """
+    Bounded per-process LRU cache of objects data. It is used for classes
+    declaring local_cache attribute (number of seconds). Every entry is bound
+    to the version of the "<clsname>/VER" memcached group which is changed on
+    every store and remove of the class objects. The version is rechecked in
+    memcached not often than once per local_cache seconds
+    """
+    def __init__(self, size=local_cache_size):
+        self.size = size
+        self.entries = {}
+        self.versions = {}
+        self.serial = 0
+
+    def version(self, db, cls):
+        "Returns key prefix for the objects of the class with actual version"
+        key = (db.keyspace, db.app, cls.clsname)
+        now = time.time()
+        ent = self.versions.get(key)
+        if ent is None or ent[0] < now:
+            ver = db.mc.get_ver("%s/VER" % cls.clsname) if db.mc else 0
+            ent = (now + cls.local_cache, ver)
+            self.versions[key] = ent
+        return key + (ent[1],)
+
+    def get_multi(self, db, cls, uuids):
+        "Returns dict uuid => data for all objects found in the cache"
+        ver = self.version(db, cls)
+        res = {}
+        for uuid in uuids:
+            ent = self.entries.get((ver, uuid))
+            if ent is not None:
+                self.serial += 1
+                ent[0] = self.serial
+                res[uuid] = copy.deepcopy(ent[1])
+        return res
+
+    def get(self, db, cls, uuid):
+        return self.get_multi(db, cls, [uuid]).get(uuid)
+
+    def set(self, db, cls, uuid, data):
+        self.serial += 1
+        self.entries[(self.version(db, cls), uuid)] = [self.serial, copy.deepcopy(data)]
+        if len(self.entries) > self.size:
+            self.evict()
+
+    def evict(self):
+        "Drop least recently used half of the cache"
+        entries = sorted(self.entries.iteritems(), key=lambda ent: ent[1][0])
+        for key, ent in entries[0:len(entries) - self.size / 2]:
+            del self.entries[key]
+
+    def changed(self, db, cls, uuid):
+        """
+        Notify cache that the object was changed by the current process.
+        The class version will be rechecked on the next access
+        """
+        key = (db.keyspace, db.app, cls.clsname)
+        ent = self.versions.pop(key, None)
+        if ent is not None:
+            self.entries.pop((key + (ent[1],), uuid), None)
+
+    def invalidate(self, db):
+        "Drop all cached objects of the given database"
+        self._invalidate(lambda keyspace, app: keyspace == db.keyspace and app == db.app)
+
+    def invalidate_tag(self, tag):
+        """
+        Drop all cached objects of the application with the given tag. The
+        application needn't be loaded: its tag is either the keyspace or
+        the app code of the database
+        """
+        self._invalidate(lambda keyspace, app: app == tag or (app is None and keyspace == tag))
+
+    def _invalidate(self, match):
+        for key in self.versions.keys():
+            if match(key[0], key[1]):
+                del self.versions[key]
+        for key in self.entries.keys():
+            if match(key[0][0], key[0][1]):
+                del self.entries[key]
+
+object_cache = LocalObjectCache()
+
+class IndexReads(object):
+    """
+    Registry of index rows being read from the database by tasklets of the
+    current process. Tasklets missing the same index row in memcached wait
+    for the running query instead of querying the database again
+    """
+    def __init__(self):
+        self.reads = {}
+
+    def wait(self, db, mcid):
+        """
+        If the row is being read by another tasklet wait for it and return
+        its data. Otherwise (or if the read failed or took longer than
+        index_read_wait seconds) return None
+        """
+        channel = self.reads.get((db.keyspace, db.app, mcid))
+        if channel is None:
+            return None
+        try:
+            data = channel.receive(index_read_wait)
+        except TimeoutError:
+            return None
+        return list(data) if data is not None else None
+
+    def begin(self, db, mcid):
+        """
+        Register the current tasklet as the reader of the row. Returns False
+        if the row is being read by another tasklet already: the caller must
+        wait() for it instead of replacing its registration
+        """
+        key = (db.keyspace, db.app, mcid)
+        if key in self.reads:
+            return False
+        self.reads[key] = concurrence.Channel()
+        return True
+
+    def finish(self, db, mcid, data):
+        "Wake up all tasklets waiting for the row. data=None means failure"
+        channel = self.reads.pop((db.keyspace, db.app, mcid), None)
+        if channel is not None:
+            while channel.balance < 0:
+                channel.send(data)
+
+index_reads = IndexReads()
+
 class CassandraObject(object):
     """
     An ORM object
     """
+    # Number of seconds objects may be kept in the LocalObjectCache without
+    # checking their version in memcached (None - don't cache locally)
+    local_cache = None
+
     def __init__(self, db, uuid=None, data=None, silent=False):
         """
         db - Cassandra database
@@ -578,6 +726,13 @@ class CassandraObject(object):
         Raises ObjectNotFoundException
         """
         self._indexes = None
+        cls = self.__class__
+        if cls.local_cache:
+            data = object_cache.get(self.db, cls, self.uuid)
+            if data is not None:
+                self.data = data
+                self.dirty = False
+                return
         row_mcid = "%s-%s" % (self.__class__.clsname, self.uuid)
         self.data = self.db.mc.get(row_mcid) if self.db.mc else None
         if self.data == "tomb":
@@ -599,10 +754,12 @@ class CassandraObject(object):
                 raise ObjectNotFoundException(self.uuid)
             self.data = json.loads(col.value)
             if self.db.mc:
-                self.db.mc.add(row_mcid, self.data, cache_interval)
+                self.db.mc.queue_add(row_mcid, self.data, cache_interval)
 #            print "LOAD(DB) %s %s" % (row_id, self.data)
 #        else:
 #            print "LOAD(MC) %s %s" % (row_id, self.data)
+        if cls.local_cache:
+            object_cache.set(self.db, cls, self.uuid, self.data)
         self.dirty = False
 
     def mutate(self, mutations, mcgroups, timestamp):
@@ -692,15 +849,23 @@ class CassandraObject(object):
         row_mcid = "%s-%s" % (self.__class__.clsname, self.uuid)
         if self.db.mc:
             self.db.mc.set(row_mcid, self.data, cache_interval)
+        if self.__class__.local_cache:
+            mcgroups.add("%s/VER" % self.__class__.clsname)
+            object_cache.changed(self.db, self.__class__, self.uuid)
         self.dirty = False
         self.new = False
 
     def store(self):
         """
-        Store object in the database
+        Store object in the database. If a CassandraBatch is open in the current
+        tasklet mutations are postponed until the batch is flushed
         """
         if not self.dirty:
             return
+        batch = self.db.current_batch()
+        if batch is not None:
+            batch.add(self)
+            return
         timestamp = self.db.get_time()
         mutations = {}
         mcgroups = set()
@@ -708,8 +873,7 @@ class CassandraObject(object):
         if len(mutations):
             self.db.batch_mutate(mutations, ConsistencyLevel.QUORUM)
             if self.db.mc:
-                for mcid in mcgroups:
-                    self.db.mc.incr_ver(mcid)
+                self.db.mc.incr_ver_multi(mcgroups)
 
     def remove(self):
         """
@@ -729,6 +893,9 @@ class CassandraObject(object):
         # removing indexes
         mutations = {}
         mcgroups = set()
+        if self.__class__.local_cache:
+            mcgroups.add("%s/VER" % self.__class__.clsname)
+            object_cache.changed(self.db, self.__class__, self.uuid)
         old_index_values = self.index_values()
         for index_name, key in old_index_values.iteritems():
             if self.db.storage == 0:
@@ -755,9 +922,8 @@ class CassandraObject(object):
 #       print "REMOVE %s" % row_id
         if len(mutations):
             self.db.batch_mutate(mutations, ConsistencyLevel.QUORUM)
-            if self.db.mc:
-                for mcid in mcgroups:
-                    self.db.mc.incr_ver(mcid)
+        if self.db.mc:
+            self.db.mc.incr_ver_multi(mcgroups)
         self.dirty = False
         self.new = False
 
@@ -855,19 +1021,11 @@ class CassandraObjectList(object):
                 for val in query_equal:
                     mcid = urlencode("%s-%s-%s/%s/%s/%s/%s/%s" % (clsname, query_index, val, query_start, query_finish, query_limit, query_reversed, grpid))
                     mcids.append(mcid)
-                    if self.db.storage == 0:
-                        index_row = "%s_%s_Index_eq-%s" % (clsname, query_index, val)
-                    elif self.db.storage == 1:
-                        index_row = "eq-%s" % val
-                    elif self.db.storage == 2:
-                        index_row = "%s_%s_Index_eq-%s" % (self.db.app, query_index, val)
-                    if type(index_row) == unicode:
-                        index_row = index_row.encode("utf-8")
-                    index_rows.append(index_row)
+                    index_rows.append(self._index_row(db, clsname, query_index, val))
 #               print "loading mcids %s" % mcids
                 d = self.db.mc.get_multi(mcids) if self.db.mc else {}
 #               print d
-                remain_index_rows = []
+                remain_index_rows = {}
                 for i in range(0, len(query_equal)):
                     index_row = index_rows[i]
                     index_data = d.get(mcids[i])
@@ -876,73 +1034,30 @@ class CassandraObjectList(object):
                         self.index_rows[index_row] = [ent[1] for ent in index_data]
                         self.index_data.extend(index_data)
                     else:
-                        remain_index_rows.append(index_row)
+                        remain_index_rows[index_row] = mcids[i]
                 if len(remain_index_rows):
 #                   print "loading index rows %s" % remain_index_rows
-                    if self.db.storage == 0:
-                        cf = "Data"
-                    elif self.db.storage == 1:
-                        cf = "%s_Index_%s" % (clsname, query_index)
-                    elif self.db.storage == 2:
-                        cf = "%s_Indexes" % clsname
-                    d = self.db.multiget_slice(remain_index_rows, ColumnParent(column_family=cf), SlicePredicate(slice_range=SliceRange(start=query_start, finish=query_finish, reversed=query_reversed, count=query_limit)), ConsistencyLevel.QUORUM)
+                    cf = self._index_family(db, clsname, query_index)
+                    d = self._read_index_rows(cf, remain_index_rows, SlicePredicate(slice_range=SliceRange(start=query_start, finish=query_finish, reversed=query_reversed, count=query_limit)))
 #                   print d
                     for index_row, index_data in d.iteritems():
-                        self.index_rows[index_row] = [col.column.value for col in index_data]
-                        index_data = [[col.column.name, col.column.value] for col in index_data]
+                        self.index_rows[index_row] = [ent[1] for ent in index_data]
                         self.index_data.extend(index_data)
-                        mcid = urlencode("%s-%s-%s/%s/%s/%s/%s/%s" % (clsname, query_index, index_row, query_start, query_finish, query_limit, query_reversed, grpid))
-                        #logging.getLogger("mg.core.cass.CassandraObject").debug("storing mcid %s = %s", mcid, index_data)
-                        if self.db.mc:
-                            if len(index_data) < max_index_length:
-                                self.db.mc.set(mcid, index_data)
-                            else:
-                                self.db.mc.delete(mcid)
                 self.index_data.sort(cmp=lambda x, y: cmp(x[0], y[0]), reverse=query_reversed)
                 self.lst = [cls(db, col[1], {}) for col in self.index_data]
                 #print "loaded index data %s" % self.index_data
             else:
                 # single key
                 mcid = urlencode("%s-%s-%s/%s/%s/%s/%s/%s" % (clsname, query_index, query_equal, query_start, query_finish, query_limit, query_reversed, grpid))
-                if self.db.storage == 0:
-                    if query_equal is None:
-                        index_row = "%s_%s_Index_eq" % (clsname, query_index)
-                    else:
-                        index_row = "%s_%s_Index_eq-%s" % (clsname, query_index, query_equal)
-                elif self.db.storage == 1:
-                    if query_equal is None:
-                        index_row = "eq"
-                    else:
-                        index_row = "eq-%s" % query_equal
-                elif self.db.storage == 2:
-                    if query_equal is None:
-                        index_row = "%s_%s_Index_eq" % (self.db.app, query_index)
-                    else:
-                        index_row = "%s_%s_Index_eq-%s" % (self.db.app, query_index, query_equal)
-                if type(index_row) == unicode:
-                    index_row = index_row.encode("utf-8")
+                index_row = self._index_row(db, clsname, query_index, query_equal)
 #               print "loading mcid %s" % mcid
                 d = self.db.mc.get(mcid) if self.db.mc else None
-                if d is not None:
-                    self.index_rows[index_row] = [ent[1] for ent in d]
-                    self.index_data = d
-                else:
+                if d is None:
 #                   print "loading index row %s" % index_row
-                    if self.db.storage == 0:
-                        cf = "Data"
-                    elif self.db.storage == 1:
-                        cf = "%s_Index_%s" % (clsname, query_index)
-                    elif self.db.storage == 2:
-                        cf = "%s_Indexes" % clsname
-                    d = self.db.get_slice(index_row, ColumnParent(column_family=cf), SlicePredicate(slice_range=SliceRange(start=query_start, finish=query_finish, reversed=query_reversed, count=query_limit)), ConsistencyLevel.QUORUM)
-                    self.index_rows[index_row] = [col.column.value for col in d]
-                    self.index_data = [[col.column.name, col.column.value] for col in d]
-                    #logging.getLogger("mg.core.cass.CassandraObject").debug("storing mcid %s = %s", mcid, self.index_data)
-                    if self.db.mc:
-                        if len(self.index_data) < max_index_length:
-                            self.db.mc.set(mcid, self.index_data)
-                        else:
-                            self.db.mc.delete(mcid)
+                    cf = self._index_family(db, clsname, query_index)
+                    d = self._read_index_rows(cf, {index_row: mcid}, SlicePredicate(slice_range=SliceRange(start=query_start, finish=query_finish, reversed=query_reversed, count=query_limit)))[index_row]
+                self.index_rows[index_row] = [ent[1] for ent in d]
+                self.index_data = d
 #               print "loaded index data " % self.index_data
                 self.lst = [cls(db, col[1], {}) for col in self.index_data]
         else:
@@ -950,6 +1065,169 @@ class CassandraObjectList(object):
         for obj in self.lst:
             obj._indexes = None
 
+    @staticmethod
+    def _index_family(db, clsname, query_index):
+        "Column family keeping index rows"
+        if db.storage == 0:
+            return "Data"
+        elif db.storage == 1:
+            return "%s_Index_%s" % (clsname, query_index)
+        elif db.storage == 2:
+            return "%s_Indexes" % clsname
+
+    @staticmethod
+    def _index_row(db, clsname, query_index, query_equal):
+        "Key of the index row for the given equal value (None - index without equal fields)"
+        if db.storage == 0:
+            if query_equal is None:
+                index_row = "%s_%s_Index_eq" % (clsname, query_index)
+            else:
+                index_row = "%s_%s_Index_eq-%s" % (clsname, query_index, query_equal)
+        elif db.storage == 1:
+            if query_equal is None:
+                index_row = "eq"
+            else:
+                index_row = "eq-%s" % query_equal
+        elif db.storage == 2:
+            if query_equal is None:
+                index_row = "%s_%s_Index_eq" % (db.app, query_index)
+            else:
+                index_row = "%s_%s_Index_eq-%s" % (db.app, query_index, query_equal)
+        if type(index_row) == unicode:
+            index_row = index_row.encode("utf-8")
+        return index_row
+
+    @classmethod
+    def pages(cls, db, query_index, query_equal=None, query_start="", query_finish="", query_reversed=False, page_size=max_chunk_size, silent=False):
+        """
+        Walk an index slice by slice without loading it entirely:
+        for lst in CassandraObjectList.pages(db, query_index="name5", query_equal="value1-value2", page_size=100):
+            for obj in lst:
+                ...
+
+        Every slice contains page_size columns at most and continues from the last column
+        of the previous one. Yields loaded lists one by one, so only the current page is
+        kept in memory. Index slices are read from the database directly bypassing memcached
+        """
+        clsname = cls.objcls.clsname
+        cf = cls._index_family(db, clsname, query_index)
+        index_row = cls._index_row(db, clsname, query_index, query_equal)
+        start = query_start
+        last_column = None
+        while True:
+            # slice start is inclusive - the last column of the previous page is returned again
+            count = page_size if last_column is None else page_size + 1
+            cols = db.get_slice(index_row, ColumnParent(column_family=cf), SlicePredicate(slice_range=SliceRange(start=start, finish=query_finish, reversed=query_reversed, count=count)), ConsistencyLevel.QUORUM)
+            index_data = [[col.column.name, col.column.value] for col in cols]
+            fetched = len(index_data)
+            if fetched:
+                start = index_data[-1][0]
+            if index_data and index_data[0][0] == last_column:
+                del index_data[0]
+            if index_data:
+                lst = cls(db, [ent[1] for ent in index_data])
+                lst.query_index = query_index
+                lst.index_rows[index_row] = [ent[1] for ent in index_data]
+                lst.index_data = index_data
+                lst.load(silent=silent)
+                yield lst
+            if fetched < count:
+                break
+            last_column = start
+
+    def _read_index_rows(self, cf, rows, predicate):
+        """
+        Read index rows missing in memcached from the database and store them
+        in memcached. rows - dict index_row => mcid.
+        Concurrent misses of the same row share a single query: tasklets of
+        this process wait for the running one, other processes wait for the
+        memcached lease of a single row query (for index_lease_wait seconds
+        at most) and take the result from memcached.
+        Returns dict index_row => [[column, uuid], ...]
+        """
+        res = {}
+        query = []
+        for index_row, mcid in rows.iteritems():
+            data = index_reads.wait(self.db, mcid)
+            if data is None:
+                query.append(index_row)
+            else:
+                res[index_row] = data
+        if not query:
+            return res
+        mc = self.db.mc
+        lease = None
+        if mc and len(query) == 1:
+            mcid = rows[query[0]]
+            lease = "%s/LEASE" % mcid
+            if mc.add(lease, 1, index_lease_timeout) == MemcacheResult.NOT_STORED:
+                # another process is reading this row
+                data = None
+                till = time.time() + index_lease_wait
+                while time.time() < till:
+                    Tasklet.sleep(index_lease_poll)
+                    d = mc.get_multi([mcid, lease])
+                    data = d.get(mcid)
+                    if data is not None or d.get(lease) is None:
+                        break
+                if data is not None:
+                    res[query[0]] = data
+                    return res
+                lease = None
+        # rows registered by other tasklets since the check above are joined
+        owned = []
+        joined = []
+        for index_row in query:
+            if index_reads.begin(self.db, rows[index_row]):
+                owned.append(index_row)
+            else:
+                joined.append(index_row)
+        try:
+            if owned:
+                res.update(self._query_index_rows(cf, owned, rows, predicate, lease))
+        finally:
+            for index_row in owned:
+                index_reads.finish(self.db, rows[index_row], res.get(index_row))
+            if lease:
+                mc.delete(lease)
+        if joined:
+            retry = []
+            for index_row in joined:
+                data = index_reads.wait(self.db, rows[index_row])
+                if data is None:
+                    retry.append(index_row)
+                else:
+                    res[index_row] = data
+            if retry:
+                res.update(self._query_index_rows(cf, retry, rows, predicate, None))
+        return res
+
+    def _query_index_rows(self, cf, query, rows, predicate, lease):
+        "Query index rows from the database and store them in memcached"
+        res = {}
+        mc = self.db.mc
+        if len(query) == 1:
+            d = {query[0]: self.db.get_slice(query[0], ColumnParent(column_family=cf), predicate, ConsistencyLevel.QUORUM)}
+        else:
+            d = self.db.multiget_slice(query, ColumnParent(column_family=cf), predicate, ConsistencyLevel.QUORUM)
+        for index_row, index_data in d.iteritems():
+            index_data = [[col.column.name, col.column.value] for col in index_data]
+            res[index_row] = index_data
+            if mc:
+                mcid = rows[index_row]
+                #logging.getLogger("mg.core.cass.CassandraObject").debug("storing mcid %s = %s", mcid, index_data)
+                if lease:
+                    # waiting processes poll memcached - don't postpone
+                    if len(index_data) < max_index_length:
+                        mc.set(mcid, index_data)
+                    else:
+                        mc.delete(mcid)
+                elif len(index_data) < max_index_length:
+                    mc.queue_set(mcid, index_data)
+                else:
+                    mc.queue_delete(mcid)
+        return res
+
     def index_values(self, strip_prefix_len=0):
         res = []
         for key, values in self.index_rows.iteritems():
@@ -960,126 +1238,187 @@ class CassandraObjectList(object):
         return res
 
     def load(self, silent=False):
+        for index_from, index_to in self._load_chunks(silent):
+            pass
+
+    def iter_load(self, silent=False):
+        """
+        Load objects and yield them as soon as their chunk is loaded. Chunks are fetched
+        in parallel. With silent=True missing objects are skipped
+        """
+        for index_from, index_to in self._load_chunks(silent):
+            for i in xrange(index_from, index_to):
+                obj = self.lst[i]
+                if obj.valid:
+                    yield obj
+
+    def _load_chunks(self, silent):
+        """
+        Load list chunk by chunk. Up to max_parallel_chunks chunks of this list are fetched
+        concurrently. The limit is per list: concurrent lists are bounded by CassandraPool
+        size only (fetches wait for a free connection in cget).
+        Yields (index_from, index_to) of every loaded chunk in the list order
+        """
         if self.lst:
-            def load_chunk(index_from, index_to):
-                clsname = self.__class__.objcls.clsname
-                row_mcids = ["%s-%s" % (clsname, self.lst[i].uuid) for i in xrange(index_from, index_to)]
-                mc_d = self.db.mc.get_multi(row_mcids) if self.db.mc else {}
-                if self.db.storage == 0:
-                    col_ids = [self.lst[i].uuid for i in xrange(index_from, index_to) if "%s-%s" % (clsname, self.lst[i].uuid) not in mc_d]
-                    row_ids = ["%s_Object_%s" % (clsname, uuid) for uuid in col_ids]
-                    if row_ids:
-                        db_d = self.db.multiget_slice(row_ids, ColumnParent(column_family="Data"), SlicePredicate(column_names=["data-%s" % uuid for uuid in col_ids]), ConsistencyLevel.QUORUM)
-                    else:
-                        db_d = {}
-                elif self.db.storage == 1:
-                    col_ids = [self.lst[i].uuid for i in xrange(index_from, index_to) if "%s-%s" % (clsname, self.lst[i].uuid) not in mc_d]
-                    row_ids = col_ids
-                    if row_ids:
-                        db_d = self.db.multiget_slice(row_ids, ColumnParent(column_family="%s_Objects" % clsname), SlicePredicate(column_names=["data-%s" % uuid for uuid in col_ids]), ConsistencyLevel.QUORUM)
-                    else:
-                        db_d = {}
-                elif self.db.storage == 2:
-                    col_ids = [self.lst[i].uuid for i in xrange(index_from, index_to) if "%s-%s" % (clsname, self.lst[i].uuid) not in mc_d]
-                    row_ids = ["%s_%s" % (self.db.app, uuid) for uuid in col_ids]
-                    if row_ids:
-                        db_d = self.db.multiget_slice(row_ids, ColumnParent(column_family="%s_Objects" % clsname), SlicePredicate(column_names=["data-%s" % uuid for uuid in col_ids]), ConsistencyLevel.QUORUM)
-                    else:
-                        db_d = {}
-                recovered = False
-                for i in xrange(index_from, index_to):
-                    obj = self.lst[i]
-                    obj.valid = True
-                    row_mcid = "%s-%s" % (clsname, obj.uuid)
-                    data = mc_d.get(row_mcid)
-                    if data is not None:
-                        #print "LOAD(MC) %s %s" % (obj.uuid, data)
-                        if data == "tomb":
-                            if silent:
-                                obj.valid = False
-                                recovered = True
-                                if len(self.index_rows):
-                                    mutations = []
-                                    mcgroups = set()
-                                    timestamp = None
-                                    for col in self.index_data:
-                                        if col[1] == obj.uuid:
-                                            #print "read recovery. removing column %s from index row %s" % (col.column.name, self.index_row)
-                                            if timestamp is None:
-                                                timestamp = self.db.get_time()
-                                            mutations.append(Mutation(deletion=Deletion(predicate=SlicePredicate([col[0]]), timestamp=timestamp)))
-                                            if self.db.mc:
-                                                self.db.mc.incr_ver("%s-%s/VER" % (clsname, self.query_index))
-                                            break
-                                    if len(mutations):
-                                        if self.db.storage == 0:
-                                            cf = "Data"
-                                        elif self.db.storage == 1:
-                                            cf = "%s_Index_%s" % (clsname, self.query_index)
-                                        elif self.db.storage == 2:
-                                            cf = "%s_Indexes" % clsname
-                                        self.db.batch_mutate(dict([(index_row, {cf: mutations}) for index_row, values in self.index_rows.iteritems()]), ConsistencyLevel.QUORUM)
-                            else:
-                                raise ObjectNotFoundException("UUID %s (keyspace %s, cls %s) not found" % (obj.uuid, obj.db.keyspace, clsname))
-                        else:
-                            obj.data = data
-                            obj.dirty = False
-                    else:
-                        if self.db.storage == 0:
-                            row_id = "%s_Object_%s" % (clsname, obj.uuid)
-                        elif self.db.storage == 1:
-                            row_id = obj.uuid
-                        elif self.db.storage == 2:
-                            row_id = "%s_%s" % (self.db.app, obj.uuid)
-                        cols = db_d.get(row_id)
-                        if cols:
-                            obj.data = json.loads(cols[0].column.value)
-                            obj.dirty = False
-                            # Don't save too long lists to the memcached. It's useless
-                            if self.db.mc and len(self.lst) <= max_memcached_list_store:
-                                self.db.mc.add(row_mcid, obj.data, cache_interval)
-                            #print "LOAD(DB) %s %s" % (obj.uuid, obj.data)
-                        elif silent:
-                            obj.valid = False
-                            recovered = True
-                            if len(self.index_rows):
-                                mutations = []
-                                timestamp = None
-                                for col in self.index_data:
-                                    if col[1] == obj.uuid:
-                                        #print "read recovery. removing column %s from index row %s" % (col.column.name, self.index_row)
-                                        if timestamp is None:
-                                            timestamp = self.db.get_time()
-                                        mutations.append(Mutation(deletion=Deletion(predicate=SlicePredicate([col[0]]), timestamp=timestamp)))
-                                        if self.db.mc:
-                                            self.db.mc.incr_ver("%s-%s/VER" % (clsname, self.query_index))
-                                        break
-                                if len(mutations):
-                                    if self.db.storage == 0:
-                                        cf = "Data"
-                                    elif self.db.storage == 1:
-                                        cf = "%s_Index_%s" % (clsname, self.query_index)
-                                    elif self.db.storage == 2:
-                                        cf = "%s_Indexes" % clsname
-                                    self.db.batch_mutate(dict([(index_row, {cf: mutations}) for index_row, values in self.index_rows.iteritems()]), ConsistencyLevel.QUORUM)
-                        else:
-                            raise ObjectNotFoundException("UUID %s (keyspace %s, cls %s) not found" % (obj.uuid, obj.db.keyspace, clsname))
-                return recovered
-            # trying to load long lists chunk by chunk
-            recovered = False
-            index = 0
             len_lst = len(self.lst)
-            while index < len_lst:
-                chunk_size = len_lst - index
-                if chunk_size > max_chunk_size:
-                    chunk_size = max_chunk_size
-                if load_chunk(index, index + chunk_size):
+            chunks = [(index, min(index + max_chunk_size, len_lst)) for index in xrange(0, len_lst, max_chunk_size)]
+            recovered = False
+            if len(chunks) == 1:
+                index_from, index_to = chunks[0]
+                if self._apply_chunk(index_from, index_to, self._fetch_chunk(index_from, index_to), silent):
                     recovered = True
-                index += chunk_size
+                yield index_from, index_to
+            else:
+                # trying to load long lists chunk by chunk
+                tasks = []
+                next_chunk = 0
+                try:
+                    for index_from, index_to in chunks:
+                        while next_chunk < len(chunks) and len(tasks) < max_parallel_chunks:
+                            tasks.append(Tasklet.new(self._fetch_chunk)(*chunks[next_chunk]))
+                            next_chunk += 1
+                        fetched = Tasklet.join_all([tasks.pop(0)])[0]
+                        if isinstance(fetched, Exception):
+                            raise fetched
+                        if self._apply_chunk(index_from, index_to, fetched, silent):
+                            recovered = True
+                        yield index_from, index_to
+                finally:
+                    # on errors and early stop of iter_load() fetches in flight must not be left behind.
+                    # They are joined rather than killed to return their connections to the pool
+                    if tasks:
+                        Tasklet.join_all(tasks)
             if recovered:
                 self.lst = [obj for obj in self.lst if obj.valid]
         self._loaded = True
 
+    def _fetch_chunk(self, index_from, index_to):
+        "Query local cache, memcached and database for the objects of the chunk"
+        cls = self.__class__.objcls
+        clsname = cls.clsname
+        if cls.local_cache:
+            local_d = object_cache.get_multi(self.db, cls, [self.lst[i].uuid for i in xrange(index_from, index_to)])
+        else:
+            local_d = {}
+        row_mcids = ["%s-%s" % (clsname, self.lst[i].uuid) for i in xrange(index_from, index_to) if self.lst[i].uuid not in local_d]
+        mc_d = self.db.mc.get_multi(row_mcids) if self.db.mc and row_mcids else {}
+        if self.db.storage == 0:
+            col_ids = [self.lst[i].uuid for i in xrange(index_from, index_to) if self.lst[i].uuid not in local_d and "%s-%s" % (clsname, self.lst[i].uuid) not in mc_d]
+            row_ids = ["%s_Object_%s" % (clsname, uuid) for uuid in col_ids]
+            if row_ids:
+                db_d = self.db.multiget_slice(row_ids, ColumnParent(column_family="Data"), SlicePredicate(column_names=["data-%s" % uuid for uuid in col_ids]), ConsistencyLevel.QUORUM)
+            else:
+                db_d = {}
+        elif self.db.storage == 1:
+            col_ids = [self.lst[i].uuid for i in xrange(index_from, index_to) if self.lst[i].uuid not in local_d and "%s-%s" % (clsname, self.lst[i].uuid) not in mc_d]
+            row_ids = col_ids
+            if row_ids:
+                db_d = self.db.multiget_slice(row_ids, ColumnParent(column_family="%s_Objects" % clsname), SlicePredicate(column_names=["data-%s" % uuid for uuid in col_ids]), ConsistencyLevel.QUORUM)
+            else:
+                db_d = {}
+        elif self.db.storage == 2:
+            col_ids = [self.lst[i].uuid for i in xrange(index_from, index_to) if self.lst[i].uuid not in local_d and "%s-%s" % (clsname, self.lst[i].uuid) not in mc_d]
+            row_ids = ["%s_%s" % (self.db.app, uuid) for uuid in col_ids]
+            if row_ids:
+                db_d = self.db.multiget_slice(row_ids, ColumnParent(column_family="%s_Objects" % clsname), SlicePredicate(column_names=["data-%s" % uuid for uuid in col_ids]), ConsistencyLevel.QUORUM)
+            else:
+                db_d = {}
+        return local_d, mc_d, db_d
+
+    def _apply_chunk(self, index_from, index_to, fetched, silent):
+        "Fill objects of the chunk with fetched data. Returns True when some objects were missing"
+        cls = self.__class__.objcls
+        clsname = cls.clsname
+        local_d, mc_d, db_d = fetched
+        recovered = False
+        for i in xrange(index_from, index_to):
+            obj = self.lst[i]
+            obj.valid = True
+            data = local_d.get(obj.uuid)
+            if data is not None:
+                obj.data = data
+                obj.dirty = False
+                continue
+            row_mcid = "%s-%s" % (clsname, obj.uuid)
+            data = mc_d.get(row_mcid)
+            if data is not None:
+                #print "LOAD(MC) %s %s" % (obj.uuid, data)
+                if data == "tomb":
+                    if silent:
+                        obj.valid = False
+                        recovered = True
+                        if len(self.index_rows):
+                            mutations = []
+                            mcgroups = set()
+                            timestamp = None
+                            for col in self.index_data:
+                                if col[1] == obj.uuid:
+                                    #print "read recovery. removing column %s from index row %s" % (col.column.name, self.index_row)
+                                    if timestamp is None:
+                                        timestamp = self.db.get_time()
+                                    mutations.append(Mutation(deletion=Deletion(predicate=SlicePredicate([col[0]]), timestamp=timestamp)))
+                                    if self.db.mc:
+                                        self.db.mc.incr_ver("%s-%s/VER" % (clsname, self.query_index))
+                                    break
+                            if len(mutations):
+                                if self.db.storage == 0:
+                                    cf = "Data"
+                                elif self.db.storage == 1:
+                                    cf = "%s_Index_%s" % (clsname, self.query_index)
+                                elif self.db.storage == 2:
+                                    cf = "%s_Indexes" % clsname
+                                self.db.batch_mutate(dict([(index_row, {cf: mutations}) for index_row, values in self.index_rows.iteritems()]), ConsistencyLevel.QUORUM)
+                    else:
+                        raise ObjectNotFoundException("UUID %s (keyspace %s, cls %s) not found" % (obj.uuid, obj.db.keyspace, clsname))
+                else:
+                    obj.data = data
+                    obj.dirty = False
+                    if cls.local_cache:
+                        object_cache.set(self.db, cls, obj.uuid, data)
+            else:
+                if self.db.storage == 0:
+                    row_id = "%s_Object_%s" % (clsname, obj.uuid)
+                elif self.db.storage == 1:
+                    row_id = obj.uuid
+                elif self.db.storage == 2:
+                    row_id = "%s_%s" % (self.db.app, obj.uuid)
+                cols = db_d.get(row_id)
+                if cols:
+                    obj.data = json.loads(cols[0].column.value)
+                    obj.dirty = False
+                    if cls.local_cache:
+                        object_cache.set(self.db, cls, obj.uuid, obj.data)
+                    # Don't save too long lists to the memcached. It's useless
+                    if self.db.mc and len(self.lst) <= max_memcached_list_store:
+                        self.db.mc.queue_add(row_mcid, obj.data, cache_interval)
+                    #print "LOAD(DB) %s %s" % (obj.uuid, obj.data)
+                elif silent:
+                    obj.valid = False
+                    recovered = True
+                    if len(self.index_rows):
+                        mutations = []
+                        timestamp = None
+                        for col in self.index_data:
+                            if col[1] == obj.uuid:
+                                #print "read recovery. removing column %s from index row %s" % (col.column.name, self.index_row)
+                                if timestamp is None:
+                                    timestamp = self.db.get_time()
+                                mutations.append(Mutation(deletion=Deletion(predicate=SlicePredicate([col[0]]), timestamp=timestamp)))
+                                if self.db.mc:
+                                    self.db.mc.incr_ver("%s-%s/VER" % (clsname, self.query_index))
+                                break
+                        if len(mutations):
+                            if self.db.storage == 0:
+                                cf = "Data"
+                            elif self.db.storage == 1:
+                                cf = "%s_Index_%s" % (clsname, self.query_index)
+                            elif self.db.storage == 2:
+                                cf = "%s_Indexes" % clsname
+                            self.db.batch_mutate(dict([(index_row, {cf: mutations}) for index_row, values in self.index_rows.iteritems()]), ConsistencyLevel.QUORUM)
+                else:
+                    raise ObjectNotFoundException("UUID %s (keyspace %s, cls %s) not found" % (obj.uuid, obj.db.keyspace, clsname))
+        return recovered
+
     def _load_if_not_yet(self, silent=False):
         if not self._loaded:
             self.load(silent);
@@ -1088,6 +1427,12 @@ class CassandraObjectList(object):
         if not dont_load:
             self._load_if_not_yet()
         if len(self.lst) > 0:
+            batch = self.db.current_batch()
+            if batch is not None:
+                for obj in self.lst:
+                    if obj.dirty:
+                        batch.add(obj)
+                return
             mutations = {}
             mcgroups = set()
             timestamp = None
@@ -1099,8 +1444,7 @@ class CassandraObjectList(object):
             if len(mutations) > 0:
                 self.db.batch_mutate(mutations, ConsistencyLevel.QUORUM)
                 if self.db.mc:
-                    for mcid in mcgroups:
-                        self.db.mc.incr_ver(mcid)
+                    self.db.mc.incr_ver_multi(mcgroups)
 
     def remove(self):
         self._load_if_not_yet(True)
@@ -1146,14 +1490,16 @@ class CassandraObjectList(object):
                 obj.db.remove(row_id, ColumnPath(cf), timestamp, ConsistencyLevel.QUORUM)
                 if obj.db.mc:
                     obj.db.mc.set(row_mcid, "tomb", cache_interval)
+                if obj.__class__.local_cache:
+                    mcgroups.add("%s/VER" % obj.__class__.clsname)
+                    object_cache.changed(obj.db, obj.__class__, obj.uuid)
                 obj.dirty = False
                 obj.new = False
             # removing indexes
             if len(mutations):
                 self.db.batch_mutate(mutations, ConsistencyLevel.QUORUM)
-                if self.db.mc:
-                    for mcid in mcgroups:
-                        self.db.mc.incr_ver(mcid)
+            if self.db.mc:
+                self.db.mc.incr_ver_multi(mcgroups)
 
     def __len__(self):
         return self.lst.__len__()
@@ -1205,6 +1551,73 @@ class CassandraObjectList(object):
     def uuids(self):
         return [obj.uuid for obj in self.lst]
 
+class CassandraBatch(object):
+    """
+    Unit of work. While the batch is open CassandraObject.store() and
+    CassandraObjectList.store() called by the current tasklet don't write to the
+    database immediately. Mutations of all stored objects are collected and sent
+    in a single batch_mutate when the batch is closed (or grows too large).
+    Objects data are put to memcached immediately, so subsequent loads see
+    stored values. Index queries see new values only after flush.
+
+    with CassandraBatch(db):
+        obj1.store()
+        obj2.store()
+    """
+    def __init__(self, db):
+        self.db = db
+        self.mutations = {}
+        self.mcgroups = set()
+        self.depth = 0
+
+    def __enter__(self):
+        tasklet = Tasklet.current()
+        try:
+            batches = tasklet.cassandra_batches
+        except AttributeError:
+            batches = {}
+            tasklet.cassandra_batches = batches
+        outer = batches.get(self.db)
+        if outer is not None and outer is not self:
+            # Nested batches are merged into the outermost one
+            outer.depth += 1
+            self.outer = outer
+            return outer
+        self.outer = None
+        self.depth += 1
+        batches[self.db] = self
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self.outer is not None:
+            self.outer.depth -= 1
+            return
+        self.depth -= 1
+        if self.depth > 0:
+            return
+        del Tasklet.current().cassandra_batches[self.db]
+        # Stored objects are already visible in memcached. Writing them even if
+        # exception occurred to keep the same durability as unbatched store()
+        self.flush()
+
+    def add(self, obj):
+        "Collect mutations of the given object"
+        obj.mutate(self.mutations, self.mcgroups, self.db.get_time())
+        if len(self.mutations) >= max_chunk_size:
+            self.flush()
+
+    def flush(self):
+        "Send all collected mutations to the database"
+        if not self.mutations:
+            return
+        mutations = self.mutations
+        mcgroups = self.mcgroups
+        self.mutations = {}
+        self.mcgroups = set()
+        self.db.batch_mutate(mutations, ConsistencyLevel.QUORUM)
+        if self.db.mc:
+            self.db.mc.incr_ver_multi(mcgroups)
+
 class CassandraDump(object):
     def __init__(self, db):
         self.db = db
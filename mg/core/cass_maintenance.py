@@ -22,6 +22,7 @@ import re
 import json
 import time
 from mg.core.tools import *
+from mg.core.cass import max_chunk_size
 
 class CassandraMaintenance(mg.Module):
     def register(self):
@@ -53,29 +54,31 @@ class CassandraMaintenance(mg.Module):
                 index_cnt += len(index_data)
                 self.debug("Index %s entries: %s", index_name, len(index_data))
                 indexes[index_name] = index_data
-            # iterating over objects and checking their indexes
-            for uuid in uuids:
-                obj = app.obj(cinfo[0], uuid)
-                restore = False
-                for index_name, lst in obj.index_values().iteritems():
-                    key = utf2str(lst[0])
-                    column = utf2str(lst[1])
-                    try:
-                        index = indexes[index_name]
-                        objects = index[key][2]
-                        del objects[column]
-                        if not objects:
-                            del index[key]
-                            if not index:
-                                del indexes[index_name]
-                    except KeyError:
-                        missing_cnt += 1
-                        self.debug("  - object %s is missing index %s (key %s, column %s)", obj.uuid, index_name, key, column)
-                        restore = True
-                if restore:
-                    obj.touch()
-                    obj._indexes = {}
-                    obj.store()
+            # iterating over objects chunk by chunk and checking their indexes
+            for i in xrange(0, obj_cnt, max_chunk_size):
+                objs = app.objlist(cinfo[1], uuids[i:i + max_chunk_size])
+                objs.load(silent=True)
+                for obj in objs:
+                    restore = False
+                    for index_name, lst in obj.index_values().iteritems():
+                        key = utf2str(lst[0])
+                        column = utf2str(lst[1])
+                        try:
+                            index = indexes[index_name]
+                            objects = index[key][2]
+                            del objects[column]
+                            if not objects:
+                                del index[key]
+                                if not index:
+                                    del indexes[index_name]
+                        except KeyError:
+                            missing_cnt += 1
+                            self.debug("  - object %s is missing index %s (key %s, column %s)", obj.uuid, index_name, key, column)
+                            restore = True
+                    if restore:
+                        obj.touch()
+                        obj._indexes = {}
+                        obj.store()
             # iterating over remaining indexes and deleting them from the DB
             for index_name, index_data in indexes.iteritems():
                 self.debug("Listing invalid keys in index %s", index_name)
@@ -23,6 +23,8 @@ re_config_path = re.compile(r'^(.+?)\.(.+)$')
 
 class DBConfigGroup(CassandraObject):
     clsname = "ConfigGroup"
+    # Config changes are broadcasted to all processes (/core/appconfig)
+    local_cache = 60
     indexes = {
         "all": [[]],
     }
@@ -25,47 +25,58 @@ import logging
 import traceback
 import concurrence
 import random
+import hashlib
+import struct
+import bisect
+import copy
 
 DEBUG = 0
 
 class MemcachedEmptyKeyError(Exception):
     pass
 
-class MemcachedPool(object):
+ketama_points_per_host = 160
+
+def ketama_hash(key):
+    "32-bit ketama hash of the key"
+    return struct.unpack("<I", hashlib.md5(key).digest()[0:4])[0]
+
+def ketama_ring(hosts):
     """
-    Handles pool of Memcache objects, allowing get and put operations.
-    Connections are created on demand
+    Build consistent hashing continuum for the list of (addr, port) hosts.
+    Returns sorted list of (point, host)
     """
-    def __init__(self, hosts=[("127.0.0.1", 11211)], size=8):
+    ring = []
+    for host in hosts:
+        for i in xrange(0, ketama_points_per_host / 4):
+            digest = hashlib.md5("%s:%s-%d" % (host[0], host[1], i)).digest()
+            for point in struct.unpack("<IIII", digest):
+                ring.append((point, host))
+    ring.sort()
+    return ring
+
+class MemcachedNode(object):
+    """
+    Handles pool of Memcache objects connected to a single memcached server,
+    allowing get and put operations. Connections are created on demand
+    """
+    def __init__(self, host, size=8):
         """
+        host - (addr, port) of the memcached server
         size - max amount of active memcached connections (None if no limit)
         """
-        self.hosts = [(a, 100) for a in hosts]
-        self.hosts_version = 0
+        self.host = host
         self.connections = []
         self.size = size
         self.allocated = 0
         self.channel = None
-        self.last_debug = 0
-
-    def set_hosts(self, hosts):
-        self.hosts = hosts
-        self.hosts_version += 1
-        del self.connections[:]
-        self.allocated = 0
 
     def new_connection(self):
         "Create a new Memcached and connect it"
-        conn = Memcache(self.hosts)
-        conn._hosts_version = self.hosts_version
-        return conn
+        return Memcache([(self.host, 100)])
 
     def get(self):
         "Get a connection from the pool. If the pool is empty, current tasklet will be locked"
-#        now = time.time()
-#        if now > self.last_debug + 300:
-#            logging.getLogger("memcached").debug("idle %s, allocated %s/%s", len(self.connections), self.allocated, self.size)
-#            self.last_debug = now
         # The Pool contains at least one connection
         if len(self.connections) > 0:
             conn = self.connections.pop(0)
@@ -85,20 +96,65 @@ class MemcachedPool(object):
 
     def put(self, connection):
         "Return a connection to the pool"
-        # If memcached host changed
-        if connection._hosts_version != self.hosts_version:
-            self.put(self.new_connection())
+        # If somebody waits on the channel
+        if self.channel is not None and self.channel.balance < 0:
+            self.channel.send(connection)
         else:
-            # If somebody waits on the channel
-            if self.channel is not None and self.channel.balance < 0:
-                self.channel.send(connection)
-            else:
-                self.connections.append(connection)
+            self.connections.append(connection)
 
     def new(self):
         "Put a new connection to the pool"
         self.put(self.new_connection())
 
+class MemcachedPool(object):
+    """
+    Set of memcached servers. Keys are distributed among servers using
+    ketama consistent hashing, every server has its own pool of connections
+    """
+    def __init__(self, hosts=[("127.0.0.1", 11211)], size=8):
+        """
+        size - max amount of active memcached connections per server (None if no limit)
+        """
+        self.size = size
+        self.nodes = {}
+        self.set_hosts(hosts)
+
+    def set_hosts(self, hosts):
+        nodes = {}
+        for host in hosts:
+            host = tuple(host)
+            node = self.nodes.get(host)
+            if node is None:
+                node = MemcachedNode(host, self.size)
+            nodes[host] = node
+        self.hosts = [tuple(host) for host in hosts]
+        self.nodes = nodes
+        ring = ketama_ring(nodes.keys())
+        self.ring_points = [ent[0] for ent in ring]
+        self.ring_nodes = [nodes[ent[1]] for ent in ring]
+
+    def node(self, key):
+        "Returns MemcachedNode storing the given key"
+        if len(self.nodes) == 1:
+            return self.ring_nodes[0]
+        i = bisect.bisect(self.ring_points, ketama_hash(key))
+        if i >= len(self.ring_points):
+            i = 0
+        return self.ring_nodes[i]
+
+    def split(self, keys):
+        "Group keys by nodes. Returns list of (node, [key, key, ...])"
+        if len(self.nodes) == 1:
+            return [(self.ring_nodes[0], keys)]
+        groups = {}
+        for key in keys:
+            node = self.node(key)
+            try:
+                groups[node].append(key)
+            except KeyError:
+                groups[node] = [key]
+        return groups.items()
+
 class Memcached(object):
     """
     Memcached - interface to the memcached system
@@ -124,171 +180,229 @@ class Memcached(object):
         values = self.get_multi([key])
         return values.get(key, default)
 
+    def current_pipeline(self):
+        "Returns MemcachedPipeline opened by the current tasklet for this object (or None)"
+        try:
+            return Tasklet.current().memcached_pipelines.get(self)
+        except AttributeError:
+            return None
+
+    def pipeline(self):
+        "Create MemcachedPipeline collecting queued writes of the current tasklet"
+        return MemcachedPipeline(self)
+
     def get_multi(self, keys):
-        connection = self.pool.get()
+        pipeline = self.current_pipeline()
+        if pipeline is not None and pipeline.pending:
+            return pipeline.get_multi(keys)
+        query_keys = []
+        for key in keys:
+            qk = str(self.prefix + key)
+            if qk == "":
+                raise MemcachedEmptyKeyError()
+            query_keys.append(qk)
+        groups = self.pool.split(query_keys)
+        if len(groups) == 1:
+            return self._get_multi(*groups[0])
+        # Querying every node in a separate tasklet
+        res = {}
+        tasks = [Tasklet.new(self._get_multi)(node, node_keys) for node, node_keys in groups]
+        for node_res in Tasklet.join_all(tasks):
+            if isinstance(node_res, dict):
+                res.update(node_res)
+            else:
+                raise node_res
+        return res
+
+    def _get_multi(self, node, query_keys):
+        "Query prefixed keys from the single node"
+        connection = node.get()
         if not connection:
             return {}
         try:
-            query_keys = []
-            for key in keys:
-                qk = str(self.prefix + key)
-                if qk == "":
-                    raise MemcachedEmptyKeyError()
-                query_keys.append(qk)
             got = connection.get_multi(query_keys)
             res = {}
             for item in got[1].iteritems():
                 (key, data) = item
                 res[self.prefix_re.sub("", key)] = data
         except IOError:
-            self.pool.new()
+            node.new()
             return {}
         except EOFError:
-            self.pool.new()
+            node.new()
             return {}
         except Exception as e:
-            self.pool.new()
+            node.new()
             raise
-        self.pool.put(connection)
+        node.put(connection)
         return res
 
-    def set(self, key, data, expiration=0, flags=0):
+    def _command(self, key, method, *args):
+        "Perform single key command on the node storing the key"
         if key == "":
             raise MemcachedEmptyKeyError()
-        connection = self.pool.get()
+        qk = str(self.prefix + key)
+        node = self.pool.node(qk)
+        connection = node.get()
         if not connection:
             return MemcacheResult.ERROR
         try:
-            res = connection.set(str(self.prefix + key), data, expiration, flags)
+            res = getattr(connection, method)(qk, *args)
             if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
-                self.pool.new()
+                node.new()
                 return res
         except IOError:
-            self.pool.new()
+            node.new()
             return MemcacheResult.ERROR
         except EOFError:
-            self.pool.new()
+            node.new()
             return MemcacheResult.ERROR
         except Exception:
-            self.pool.new()
+            node.new()
             raise
-        self.pool.put(connection)
+        node.put(connection)
         return res
 
+    def set(self, key, data, expiration=0, flags=0):
+        self.evict_pending([key])
+        return self._command(key, "set", data, expiration, flags)
+
     def add(self, key, data, expiration=0, flags=0):
-        if key == "":
-            raise MemcachedEmptyKeyError()
-        connection = self.pool.get()
-        if not connection:
-            return MemcacheResult.ERROR
-        try:
-            res = connection.add(str(self.prefix + key), data, expiration, flags)
-            if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
-                self.pool.new()
-                return res
-        except IOError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except EOFError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except Exception:
-            self.pool.new()
-            raise
-        self.pool.put(connection)
-        return res
+        self.evict_pending([key])
+        return self._command(key, "add", data, expiration, flags)
 
     def replace(self, key, data, expiration=0, flags=0):
-        if key == "":
-            raise MemcachedEmptyKeyError()
-        connection = self.pool.get()
-        if not connection:
-            return MemcacheResult.ERROR
-        try:
-            res = connection.replace(str(self.prefix + key), data, expiration, flags)
-            if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
-                self.pool.new()
-                return res
-        except IOError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except EOFError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except Exception:
-            self.pool.new()
-            raise
-        self.pool.put(connection)
-        return res
+        self.evict_pending([key])
+        return self._command(key, "replace", data, expiration, flags)
 
     def incr(self, key, increment=1):
-        if key == "":
-            raise MemcachedEmptyKeyError()
-        connection = self.pool.get()
-        if not connection:
-            return MemcacheResult.ERROR
-        try:
-            res = connection.incr(str(self.prefix + key), increment)
-            if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
-                self.pool.new()
-                return res
-        except IOError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except EOFError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except Exception:
-            self.pool.new()
-            raise
-        self.pool.put(connection)
-        return res
+        self.evict_pending([key])
+        return self._command(key, "incr", increment)
 
     def decr(self, key, decrement=1):
-        if key == "":
-            raise MemcachedEmptyKeyError()
-        connection = self.pool.get()
-        if not connection:
-            return MemcacheResult.ERROR
-        try:
-            res = connection.decr(str(self.prefix + key), decrement)
-            if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
-                self.pool.new()
-                return res
-        except IOError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except EOFError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except Exception:
-            self.pool.new()
-            raise
-        self.pool.put(connection)
-        return res
+        self.evict_pending([key])
+        return self._command(key, "decr", decrement)
 
     def delete(self, key, expiration=0):
-        if key == "":
-            raise MemcachedEmptyKeyError()
-        connection = self.pool.get()
-        if not connection:
-            return MemcacheResult.ERROR
-        try:
-            res = connection.delete(str(self.prefix + key), expiration)
+        self.evict_pending([key])
+        return self._command(key, "delete", expiration)
+
+    def evict_pending(self, keys):
+        """
+        Drop queued writes of the current tasklet for the keys written immediately.
+        Otherwise reads would return the queued value and the flush would overwrite
+        the immediate write
+        """
+        pipeline = self.current_pipeline()
+        if pipeline is not None and pipeline.pending:
+            for key in keys:
+                pipeline.pending.pop(key, None)
+
+    def _command_multi(self, method, keys, values=None, *args):
+        """
+        Perform command for several keys. Keys are grouped by nodes, every node
+        is queried using a single connection, several nodes are queried in
+        parallel tasklets.
+        values - dict key => value (None if command has no value argument)
+        Returns dict key => result
+        """
+        qkeys = {}
+        for key in keys:
+            if key == "":
+                raise MemcachedEmptyKeyError()
+            qkeys[str(self.prefix + key)] = key
+        groups = self.pool.split(qkeys.keys())
+        def run(node, node_keys):
+            results = {}
+            connection = node.get()
+            if not connection:
+                for qk in node_keys:
+                    results[qkeys[qk]] = MemcacheResult.ERROR
+                return results
+            try:
+                command = getattr(connection, method)
+                for qk in node_keys:
+                    key = qkeys[qk]
+                    if values is None:
+                        res = command(qk, *args)
+                    else:
+                        res = command(qk, values[key], *args)
+                    results[key] = res
+                    if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
+                        node.new()
+                        return results
+            except IOError:
+                node.new()
+                return results
+            except EOFError:
+                node.new()
+                return results
+            except Exception:
+                node.new()
+                raise
+            node.put(connection)
+            return results
+        if len(groups) == 1:
+            return run(*groups[0])
+        results = {}
+        for node_results in Tasklet.join_all([Tasklet.new(run)(node, node_keys) for node, node_keys in groups]):
+            if isinstance(node_results, dict):
+                results.update(node_results)
+            else:
+                raise node_results
+        return results
+
+    def _multi_status(self, keys, results):
+        "Summarize results of _command_multi: OK or the first error"
+        for key in keys:
+            res = results.get(key, MemcacheResult.ERROR)
             if res == MemcacheResult.ERROR or res == MemcacheResult.TIMEOUT:
-                self.pool.new()
                 return res
-        except IOError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except EOFError:
-            self.pool.new()
-            return MemcacheResult.ERROR
-        except Exception:
-            self.pool.new()
-            raise
-        self.pool.put(connection)
-        return res
+        return MemcacheResult.OK
+
+    def set_multi(self, mapping, expiration=0, flags=0):
+        "Store several keys using a single pooled connection per server"
+        self.evict_pending(mapping)
+        return self._multi_status(mapping, self._command_multi("set", mapping.keys(), mapping, expiration, flags))
+
+    def add_multi(self, mapping, expiration=0, flags=0):
+        "Add several keys using a single pooled connection per server"
+        self.evict_pending(mapping)
+        return self._multi_status(mapping, self._command_multi("add", mapping.keys(), mapping, expiration, flags))
+
+    def delete_multi(self, keys):
+        "Delete several keys using a single pooled connection per server"
+        self.evict_pending(keys)
+        return self._multi_status(keys, self._command_multi("delete", keys, None, 0))
+
+    def incr_multi(self, keys, increment=1):
+        """
+        Increment several keys using a single pooled connection per server.
+        Returns dict key => incr() result
+        """
+        self.evict_pending(keys)
+        return self._command_multi("incr", keys, None, increment)
+
+    def queue_set(self, key, data, expiration=0, flags=0):
+        "The same as set(), but postponed until flush if a pipeline is open"
+        pipeline = self.current_pipeline()
+        if pipeline is None:
+            return self.set(key, data, expiration, flags)
+        pipeline.set(key, data, expiration, flags)
+
+    def queue_add(self, key, data, expiration=0, flags=0):
+        "The same as add(), but postponed until flush if a pipeline is open"
+        pipeline = self.current_pipeline()
+        if pipeline is None:
+            return self.add(key, data, expiration, flags)
+        pipeline.add(key, data, expiration, flags)
+
+    def queue_delete(self, key):
+        "The same as delete(), but postponed until flush if a pipeline is open"
+        pipeline = self.current_pipeline()
+        if pipeline is None:
+            return self.delete(key)
+        pipeline.delete(key)
 
     def get_ver(self, group):
         if group == "":
@@ -307,12 +421,134 @@ class Memcached(object):
             ver = random.randrange(0, 1000000000)
             self.set("GRP-%s" % group, ver)
 
+    def incr_ver_multi(self, groups):
+        """
+        Invalidate several version groups at once. Every group gets a new random
+        version, so no read is needed and concurrent invalidations can't collapse
+        into the same value
+        """
+        mapping = {}
+        for group in groups:
+            if group == "":
+                raise MemcachedEmptyKeyError()
+            mapping["GRP-%s" % group] = random.randrange(0, 1000000000)
+        if mapping:
+            self.set_multi(mapping)
+
     def ver(self, groups):
         key = '/ver'
         for g in groups:
             key += '/%s' % self.get_ver(g)
         return key
 
+class MemcachedPipeline(object):
+    """
+    Pipelined write mode. While the pipeline is open queue_set(), queue_add()
+    and queue_delete() called by the current tasklet are collected and sent
+    in batches when the pipeline is closed. Reads made by the same tasklet see
+    queued values. Other writes (set, add, delete, incr) are performed
+    immediately and drop the queued write of the same key, so MemcachedLock is
+    not affected. Queue only writes that may
+    be safely delayed (cache fills): other processes don't see them until flush
+
+    with mc.pipeline():
+        ...
+    """
+    def __init__(self, mc):
+        self.mc = mc
+        self.pending = {}
+        self.depth = 0
+
+    def __enter__(self):
+        tasklet = Tasklet.current()
+        try:
+            pipelines = tasklet.memcached_pipelines
+        except AttributeError:
+            pipelines = {}
+            tasklet.memcached_pipelines = pipelines
+        outer = pipelines.get(self.mc)
+        if outer is not None and outer is not self:
+            # Nested pipelines are merged into the outermost one
+            outer.depth += 1
+            self.outer = outer
+            return outer
+        self.outer = None
+        self.depth += 1
+        pipelines[self.mc] = self
+        return self
+
+    def __exit__(self, type, value, tb):
+        if self.outer is not None:
+            self.outer.depth -= 1
+            return
+        self.depth -= 1
+        if self.depth > 0:
+            return
+        del Tasklet.current().memcached_pipelines[self.mc]
+        self.flush()
+
+    def set(self, key, data, expiration=0, flags=0):
+        if key == "":
+            raise MemcachedEmptyKeyError()
+        # callers keep modifying their objects after queueing
+        self.pending[key] = ("set", copy.deepcopy(data), expiration, flags)
+
+    def add(self, key, data, expiration=0, flags=0):
+        if key == "":
+            raise MemcachedEmptyKeyError()
+        if key not in self.pending:
+            self.pending[key] = ("add", copy.deepcopy(data), expiration, flags)
+
+    def delete(self, key):
+        if key == "":
+            raise MemcachedEmptyKeyError()
+        self.pending[key] = ("delete",)
+
+    def get_multi(self, keys):
+        "Read keys taking queued writes into account"
+        res = {}
+        query_keys = []
+        for key in keys:
+            op = self.pending.get(key)
+            if op is None:
+                query_keys.append(key)
+            elif op[0] != "delete":
+                res[key] = copy.deepcopy(op[1])
+        if query_keys:
+            pending = self.pending
+            self.pending = {}
+            try:
+                res.update(self.mc.get_multi(query_keys))
+            finally:
+                self.pending = pending
+        return res
+
+    def flush(self):
+        "Send all queued writes to memcached"
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        sets = {}
+        adds = {}
+        deletes = []
+        for key, op in pending.iteritems():
+            if op[0] == "delete":
+                deletes.append(key)
+            else:
+                group = sets if op[0] == "set" else adds
+                mapping = group.get((op[2], op[3]))
+                if mapping is None:
+                    mapping = {}
+                    group[(op[2], op[3])] = mapping
+                mapping[key] = op[1]
+        for (expiration, flags), mapping in sets.iteritems():
+            self.mc.set_multi(mapping, expiration, flags)
+        for (expiration, flags), mapping in adds.iteritems():
+            self.mc.add_multi(mapping, expiration, flags)
+        if deletes:
+            self.mc.delete_multi(deletes)
+
 lock_serial = [0]
 
 class MemcachedLock(object):
@@ -16,7 +16,17 @@
 # along with Metagam.  If not, see <http://www.gnu.org/licenses/>.
 
 from mg import *
+from uuid import uuid4
 import re
+import time
+import heapq
+
+# expirations are loaded into memory this many seconds ahead
+modifiers_window = 60
+# the loaded expirations are refreshed from the database this often
+modifiers_refresh = 10
+# targets per delete statement
+modifiers_batch = 100
 
 re_valid_identifier = re.compile(r'^[a-z_][a-z0-9_]*$', re.IGNORECASE)
 re_aggr = re.compile(r'^(max|min|sum|cnt)_(.+)$')
@@ -82,9 +92,16 @@ class MemberModifiers(Module):
                 pass
         # storing mobjs
         if self.mobjs:
+            window = self.now(modifiers_window)
+            due = False
             for mobj in self.mobjs:
                 self.sql_write.do("insert into modifiers(till, cls, app, target_type, target, priority) values (?, ?, ?, ?, ?, ?)", *mobj)
+                if mobj[0] < window:
+                    due = True
             self.mobjs = []
+            # the checker has to see this expiration before its next periodic reload
+            if due:
+                self.app().inst.int_app.mc.incr_ver("ModifiersTimers")
 
     def notify(self):
         if self.in_notify:
@@ -321,29 +338,81 @@ class MemberModifiers(Module):
     __repr__ = __str__
 
 class ModifiersChecker(Module):
+    """
+    Expirations due within modifiers_window seconds are kept in a heap ordered by 'till'.
+    The heap is reloaded every modifiers_refresh seconds, when another instance has taken
+    over the checker or when a modifier due within the window has been inserted
+    (MemberModifiers.store() bumps the ModifiersTimers version)
+    """
     def register(self):
         self.rhook("core.fastidle", self.fastidle)
         self.tasklet_running = False
+        self.timers = None
 
     def modifiers_checker_runner(self):
         try:
-            inst = self.app().inst
-            cls = inst.cls
             lock = self.lock(["modifiers"])
             if not lock.trylock():
+                self.timers = None
                 return
             try:
-                now = self.now()
-                for mod in self.sql_write.selectall_dict("select target_type, target, app, priority from modifiers where cls=? and till<=? group by target_type, target, app", cls, now):
-                    self.call("queue.add", "modifiers.stop", {"target_type": mod["target_type"], "target": mod["target"]}, app_tag=mod["app"], app_cls=cls, unique="mod-%s-%s" % (mod["app"], mod["target"]), priority=mod["priority"])
-                    self.sql_write.do("delete from modifiers where app=? and target=? and till<=?", mod["app"], mod["target"], now)
+                state = self.app().mc.get_multi(["ModifiersTimers", "GRP-ModifiersTimers"])
+                ver = state.get("GRP-ModifiersTimers")
+                if self.timers is None or time.time() >= self.timers_refresh or state.get("ModifiersTimers") != self.timers_owner or ver != self.timers_ver:
+                    # the version is read before the select, so inserts made during the load aren't missed
+                    self.modifiers_load(ver)
+                self.modifiers_expire()
             finally:
                 lock.unlock()
         except Exception as e:
+            self.timers = None
             self.exception(e)
         finally:
             self.tasklet_running = False
 
+    def modifiers_load(self, ver):
+        "Load expirations of the next modifiers_window seconds. ver is the ModifiersTimers version read before loading"
+        cls = self.app().inst.cls
+        timers = [(str(mod["till"]), mod["app"], mod["target_type"], mod["target"], mod["priority"]) for mod in self.sql_write.selectall_dict("select till, target_type, target, app, priority from modifiers where cls=? and till<=?", cls, self.now(modifiers_window))]
+        heapq.heapify(timers)
+        self.timers = timers
+        self.timers_refresh = time.time() + modifiers_refresh
+        self.timers_owner = uuid4().hex
+        self.timers_ver = ver
+        self.app().mc.set("ModifiersTimers", self.timers_owner)
+
+    def modifiers_expire(self):
+        "Stop expired modifiers. Queue tasks are created and database rows are deleted in batches"
+        timers = self.timers
+        now = self.now()
+        targets = {}
+        while timers and timers[0][0] <= now:
+            till, app_tag, target_type, target, priority = heapq.heappop(timers)
+            key = (app_tag, target)
+            ent = targets.get(key)
+            if ent is None:
+                targets[key] = (target_type, priority)
+            elif priority > ent[1]:
+                targets[key] = (target_type, priority)
+        if not targets:
+            return
+        cls = self.app().inst.cls
+        self.call("queue.add-multi", [{
+            "hook": "modifiers.stop",
+            "args": {"target_type": target_type, "target": target},
+            "app_tag": app_tag,
+            "app_cls": cls,
+            "unique": "mod-%s-%s" % (app_tag, target),
+            "priority": priority,
+        } for (app_tag, target), (target_type, priority) in targets.iteritems()])
+        keys = targets.keys()
+        for i in xrange(0, len(keys), modifiers_batch):
+            chunk = keys[i:i + modifiers_batch]
+            args = [now]
+            for key in chunk:
+                args.extend(key)
+            self.sql_write.do("delete from modifiers where till<=? and (app, target) in (%s)" % ", ".join(["(?, ?)"] * len(chunk)), *args)
+
     def fastidle(self):
         if not self.tasklet_running:
             self.tasklet_running = True
@@ -97,42 +97,40 @@ class MoneyAdmin(Module):
     def stats(self):
         today = self.nowdate()
         yesterday = prev_date(today)
-        lst = self.objlist(AccountOperationList, query_index="performed", query_start=yesterday, query_finish=today)
-        lst.load(silent=True)
         total = {}
         descriptions = {}
-        for ent in lst:
-            currency = ent.get("currency")
-            amount = ent.get("amount")
-            # total amount
-            try:
-                total[currency] += amount
-            except KeyError:
-                total[currency] = amount
-            # descriptions
-            description = ent.get("description")
-            try:
-                hsh = descriptions[description]
-            except KeyError:
-                hsh = {}
-                descriptions[description] = hsh
-            try:
-                hsh[currency] += amount
-            except KeyError:
-                hsh[currency] = amount
-        kwargs = {}
-        # this condition may be modified if we need to make remains recalculation more rare
-        if True:
-            remains = {}
-            lst = self.objlist(AccountList, query_index="all")
-            lst.load(silent=True)
+        for lst in self.objlist_pages(AccountOperationList, query_index="performed", query_start=yesterday, query_finish=today, silent=True):
             for ent in lst:
                 currency = ent.get("currency")
-                balance = ent.get("balance")
+                amount = ent.get("amount")
+                # total amount
+                try:
+                    total[currency] += amount
+                except KeyError:
+                    total[currency] = amount
+                # descriptions
+                description = ent.get("description")
+                try:
+                    hsh = descriptions[description]
+                except KeyError:
+                    hsh = {}
+                    descriptions[description] = hsh
                 try:
-                    remains[currency] += balance
+                    hsh[currency] += amount
                 except KeyError:
-                    remains[currency] = balance
+                    hsh[currency] = amount
+        kwargs = {}
+        # this condition may be modified if we need to make remains recalculation more rare
+        if True:
+            remains = {}
+            for lst in self.objlist_pages(AccountList, query_index="all", silent=True):
+                for ent in lst:
+                    currency = ent.get("currency")
+                    balance = ent.get("balance")
+                    try:
+                        remains[currency] += balance
+                    except KeyError:
+                        remains[currency] = balance
             kwargs["remains"] = remains
         self.call("dbexport.add", "money_stats", total=total, descriptions=descriptions, date=yesterday, **kwargs)
 
@@ -16,6 +16,8 @@
 # along with Metagam.  If not, see <http://www.gnu.org/licenses/>.
 
 import mg
+import mg.core.web
+from mg.core.tools import htmlescape
 
 class ClusterMonitor(mg.Module):
     def register(self):
@@ -34,6 +36,8 @@ class ClusterMonitor(mg.Module):
         dbhost = {}
         webservices = {}
         intservices = []
+        # template name => [renders, seconds]
+        templates = {}
         for dmnid, dmninfo in daemons.iteritems():
             if dmninfo.get("cls") != self.inst.cls:
                 continue
@@ -45,6 +49,14 @@ class ClusterMonitor(mg.Module):
                     srvhost[hostid] = True
                 if svcinfo.get("type") == "cassandra" or svcinfo.get("type") == "mysql":
                     dbhost[hostid] = True
+                for name, renders, elapsed in svcinfo.get("svc-templates", []):
+                    try:
+                        ent = templates[name]
+                    except KeyError:
+                        templates[name] = [renders, elapsed]
+                    else:
+                        ent[0] += renders
+                        ent[1] += elapsed
                 # service info
                 webbackend = svcinfo.get("webbackend")
                 if webbackend:
@@ -96,6 +108,13 @@ class ClusterMonitor(mg.Module):
         vars["databases"] = databases
         vars["webservices"] = webservices
         vars["intservices"] = intservices
+        templates = sorted(templates.iteritems(), key=lambda ent: -ent[1][1])[0:mg.core.web.template_stats_top]
+        vars["templates"] = [{
+            "name": htmlescape(name),
+            "renders": ent[0],
+            "total": "%.3f" % ent[1],
+            "avg": "%.2f" % (ent[1] * 1000.0 / ent[0]) if ent[0] else "",
+        } for name, ent in templates]
         self.call("socio.setup-interface", vars)
         vars["content"] = self.call("web.parse_layout", "monitoring/dashboard.html", vars)
         self.call("web.response", self.call("web.parse_layout", "constructor/socio_global.html", vars))
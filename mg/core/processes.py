@@ -24,6 +24,7 @@ from mg.core.mysql import MySQLPool
 from mg.core.memcached import MemcachedPool
 from mg.core.config import DBConfigGroup
 from mg.core.applications import Application, ApplicationFactory
+from mg.core import Parsing
 from concurrence import Tasklet
 from concurrence import dispatch as concurrence_dispatch
 from concurrence.extra import Lock
@@ -33,10 +34,15 @@ import logging
 import logging.handlers
 import re
 import os
+import sys
+import hashlib
+import cPickle
+import stat
 
 re_comma = re.compile('\s*,\s*')
 
 CONFIG_FILE = "/etc/metagam/metagam.conf"
+PARSER_CACHE_DIR = "/var/lib/metagam/parsers"
 
 class Formatter(logging.Formatter):
     def format(self, record):
@@ -174,6 +180,7 @@ class Instance(Loggable):
         if not self._instaddr:
             raise RuntimeError("Config key global.addr not found")
         self._instid = "%s-%s" % (self.insttype, self.conf("global", "id", self.instaddr))
+        self.hooks_profiling = self.confint("global", "hooks_profiling", 0)
 
     def conf(self, section, option, default=None):
         try:
@@ -289,6 +296,80 @@ class Instance(Loggable):
         if hasattr(self, "_mcpool"):
             delattr(self, "_mcpool")
 
+    def parser_spec(self, modname, **kwargs):
+        """
+        Returns Parsing.Spec for the grammar module. Generated LR tables are
+        pickled to global.parser_cache_dir (PARSER_CACHE_DIR by default) under
+        the name containing hash of the grammar source, so other processes
+        load them instead of generating
+        """
+        try:
+            specs = self._parser_specs
+        except AttributeError:
+            specs = {}
+            self._parser_specs = specs
+        try:
+            return specs[modname]
+        except KeyError:
+            pass
+        module = sys.modules[modname]
+        filename = None
+        try:
+            source = module.__file__
+            if source.endswith(".pyc") or source.endswith(".pyo"):
+                source = source[:-1]
+            f = open(source)
+            try:
+                digest = hashlib.md5(f.read()).hexdigest()
+            finally:
+                f.close()
+            # pickles execute code on loading. Foreign or shared writable files must not be trusted
+            cache_dir = self.private_dir("parser_cache_dir", PARSER_CACHE_DIR)
+            filename = "%s/%s-%s-%s.pickle" % (cache_dir, modname, digest, "skinny" if kwargs.get("skinny", True) else "fat")
+        except (AttributeError, IOError, OSError) as e:
+            self.warning("Parser cache disabled for %s: %s", modname, e)
+            filename = None
+        if filename and os.path.exists(filename) and not self.path_trusted(filename):
+            self.warning("Ignoring untrusted parser tables %s", filename)
+            filename = None
+        if filename and os.path.exists(filename):
+            spec = Parsing.Spec(module, pickleFile=filename, pickleMode="r", **kwargs)
+        else:
+            spec = Parsing.Spec(module, **kwargs)
+            if filename:
+                tmpname = "%s.%d" % (filename, os.getpid())
+                try:
+                    f = open(tmpname, "w")
+                    try:
+                        cPickle.dump(spec, f, protocol=cPickle.HIGHEST_PROTOCOL)
+                    finally:
+                        f.close()
+                    os.rename(tmpname, filename)
+                except (IOError, OSError) as e:
+                    self.warning("Error storing parser tables to %s: %s", filename, e)
+        specs[modname] = spec
+        return spec
+
+    def private_dir(self, option, default):
+        """
+        Returns local directory configured in global.<option> for the files of this
+        daemon. It is created with mode 0700. IOError is raised if the directory is
+        owned by somebody else or writable by others
+        """
+        path = self.conf("global", option, default)
+        if not os.path.exists(path):
+            os.makedirs(path, 0700)
+        if not self.path_trusted(path):
+            raise IOError("%s must be owned by uid %d and not writable by others" % (path, os.getuid()))
+        return path
+
+    def path_trusted(self, path):
+        "Check that the path is not a symlink, is owned by the current user and not writable by others"
+        st = os.lstat(path)
+        if stat.S_ISLNK(st.st_mode):
+            return False
+        return st.st_uid == os.getuid() and not (st.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
     @property
     def sql_read(self):
         try:
@@ -18,7 +18,7 @@
 from mg.core.applications import Module
 from mg.core.cass import CassandraObject, CassandraObjectList, ObjectNotFoundException
 from mg.core.tools import *
-from concurrence import Tasklet
+from concurrence import Tasklet, Channel, TimeoutError
 from concurrence.http import HTTPConnection, HTTPError, HTTPRequest
 from stackless import channel
 from urllib import urlencode
@@ -31,6 +31,15 @@ import weakref
 import datetime
 import calendar
 
+# tasks executed concurrently by a single instance
+queue_workers = 8
+# tasks of a single application executed concurrently
+queue_app_workers = 2
+# how often to look for new tasks while some tasks are running
+queue_poll_interval = 1
+# rows per statement in queue.add-multi
+queue_insert_batch = 100
+
 class Schedule(CassandraObject):
     clsname = "Schedule"
     indexes = {
@@ -66,6 +75,7 @@ class ScheduleList(CassandraObjectList):
 class Queue(Module):
     def register(self):
         self.rhook("queue.add", self.queue_add)
+        self.rhook("queue.add-multi", self.queue_add_multi)
         self.rhook("queue.schedule", self.queue_schedule)
         self.rhook("objclasses.list", self.objclasses_list)
         self.rhook("app.check", self.check)
@@ -104,6 +114,48 @@ class Queue(Module):
         else:
             insert()
 
+    def queue_add_multi(self, tasks):
+        """
+        Add several events to queue at once. tasks - list of dicts with keys
+        hook, args, at, priority, unique, app_tag, app_cls having the same meaning as queue.add parameters.
+        Unlike queue.add 'at' must be either None or a datetime (not cron time)
+        """
+        int_app = self.app().inst.int_app
+        rows = []
+        uniques = []
+        for task in tasks:
+            app_tag = task.get("app_tag")
+            if app_tag is None:
+                app_tag = self.app().tag
+            app_cls = task.get("app_cls")
+            if app_cls is None:
+                app_cls = self.app().inst.cls
+            at = task.get("at")
+            if at is None:
+                at = self.now()
+            unique = task.get("unique")
+            if unique is not None:
+                uniques.append((app_tag, unique))
+            rows.append((uuid4().hex, app_cls, app_tag, at, int(task.get("priority", 100)), unique, task["hook"], json.dumps(task.get("args", {}))))
+        def insert():
+            for i in xrange(0, len(rows), queue_insert_batch):
+                chunk = rows[i:i + queue_insert_batch]
+                args = []
+                for row in chunk:
+                    args.extend(row)
+                int_app.sql_write.do("insert into queue_tasks(id, cls, app, at, priority, `unique`, hook, data) values %s" % ", ".join(["(?, ?, ?, ?, ?, ?, ?, ?)"] * len(chunk)), *args)
+        if uniques:
+            with int_app.lock(["queue"], reason="insert-unique-queue-task"):
+                for i in xrange(0, len(uniques), queue_insert_batch):
+                    chunk = uniques[i:i + queue_insert_batch]
+                    args = []
+                    for ent in chunk:
+                        args.extend(ent)
+                    int_app.sql_write.do("delete from queue_tasks where (app, `unique`) in (%s)" % ", ".join(["(?, ?)"] * len(chunk)), *args)
+                insert()
+        else:
+            insert()
+
     def queue_schedule(self, empty=False):
         "Return application schedule object"
         int_app = self.app().inst.int_app
@@ -172,66 +224,173 @@ class QueueRunner(Module):
                 self.sql_write.do("update queue_tasks set locked='', locked_till=null, priority=priority-1 where cls=? and locked=?", cls, instid)
                 # Free tasks locked too long
                 self.sql_write.do("update queue_tasks set locked='', locked_till=null, priority=priority-1 where cls=? and locked_till<?", cls, self.now())
+                # task id => app tag
+                self.queue_running = {}
+                # claimed tasks waiting for a free slot of their application
+                self.queue_pending = []
+                # tasks failed outside of the handler. They stay locked until the runner restarts
+                self.queue_abandoned = set()
+                self.queue_wakeup_channel = Channel()
                 while True:
-                    lock = self.lock(["queue"], reason="execute-queue")
-                    if not lock.trylock():
-                        return
-                    try:
-                        # Find task to run
-                        tasks = self.sql_write.selectall_dict("select * from queue_tasks where cls=? and locked='' and at<=? order by priority desc limit 1", cls, self.now())
-                        if not tasks:
-                            return
-                        task = tasks[0]
-                        self.sql_write.do("update queue_tasks set locked=?, locked_till=? where id=?", instid, self.now(86400), task["id"])
-                        ctl = self.sql_write.selectall_dict("select * from queue_tasks where id=?", task["id"])
-                    finally:
-                        lock.unlock()
-                    # Execute task
-                    app_tag = str(task["app"])
-                    hook = str(task["hook"])
-                    args = json.loads(task["data"])
-                    self.debug("Executing %s.%s", app_tag, hook)
-                    app = self.app().inst.appfactory.get_by_tag(app_tag)
-                    if app is None:
-                        self.info("Found queue event for unknown application %s", app_tag)
-                        main_app = self.main_app()
-                        if main_app.call("project.missing", app_tag):
-                            self.info("Removing missing project %s", app_tag)
-                            main_app.call("project.cleanup", app_tag)
-                    else:
-                        schedule = args.get("schedule")
-                        at = args.get("at")
-                        if schedule:
-                            del args["schedule"]
-                            if at:
-                                del args["at"]
+                    free = queue_workers - len(self.queue_running) - len(self.queue_pending)
+                    if free > 0:
                         try:
-                            app.call(hook, **args)
-                            success = True
+                            self.queue_pending.extend(self.queue_claim(free))
                         except Exception as e:
+                            # running tasks must finish before the runner exits
                             self.exception(e)
-                            success = False
-                        if success:
-                            self.info("Finished task %s (%s in application %s)", task["id"], task["hook"], task["app"])
-                            # Reschedule finished task to later time
-                            if schedule:
-                                try:
-                                    sched = self.obj(Schedule, app_tag)
-                                    entries = sched.get("entries")
-                                except ObjectNotFoundException:
-                                    entries = {}
-                                params = entries.get(hook)
-                                if params is not None:
-                                    self.call("queue.schedule_task", task.get("cls"), app_tag, hook, params)
-                            self.sql_write.do("delete from queue_tasks where id=?", task["id"])
-                        else:
-                            self.error("Failed task %s (%s in application %s)", task["id"], task["hook"], task["app"])
-                            self.sql_write.do("update queue_tasks set locked='', locked_till=null, priority=priority-10, at=? where id=? and locked=?", self.now(5), task["id"], instid)
+                    self.queue_dispatch()
+                    if not self.queue_running:
+                        return
+                    try:
+                        self.queue_wakeup_channel.receive(queue_poll_interval)
+                    except TimeoutError:
+                        pass
             except Exception as e:
                 self.exception(e)
         finally:
             self.queue_task_running = False
 
+    def queue_claim(self, limit):
+        """
+        Lock up to 'limit' due tasks for this instance and return them. Every application
+        gets at most queue_app_workers running and pending tasks: surplus tasks of a busy
+        application are released and their slots are offered to other applications
+        """
+        per_app = self.queue_app_counters()
+        known = set(self.queue_running.keys())
+        known.update(self.queue_abandoned)
+        for task in self.queue_pending:
+            known.add(task["id"])
+        claimed = []
+        while limit > 0:
+            saturated = [app_tag for app_tag, cnt in per_app.iteritems() if cnt >= queue_app_workers]
+            if not self.queue_lock_tasks(limit, saturated):
+                break
+            surplus = []
+            for task in self.queue_locked_tasks():
+                if task["id"] in known:
+                    continue
+                app_tag = task["app"]
+                cnt = per_app.get(app_tag, 0)
+                if cnt < queue_app_workers and limit > 0:
+                    per_app[app_tag] = cnt + 1
+                    known.add(task["id"])
+                    claimed.append(task)
+                    limit -= 1
+                else:
+                    surplus.append(task["id"])
+            if not surplus:
+                break
+            # applications of the released tasks are saturated now and skipped on the next pass
+            self.queue_release(surplus)
+        return claimed
+
+    def queue_lock_tasks(self, limit, skip_apps):
+        "Lock up to 'limit' due tasks of applications not listed in skip_apps. Returns number of locked tasks"
+        inst = self.app().inst
+        args = [inst.instid, self.now(86400), inst.cls, self.now()]
+        if skip_apps:
+            cond = " and app not in (%s)" % ", ".join(["?"] * len(skip_apps))
+            args.extend(skip_apps)
+        else:
+            cond = ""
+        args.append(limit)
+        return self.sql_write.do("update queue_tasks set locked=?, locked_till=? where cls=? and locked='' and at<=?%s order by priority desc limit ?" % cond, *args)
+
+    def queue_locked_tasks(self):
+        "All tasks locked by this instance in the priority order"
+        inst = self.app().inst
+        return self.sql_write.selectall_dict("select * from queue_tasks where cls=? and locked=? order by priority desc", inst.cls, inst.instid)
+
+    def queue_release(self, task_ids):
+        "Unlock claimed tasks without running them"
+        args = list(task_ids)
+        args.append(self.app().inst.instid)
+        self.sql_write.do("update queue_tasks set locked='', locked_till=null where id in (%s) and locked=?" % ", ".join(["?"] * len(task_ids)), *args)
+
+    def queue_app_counters(self):
+        "Number of running and pending tasks of every application"
+        per_app = {}
+        for app_tag in self.queue_running.itervalues():
+            per_app[app_tag] = per_app.get(app_tag, 0) + 1
+        for task in self.queue_pending:
+            app_tag = task["app"]
+            per_app[app_tag] = per_app.get(app_tag, 0) + 1
+        return per_app
+
+    def queue_dispatch(self):
+        "Start pending tasks keeping at most queue_app_workers tasks of every application running"
+        per_app = {}
+        for app_tag in self.queue_running.itervalues():
+            per_app[app_tag] = per_app.get(app_tag, 0) + 1
+        pending = []
+        for task in self.queue_pending:
+            app_tag = task["app"]
+            cnt = per_app.get(app_tag, 0)
+            if cnt < queue_app_workers:
+                per_app[app_tag] = cnt + 1
+                self.queue_running[task["id"]] = app_tag
+                Tasklet.new(self.queue_task_worker)(task)
+            else:
+                pending.append(task)
+        self.queue_pending = pending
+
+    def queue_task_worker(self, task):
+        try:
+            self.queue_task_execute(task)
+        except Exception as e:
+            self.exception(e)
+            # the task may be still locked by this instance. It must not be claimed again
+            self.queue_abandoned.add(task["id"])
+        finally:
+            del self.queue_running[task["id"]]
+            if self.queue_wakeup_channel.has_receiver():
+                self.queue_wakeup_channel.send(None)
+
+    def queue_task_execute(self, task):
+        instid = self.app().inst.instid
+        app_tag = str(task["app"])
+        hook = str(task["hook"])
+        args = json.loads(task["data"])
+        self.debug("Executing %s.%s", app_tag, hook)
+        app = self.app().inst.appfactory.get_by_tag(app_tag)
+        if app is None:
+            self.info("Found queue event for unknown application %s", app_tag)
+            main_app = self.main_app()
+            if main_app.call("project.missing", app_tag):
+                self.info("Removing missing project %s", app_tag)
+                main_app.call("project.cleanup", app_tag)
+        else:
+            schedule = args.get("schedule")
+            at = args.get("at")
+            if schedule:
+                del args["schedule"]
+                if at:
+                    del args["at"]
+            try:
+                app.call(hook, **args)
+                success = True
+            except Exception as e:
+                self.exception(e)
+                success = False
+            if success:
+                self.info("Finished task %s (%s in application %s)", task["id"], task["hook"], task["app"])
+                # Reschedule finished task to later time
+                if schedule:
+                    try:
+                        sched = self.obj(Schedule, app_tag)
+                        entries = sched.get("entries")
+                    except ObjectNotFoundException:
+                        entries = {}
+                    params = entries.get(hook)
+                    if params is not None:
+                        self.call("queue.schedule_task", task.get("cls"), app_tag, hook, params)
+                self.sql_write.do("delete from queue_tasks where id=?", task["id"])
+            else:
+                self.error("Failed task %s (%s in application %s)", task["id"], task["hook"], task["app"])
+                self.sql_write.do("update queue_tasks set locked='', locked_till=null, priority=priority-10, at=? where id=? and locked=?", self.now(5), task["id"], instid)
+
     def fastidle(self):
         if not self.queue_task_running:
             self.queue_task_running = True
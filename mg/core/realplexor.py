@@ -26,6 +26,7 @@ import socket
 import os
 
 max_frame_length = 50000
+max_parallel_sends = 8
 
 re_valid_id = re.compile('^\w+$')
 re_split_headers = re.compile('\r?\n\r?\n')
@@ -80,6 +81,42 @@ class RealplexorConcurrence(object):
             client IDs in show_only_for_ids to inhibit sending messages to others.
         """
         data = json.dumps(data, skipkeys=True)
+        pairs = self._pairs(ids)
+        if show_only_for_ids:
+            for id in show_only_for_ids:
+                pairs.append("*%s%s" % (self.namespace, id))
+        self._send(",".join(pairs), data)
+
+    def send_multi(self, messages):
+        """
+        Send many messages to realplexor at once
+        messages - list of (ids, data) where ids is a str or a list of channel names.
+            Channels receiving equal data are merged into a single request.
+            Distinct requests are sent in parallel
+        """
+        requests = {}
+        order = []
+        for ids, data in messages:
+            data = json.dumps(data, skipkeys=True)
+            try:
+                pairs = requests[data]
+            except KeyError:
+                pairs = []
+                requests[data] = pairs
+                order.append(data)
+            pairs.extend(self._pairs(ids))
+        requests = [(",".join(requests[data]), data) for data in order]
+        if len(requests) == 1:
+            self._send(*requests[0])
+            return
+        for i in xrange(0, len(requests), max_parallel_sends):
+            tasks = [Tasklet.new(self._send)(identifier, data) for identifier, data in requests[i:i + max_parallel_sends]]
+            for res in Tasklet.join_all(tasks):
+                if isinstance(res, Exception):
+                    raise res
+
+    def _pairs(self, ids):
+        "Convert target IDs (see send) to the list of realplexor identifiers"
         pairs = []
         if type(ids) == type("") or type(ids) == unicode:
             if not re_valid_id.match(ids):
@@ -98,10 +135,7 @@ class RealplexorConcurrence(object):
                     raise RealplexorError("Realplexor id must be alphanumeric")
                 id = self.namespace + id
                 pairs.append("%s:%s" % (cursor, id))
-        if show_only_for_ids:
-            for id in show_only_for_ids:
-                pairs.append("*%s%s" % (self.namespace, id))
-        self._send(",".join(pairs), data)
+        return pairs
 
     def cmdOnlineWithCounters(self, idPrefixes=None):
         """
@@ -229,6 +263,7 @@ class RealplexorConcurrence(object):
 class Realplexor(mg.Module):
     def register(self):
         self.rhook("stream.send", self.send)
+        self.rhook("stream.send-multi", self.send_multi)
         self.rhook("stream.packet", self.packet)
         self.rhook("stream.packet-list", self.packet_list)
         self.rhook("stream.flush", self.flush)
@@ -245,12 +280,35 @@ class Realplexor(mg.Module):
             raise RealplexorError("Realplexor is not running")
         return realplexor[0]["addr"]
 
-    def send(self, ids, data):
+    def rpl(self):
+        "Realplexor client for the current realplexor host. Reused between requests"
         host = self.call("realplexor.host")
-        if host:
-            rpl = RealplexorConcurrence(host, 10010, self.app().tag + "_")
+        if not host:
+            return None
+        try:
+            rpl = self._rpl
+        except AttributeError:
+            pass
+        else:
+            if rpl.host == host:
+                return rpl
+        rpl = RealplexorConcurrence(host, 10010, self.app().tag + "_")
+        self._rpl = rpl
+        return rpl
+
+    def send(self, ids, data):
+        rpl = self.rpl()
+        if rpl:
             rpl.send(ids, data)
 
+    def send_multi(self, messages):
+        "messages - list of (ids, data)"
+        if not messages:
+            return
+        rpl = self.rpl()
+        if rpl:
+            rpl.send_multi(messages)
+
     def packet(self, ids, method_cls, method, **kwargs):
         kwargs["method_cls"] = method_cls
         kwargs["method"] = method
@@ -303,10 +361,9 @@ class Realplexor(mg.Module):
         except AttributeError:
             pass
         else:
-            for session_uuid, lst in packets.iteritems():
-                self.call("stream.send", session_uuid, {"packets": lst})
             req.stream_packets = {}
             req.stream_packets_len = 0
+            self.call("stream.send-multi", [(session_uuid, {"packets": lst}) for session_uuid, lst in packets.iteritems()])
 
     def request_processed(self):
         self.flush()
@@ -20,6 +20,7 @@ from concurrence.http import server
 from mg import *
 from mg.core.tools import *
 from mg.core.config import DBConfigGroup, DBConfigGroupList
+from mg.core.cass import object_cache
 from mg.core.applications import DBHookGroupModules, DBHookGroupModulesList
 from template import Template, TemplateException, TooManyLoops
 from template.provider import Provider
@@ -51,6 +52,15 @@ re_hooks_split = re.compile(r'(<hook:[a-zA-Z0-9_-]+\.[a-zA-Z0-9_\.-]+(?:\s+[a-zA
 re_hook_parse = re.compile(r'^(<|\[)hook:([a-zA-Z0-9_-]+\.[a-zA-Z0-9_\.-]+)((?:\s+[a-zA-Z0-9_-]+="[^"]*")*)\s*(/>|\])$')
 re_hook_args = re.compile(r'\s+([a-zA-Z0-9_-]+)="([^"]*)"')
 
+# idle template engines kept for every template configuration
+template_engines_pool = 10
+# compiled templates kept by every template provider (least recently used are dropped)
+template_cache_size = 1000
+# number of the most expensive templates announced to the monitoring
+template_stats_top = 20
+# default lifetime of cached page fragments (seconds)
+fragment_ttl = 3600
+
 class Request(object):
     "HTTP request"
 
@@ -463,6 +473,15 @@ class WebService(Loggable):
         if elapsed > 3:
             svcinfo["svc-rps"] = (new_reqstat[1] - old_reqstat[1]) / elapsed
             self.old_reqstat = new_reqstat
+            # the most expensive templates since the last announce: [[name, renders, seconds], ...]
+            try:
+                stats = self.inst.tpl_stats
+            except AttributeError:
+                pass
+            else:
+                self.inst.tpl_stats = {}
+                stats = sorted(stats.iteritems(), key=lambda ent: -ent[1][1])[0:template_stats_top]
+                svcinfo["svc-templates"] = [[name, ent[0], ent[1]] for name, ent in stats]
 
     def set(self, key, val):
         self.svcinfo[key] = val
@@ -485,34 +504,39 @@ class ApplicationWebService(WebService):
             request.hook = hook
             request.args = re_remove_ver.sub("", args)
             try:
-                app.hooks.call("web.security_check")
-                res = lambda: app.hooks.call("%s-%s.%s" % (self.hook_prefix, group, hook), check_priv=True)
-                # POST requests with authenticated user are automatically locked
-                # to avoid multiple concurrent requests from a single user
-                if request.environ.get("REQUEST_METHOD") == "POST" and self.request_locks:
-                    user = request.user()
-                    if user:
-                        with app.lock(["UserRequest.%s.%s" % (app.tag, user)]):
-                            res = res()
-                    else:
-                        with app.lock(["UserRequest.%s.%s" % (app.tag, request.remote_addr())]):
+                # memcached writes made by the ORM are sent in batches at the end of request
+                with app.mc.pipeline():
+                    try:
+                        app.hooks.call("web.security_check")
+                        res = lambda: app.hooks.call("%s-%s.%s" % (self.hook_prefix, group, hook), check_priv=True)
+                        # POST requests with authenticated user are automatically locked
+                        # to avoid multiple concurrent requests from a single user
+                        if request.environ.get("REQUEST_METHOD") == "POST" and self.request_locks:
+                            user = request.user()
+                            if user:
+                                with app.lock(["UserRequest.%s.%s" % (app.tag, user)]):
+                                    res = res()
+                            else:
+                                with app.lock(["UserRequest.%s.%s" % (app.tag, request.remote_addr())]):
+                                    res = res()
+                        else:
                             res = res()
-                else:
-                    res = res()
-            except WebResponse as res:
-                res = res.content
-            if getattr(request, "cache", None):
-                res = ["".join([str(chunk) for chunk in res])]
-                app.mc.set("page%s" % urldecode(request.uri()).encode("utf-8"), res[0])
-                mcid = getattr(request, "web_cache_mcid", None)
-                if mcid:
-                    app.mc.set("page%s" % mg.core.tools.urldecode(request.uri()).encode("utf-8"), res[0])
-                    app.mc.set(request.web_cache_mcid, res[0])
+                    except WebResponse as res:
+                        res = res.content
+                    if getattr(request, "cache", None):
+                        res = ["".join([str(chunk) for chunk in res])]
+                        app.mc.set("page%s" % urldecode(request.uri()).encode("utf-8"), res[0])
+                        mcid = getattr(request, "web_cache_mcid", None)
+                        if mcid:
+                            app.mc.set(mcid, res[0])
+                    request.app.hooks.call("web.request_processed")
+                    return res
+            finally:
+                # released after the pipeline is flushed, so waiting requests find the page in memcached
                 lock = getattr(request, "web_cache_lock", None)
                 if lock:
+                    request.web_cache_lock = None
                     lock.__exit__(None, None, None)
-            request.app.hooks.call("web.request_processed")
-            return res
         except SystemExit:
             os._exit(0)
         except Exception as e:
@@ -546,6 +570,9 @@ class Web(Module):
         self.rhook("web.parse_template", self.web_parse_template)
         self.rhook("web.cache", self.web_cache)
         self.rhook("web.cache_invalidate", self.web_cache_invalidate)
+        self.rhook("web.fragment", self.web_fragment)
+        self.rhook("web.fragments_invalidate", self.web_fragments_invalidate)
+        self.rhook("config.changed", self.fragments_config_changed)
         self.rhook("web.response", self.web_response)
         self.rhook("web.response_global", self.web_response_global)
         self.rhook("web.response_template", self.web_response_template)
@@ -621,6 +648,8 @@ class Web(Module):
     def core_appconfig(self):
         req = self.req()
         factory = self.app().inst.appfactory
+        # the application may be unloaded already while its objects are still cached
+        object_cache.invalidate_tag(req.args)
         app = factory.get_by_tag(req.args, False)
         if app:
             if app.hooks.dynamic:
@@ -640,6 +669,79 @@ class Web(Module):
             if req.templates_len >= 10000000:
                 return "<too-long-templates />"
             req.templates_parsed = req.templates_parsed + 1
+        inst = self.app().inst
+        conf = self.template_conf(config)
+        # applications may extend include path, so it is a part of the key
+        if config is None:
+            key = (tuple(conf["INCLUDE_PATH"]), None)
+        else:
+            key = (tuple(conf["INCLUDE_PATH"]), tuple(sorted([(k, repr(v)) for k, v in config.iteritems()])))
+        # template engines are reused by subsequent calls keeping compiled templates
+        try:
+            engines = inst.tpl_engines
+        except AttributeError:
+            engines = {}
+            inst.tpl_engines = engines
+        pool = engines.get(key)
+        if pool:
+            tpl_engine = pool.pop()
+        else:
+            tpl_engine = Template(conf)
+        self.template_universal_variables(vars)
+        if type(filename) == unicode:
+            filename = filename.encode("utf-8")
+        started = time.time()
+        try:
+            content = tpl_engine.process(filename, vars)
+        except TypeError as e:
+            raise TemplateException("security", unicode(e))
+        except ValueError as e:
+            raise TemplateException("security", unicode(e))
+        except ImportError as e:
+            raise TemplateException("security", unicode(e))
+        except MemoryError:
+            raise TemplateException("security", self._("Memory overflow during template processing"))
+        except TooManyLoops:
+            raise TemplateException("security", self._("Too many template loop iterations"))
+        except ZeroDivisionError:
+            raise TemplateException("security", self._("Zero division in the template"))
+        # engine is returned to the pool after successful processing only
+        try:
+            pool = engines[key]
+        except KeyError:
+            pool = []
+            engines[key] = pool
+        if len(pool) < template_engines_pool:
+            pool.append(tpl_engine)
+        # render timing
+        elapsed = time.time() - started
+        name = filename if type(filename) == str else "<stream>"
+        try:
+            stats = inst.tpl_stats
+        except AttributeError:
+            stats = {}
+            inst.tpl_stats = stats
+        try:
+            ent = stats[name]
+        except KeyError:
+            stats[name] = [1, elapsed]
+        else:
+            ent[0] += 1
+            ent[1] += elapsed
+        if req:
+            req.templates_len = req.templates_len + len(content)
+        m = re_content.match(content)
+        if m:
+            # everything before <!--HEAD--> delimiter will pass to the header
+            (head, content) = m.group(1, 2)
+            if vars.get("head") is None:
+                vars["head"] = head
+            else:
+                vars["head"] = head + vars["head"]
+        return content
+
+    def template_conf(self, config):
+        "Template engine configuration. config - custom parameters overriding defaults"
         include_path = [ mg.__path__[0] + "/templates" ]
         self.call("core.template_path", include_path)
         conf = {
@@ -647,6 +749,7 @@ class Web(Module):
             "ANYCASE": True,
             "PRE_CHOMP": 1,
             "POST_CHOMP": 1,
+            "CACHE_SIZE": template_cache_size,
             "PLUGIN_BASE": ["Unexistent"],
             "PLUGINS": {
                 "datafile": "Template::Plugin::Disabled::datafile",
@@ -678,81 +781,95 @@ class Web(Module):
                 conf["LOAD_TEMPLATES"] = provider
         else:
             conf["LOAD_TEMPLATES"] = Provider(conf)
-        tpl_engine = Template(conf)
-        if vars.get("universal_variables") is None:
-            vars["ver"] = self.inst.dbconfig.get("application.version", 10000)
-            vars["universal_variables"] = True
+        return conf
+
+    def template_universal_variables(self, vars):
+        """
+        Fill variables available to every template. They are evaluated once per request
+        for every application rendering templates
+        """
+        if vars.get("universal_variables") is not None:
+            return
+        try:
+            req = self.req()
+        except AttributeError:
+            req = None
+        tag = self.app().tag
+        try:
+            uvars = req._universal_variables[tag]
+        except (AttributeError, KeyError):
+            uvars = {}
+            uvars["ver"] = self.inst.dbconfig.get("application.version", 10000)
+            uvars["universal_variables"] = True
             try:
                 try:
-                    vars["protocol"] = self.app().protocol
+                    uvars["protocol"] = self.app().protocol
                 except AttributeError:
                     pass
                 try:
-                    vars["domain"] = self.app().canonical_domain
+                    uvars["domain"] = self.app().canonical_domain
                 except AttributeError:
-                    vars["domain"] = self.app().domain
+                    uvars["domain"] = self.app().domain
             except AttributeError:
                 pass
-            self.call("web.universal_variables", vars)
-        if type(filename) == unicode:
-            filename = filename.encode("utf-8")
-        try:
-            content = tpl_engine.process(filename, vars)
-        except TypeError as e:
-            raise TemplateException("security", unicode(e))
-        except ValueError as e:
-            raise TemplateException("security", unicode(e))
-        except ImportError as e:
-            raise TemplateException("security", unicode(e))
-        except MemoryError:
-            raise TemplateException("security", self._("Memory overflow during template processing"))
-        except TooManyLoops:
-            raise TemplateException("security", self._("Too many template loop iterations"))
-        except ZeroDivisionError:
-            raise TemplateException("security", self._("Zero division in the template"))
-        if req:
-            req.templates_len = req.templates_len + len(content)
-        m = re_content.match(content)
-        if m:
-            # everything before <!--HEAD--> delimiter will pass to the header
-            (head, content) = m.group(1, 2)
-            if vars.get("head") is None:
-                vars["head"] = head
-            else:
-                vars["head"] = head + vars["head"]
-        return content
+            self.call("web.universal_variables", uvars)
+            if req:
+                try:
+                    req._universal_variables[tag] = uvars
+                except AttributeError:
+                    req._universal_variables = {tag: uvars}
+        vars.update(uvars)
 
     def web_cache(self):
         req = self.req()
         req.cache = True
-        if False:
-            uri = mg.core.tools.urldecode(req.uri()).encode("utf-8")
-            mc = self.app().mc
-            mcid_ver = "pagever%s" % uri
-            ver = mc.get(mcid_ver)
-            if ver is None:
-                ver = random.randrange(0, 1000000000)
-                mc.set(mcid_ver, ver)
-            mcid = "pagecache%d%s" % (ver, uri)
-            data = mc.get(mcid)
-            if data is not None:
-                req.cache = False
-                self.call("web.response", data)
-            req.web_cache_lock = self.lock([uri], patience=random.randrange(15, 25))
-            req.web_cache_lock.__enter__()
-            ver = mc.get(mcid_ver)
-            mcid = "pagecache%d%s" % (ver, uri)
-            data = mc.get(mcid)
-            if data is not None:
-                req.cache = False
-                self.call("web.response", data)
-            req.web_cache_mcid = mcid
+        uri = mg.core.tools.urldecode(req.uri()).encode("utf-8")
+        mc = self.app().mc
+        mcid = "Page-%s%s" % (uri, mc.ver(["Page-%s" % uri, "Fragments-config"]))
+        data = mc.get(mcid)
+        if data is not None:
+            req.cache = False
+            self.call("web.response", data)
+        # only one request renders the page. Others wait for it and take the result from memcached
+        req.web_cache_lock = self.lock(["Page-%s" % uri], patience=random.randrange(15, 25))
+        req.web_cache_lock.__enter__()
+        data = mc.get(mcid)
+        if data is not None:
+            req.cache = False
+            self.call("web.response", data)
+        req.web_cache_mcid = mcid
 
     def web_cache_invalidate(self, uri):
         mc = self.app().mc
-        #mc.incr("pagever%s" % uri)
+        mc.incr_ver("Page-%s" % uri)
         mc.delete("page%s" % uri)
 
+    def web_fragment(self, group, key, render, ttl=None):
+        """
+        Return rendered fragment <group>/<key> from memcached. On a miss render() is called
+        under a lock, so concurrent requests don't render the same fragment simultaneously.
+        The fragment is dropped when the group or the application config is invalidated
+        """
+        mc = self.app().mc
+        lang = self.call("l10n.lang")
+        mcid = "Fragment-%s%s/%s/%s" % (group, mc.ver(["Fragments-%s" % group, "Fragments-config"]), lang, key)
+        data = mc.get(mcid)
+        if data is not None:
+            return data
+        with self.lock(["Fragment-%s/%s/%s" % (group, lang, key)], patience=random.randrange(15, 25)):
+            data = mc.get(mcid)
+            if data is not None:
+                return data
+            data = render()
+            mc.set(mcid, data, fragment_ttl if ttl is None else ttl)
+        return data
+
+    def web_fragments_invalidate(self, group):
+        self.app().mc.incr_ver("Fragments-%s" % group)
+
+    def fragments_config_changed(self):
+        self.app().mc.incr_ver("Fragments-config")
+
     def web_response(self, content, content_type=None):
         if content_type is not None:
             self.req().content_type = content_type
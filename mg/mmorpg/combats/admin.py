@@ -1464,9 +1464,11 @@ class CombatsAdmin(mg.constructor.ConstructorModule):
                     errors["log_retention"] = self._("Maximal value is %d") % 365
                 else:
                     config.set("combats-history.log_retention", val)
+            config.set("combats-history.syslog", True if req.param("syslog") else False)
             config.store()
             self.call("admin.response", self._("Settings stored"), {})
         fields = [
+            {"name": "syslog", "type": "checkbox", "label": self._("Write system logs of combats"), "checked": self.conf("combats-history.syslog", True)},
             {"name": "syslog_retention", "label": self._("System logs retention (for how many days to keep system logs)"), "value": self.conf("combats-history.syslog_retention", 7)},
             {"name": "log_retention", "label": self._("User logs retention (for how many days to keep user combat logs)"), "value": self.conf("combats-history.log_retention", 30)},
         ]
@@ -32,6 +32,29 @@ re_team_list = re.compile(r'^team(\d+)_list')
 
 textlog_ring_size = 10
 
+def viewer_independent(val):
+    """
+    Returns True when visibility expression doesn't depend on the 'viewer' and
+    therefore may be evaluated once for all controllers
+    """
+    if type(val) is not list:
+        return True
+    cmd = val[0]
+    if cmd == "glob":
+        return val[1] != "viewer"
+    if cmd == "random":
+        return False
+    if cmd == "call":
+        if val[1] == "selrand":
+            return False
+        args = val[2:]
+    else:
+        args = val[1:]
+    for arg in args:
+        if not viewer_independent(arg):
+            return False
+    return True
+
 class CombatError(Exception):
     def __init__(self, val):
         self.val = val
@@ -180,6 +203,9 @@ class Combat(mg.constructor.ConstructorModule, CombatParamsContainer):
         self.start_time = time.time()
         self._flags = set()
         self._textlog_ring = []
+        self._visibility_static = {}
+        self._visibility_cache = None
+        self.stream_batch = None
 
     def script_code(self, tag):
         "Get combat script code (syntax tree)"
@@ -449,7 +475,7 @@ class Combat(mg.constructor.ConstructorModule, CombatParamsContainer):
         timeout = self.rulesinfo.get("timeout", 4 * 3600)
         if elapsed > timeout + 600:
             self.warning(self._("Combat %s terminated due to too long timeout"), self.uuid)
-            os._exit(0)
+            raise CombatRunError(self._("Combat terminated due to too long timeout"))
         elif self.stage_flag("actions") and elapsed > timeout:
             self.info(self._("Combat %s timed out"), self.uuid)
             self.draw()
@@ -457,15 +483,19 @@ class Combat(mg.constructor.ConstructorModule, CombatParamsContainer):
     def flush(self):
         "Flush pending messages"
         # deliver changed parameters
-        params = self.changed_params()
-        if params:
-            for controller in self.controllers:
-                controller.combat_params_changed(params)
-        for member in self.members:
-            params = member.changed_params()
+        self._visibility_cache = {}
+        try:
+            params = self.changed_params()
             if params:
                 for controller in self.controllers:
-                    controller.member_params_changed(member, params)
+                    controller.combat_params_changed(params)
+            for member in self.members:
+                params = member.changed_params()
+                if params:
+                    for controller in self.controllers:
+                        controller.member_params_changed(member, params)
+        finally:
+            self._visibility_cache = None
         # commit logs
         if self.log:
             self.log.flush()
@@ -474,10 +504,47 @@ class Combat(mg.constructor.ConstructorModule, CombatParamsContainer):
             for controller in self.controllers:
                 controller.deliver_log(self.not_delivered_log)
             self.not_delivered_log = []
-        # flush everything to the clients
-        for controller in self.controllers:
-            controller.flush()
+        # flush everything to the clients. Controllers put their packets
+        # to the stream_batch and all of them are published at once
+        self.stream_batch = []
+        try:
+            for controller in self.controllers:
+                controller.flush()
+        finally:
+            batch = self.stream_batch
+            self.stream_batch = None
         self.call("stream.flush")
+        if batch:
+            self.call("stream.send-multi", batch)
+
+    def param_visible(self, paraminfo, key, member, viewer):
+        """
+        Evaluate visibility of the parameter 'key' of the 'member' (None for combat parameters)
+        for the 'viewer'. During flush viewer independent conditions are evaluated only once
+        """
+        visible_script = paraminfo.get("visible")
+        cache = self._visibility_cache
+        if cache is not None:
+            try:
+                script, static = self._visibility_static[id(visible_script)]
+            except KeyError:
+                script = None
+            if script is not visible_script:
+                static = viewer_independent(visible_script)
+                self._visibility_static[id(visible_script)] = (visible_script, static)
+            if static:
+                cache_key = (key, member.id if member else None)
+                try:
+                    return cache[cache_key]
+                except KeyError:
+                    pass
+        if member is None:
+            visible = self.call("script.evaluate-expression", visible_script, globs={"combat": self, "viewer": viewer}, description=self._("Visibility of combat parameter %s") % key)
+        else:
+            visible = self.call("script.evaluate-expression", visible_script, globs={"combat": self, "member": member, "viewer": viewer}, description=self._("Visibility of combat parameter %s") % key)
+        if cache is not None and static:
+            cache[cache_key] = visible
+        return visible
 
     def set_log(self, log):
         "Attach logging system to the combat"
@@ -1251,8 +1318,7 @@ class CombatMemberController(CombatObject):
                 paraminfo = paramsinfo.get(key)
                 if paraminfo:
                     # visibility check
-                    visible_script = paraminfo.get("visible")
-                    visible = self.call("script.evaluate-expression", visible_script, globs={"combat": self.combat, "viewer": self.member}, description=self._("Visibility of combat parameter %s") % key)
+                    visible = self.combat.param_visible(paraminfo, key, None, self.member)
                     if not visible:
                         val = None
                 else:
@@ -1282,8 +1348,7 @@ class CombatMemberController(CombatObject):
                 paraminfo = paramsinfo.get(key)
                 if paraminfo:
                     # visibility check
-                    visible_script = paraminfo.get("visible")
-                    visible = self.call("script.evaluate-expression", visible_script, globs={"combat": self.combat, "member": member, "viewer": self.member}, description=self._("Visibility of combat parameter %s") % key)
+                    visible = self.combat.param_visible(paraminfo, key, member, self.member)
                     if not visible:
                         val = None
                 else:
@@ -22,12 +22,14 @@ from mg.mmorpg.combats.turn_order import *
 from mg.mmorpg.combats.ai import AIController
 from mg.mmorpg.combats.logs import CombatDatabaseLog
 from mg.core.cluster import DBCluster, HTTPConnectionRefused
+from mg.core.web import re_service_call
 from mg.core.tools import *
 from concurrence import Tasklet, http
 from concurrence.http import HTTPError
 import re
 import json
 import os
+import time
 from uuid import uuid4
 
 re_valid_uuid = re.compile('^[a-f0-9]{32}$')
@@ -52,14 +54,14 @@ class CombatDaemonModule(mg.constructor.ConstructorModule):
         self.rhook("cmb-combat.members", self.combat_members, priv="public")
         self.rhook("cmb-combat.join", self.combat_join, priv="public")
 
+    @property
+    def csrv(self):
+        "CombatService the current request is addressed to"
+        return self.req().csrv
+
     @property
     def combat(self):
-        try:
-            return self._combat
-        except AttributeError:
-            pass
-        self._combat = self.app().inst.csrv.combat
-        return self._combat
+        return self.csrv.combat
 
     def response_json(self, data):
         data["combat"] = self.combat.uuid
@@ -167,8 +169,7 @@ class CombatDaemonModule(mg.constructor.ConstructorModule):
         req = self.req()
         member_info = json.loads(req.param("member"))
         try:
-            csrv = self.app().inst.csrv
-            csrv.join_member(member_info)
+            self.csrv.join_member(member_info)
             result = {"ok": 1}
         except CombatRunError as e:
             result = {"error": self._("Unable to join the combat")}
@@ -194,6 +195,7 @@ class CombatRunner(mg.constructor.ConstructorModule):
         daemons = self.int_app().obj(DBCluster, "daemons", silent=True)
         metagam_running = set()
         hosts = []
+        combat_hosts = []
         for dmnid, dmninfo in daemons.data.items():
             if dmninfo.get("cls") != cls:
                 continue
@@ -210,14 +212,46 @@ class CombatRunner(mg.constructor.ConstructorModule):
                     })
                 elif tp == "metagam":
                     metagam_running.add(dmninfo.get("hostid"))
+                elif tp == "combathost":
+                    combat_hosts.append({
+                        "id": dmnid,
+                        "hostid": dmninfo.get("hostid"),
+                        "svcid": svcid,
+                        "addr": svcinfo.get("addr"),
+                        "port": svcinfo.get("port"),
+                        "combats": svcinfo.get("combats", 0),
+                        "max_combats": svcinfo.get("max_combats", 0),
+                    })
         hosts = [host for host in hosts if host["hostid"] in metagam_running]
         if not hosts:
             self.warning("No available hosts where to launch combat %s. Postponing launch", cobj.uuid)
             return
         hosts.sort(lambda x, y: cmp(x["load"], y["load"]))
         self.debug("Available hosts: %s", hosts)
+        # Try already running combat hosts with free slots. Hosts on the
+        # least loaded machines are preferred
+        host_order = {}
+        for i in xrange(0, len(hosts)):
+            host_order.setdefault(hosts[i]["hostid"], i)
+        combat_hosts = [chost for chost in combat_hosts if chost["hostid"] in host_order and chost["combats"] < chost["max_combats"]]
+        combat_hosts.sort(lambda x, y: cmp(host_order[x["hostid"]], host_order[y["hostid"]]) or cmp(x["combats"], y["combats"]))
+        for chost in combat_hosts:
+            self.debug("Querying combat host %s to launch combat %s", chost["svcid"], cobj.uuid)
+            try:
+                val = self.call("cluster.query_server", chost["addr"], chost["port"], "/service/call/%s/run" % chost["svcid"], timeout=20, params={
+                    "app": self.app().tag,
+                    "combat": cobj.uuid,
+                    "daemon": daemon_id,
+                })
+            except HTTPError as e:
+                self.warning("Error querying combat host %s: %s", chost["svcid"], e)
+                continue
+            if type(val) == dict and val.get("ok"):
+                return
+            self.debug("Combat host %s refused to launch combat %s: %s", chost["svcid"], cobj.uuid, val)
+        # No combat hosts with free slots. Launching a new one
         host = hosts[0]
-        self.debug("Selected host %s to launch combat %s", host, cobj.uuid)
+        self.debug("Selected host %s to launch combat host for combat %s", host, cobj.uuid)
         val = self.call("cluster.query_server", host["addr"], host["port"], "/service/call/%s/newproc" % host["svcid"], timeout=20, params={
             "procid": "combat-%s" % daemon_id,
             "args": json.dumps([
@@ -260,17 +294,21 @@ class CombatRequest(mg.constructor.ConstructorModule):
         locker.set_busy()
 
 class CombatService(CombatObject, mg.SingleApplicationWebService):
-    def __init__(self, app, combat_id, daemon_id, fqn="mg.mmorpg.combats.daemon.CombatDaemon"):
+    "Single combat running inside a CombatHostService"
+    host = None
+
+    def __init__(self, app, combat_id, daemon_id, host, fqn="mg.mmorpg.combats.daemon.CombatDaemon"):
         mg.SingleApplicationWebService.__init__(self, app, "combat-%s-%s" % (app.tag, combat_id), "combat", "cmb", fqn)
         self.combat_id = combat_id
+        self.host = host
         try:
             cobj = app.obj(DBRunningCombat, combat_id)
         except mg.ObjectNotFoundException:
             self.error("Combat daemon %s started (combat %s), but RunningCombat object not found", daemon_id, combat_id)
-            os._exit(0)
+            raise CombatRunError(self._("Combat not found"))
         if cobj.get("daemonid") != daemon_id:
             self.error("Combat daemon %s started (combat %s), but RunningCombat contains another daemon id (%s)", daemon_id, combat_id, cobj.get("daemonid"))
-            os._exit(0)
+            raise CombatRunError(self._("Combat is launched by another daemon"))
         self.cobj = cobj
         combat = Combat(app, cobj.uuid, cobj.get("rules", {}))
         log = CombatDatabaseLog(combat)
@@ -280,6 +318,14 @@ class CombatService(CombatObject, mg.SingleApplicationWebService):
         if cobj.get("flags"):
             combat.set_flags(cobj.get("flags"))
 
+    def serve_any_port(self):
+        "Combats don't listen ports themselves. Requests are dispatched by the combat host"
+        self.addr = self.host.addr
+
+    def req_handler(self, request, group, hook, args):
+        request.csrv = self
+        return mg.SingleApplicationWebService.req_handler(self, request, group, hook, args)
+
     def join_member(self, member):
         if member["object"][0] != "character":
             n_char = 0
@@ -358,7 +404,6 @@ class CombatService(CombatObject, mg.SingleApplicationWebService):
         self.combat.run(turn_order)
 
     def run(self):
-        self.app().inst.csrv = self
         try:
             self.add_members(self.cobj.get("members", []))
             self.run_combat()
@@ -387,7 +432,89 @@ class CombatService(CombatObject, mg.SingleApplicationWebService):
             locker = CombatLocker(self.app(), self.cobj)
             locker.unset_busy()
             self.cobj.remove()
-            self.app().inst.csrv = None
+            if self.host:
+                self.host.combat_finished(self)
+
+class CombatHostService(mg.SingleApplicationWebService):
+    "Long-living daemon running many combats in a single process"
+    def __init__(self, app, service_id, max_combats, fqn="mg.mmorpg.combats.daemon.CombatHostService"):
+        mg.SingleApplicationWebService.__init__(self, app, service_id, "combathost", "combathost", fqn)
+        self.max_combats = max_combats
+        self.combats = {}
+        self.starting = 0
+        self.accepting = True
+        self.idle_since = time.time()
+
+    def request_uri(self, request, uri):
+        # /service/call/combat-<app>-<combat>/... is delivered to the combat itself
+        m = re_service_call.match(uri)
+        if m:
+            csrv = self.combats.get(m.group(1))
+            if csrv is not None:
+                return csrv.request_uri(request, uri)
+        return mg.SingleApplicationWebService.request_uri(self, request, uri)
+
+    def publish(self, svcinfo):
+        mg.SingleApplicationWebService.publish(self, svcinfo)
+        svcinfo["combats"] = len(self.combats) + self.starting
+        svcinfo["max_combats"] = self.max_combats if self.accepting else 0
+
+    def launch(self, app, combat_id, daemon_id):
+        "Create CombatService for the given RunningCombat and run it in a separate tasklet"
+        if not self.accepting or len(self.combats) + self.starting >= self.max_combats:
+            raise CombatRunError(self._("Combat host is full"))
+        self.starting += 1
+        try:
+            app.load(["mg.mmorpg.combats.daemon.CombatDaemonModule"])
+            csrv = CombatService(app, combat_id, daemon_id, self)
+            self.combats[csrv.id] = csrv
+        finally:
+            self.starting -= 1
+        self.debug("Combat %s launched on host %s (%d combats running)", combat_id, self.id, len(self.combats))
+        Tasklet.new(csrv.run)()
+        return csrv
+
+    def combat_finished(self, csrv):
+        try:
+            del self.combats[csrv.id]
+        except KeyError:
+            pass
+        if not self.combats:
+            self.idle_since = time.time()
+
+class CombatHost(mg.Module):
+    def register(self):
+        self.rhook("combathost-run.index", self.run_index, priv="public")
+        self.rhook("core.fastidle", self.fastidle)
+
+    def run_index(self):
+        req = self.req()
+        inst = self.app().inst
+        app = inst.appfactory.get_by_tag(req.param("app"))
+        if app is None:
+            self.call("web.response_json", {"error": "Application not found"})
+        try:
+            inst.combathost.launch(app, req.param("combat"), req.param("daemon"))
+        except CombatRunError as e:
+            self.call("web.response_json", {"error": e.val})
+        self.call("web.response_json", {"ok": 1})
+
+    def fastidle(self):
+        inst = self.app().inst
+        host = inst.combathost
+        if host.combats or host.starting or not host.accepting:
+            return
+        if time.time() < host.idle_since + inst.confint("combats", "host_idle_timeout", 600):
+            return
+        # Host is idle for a long time. Unregistering and terminating
+        self.info("Combat host %s is idle. Terminating", host.id)
+        host.accepting = False
+        with self.lock(["Cluster"]):
+            obj = self.obj(DBCluster, "daemons", silent=True)
+            obj.delkey(inst.instid)
+            obj.store()
+        self.call("cluster.terminate-daemon")
+        os._exit(0)
 
 class CombatInterface(mg.constructor.ConstructorModule):
     def __init__(self, app, combat_id, fqn="mg.mmorpg.combats.daemons.CombatInterface"):
@@ -531,7 +658,13 @@ class WebController(CombatMemberController):
         if self.outbound:
             outbound = self.outbound
             self.outbound = []
-            self.call("stream.character-list", self.char, outbound)
+            batch = self.combat.stream_batch
+            if batch is None:
+                self.call("stream.character-list", self.char, outbound)
+            else:
+                ids = self.char.stream_channels
+                if ids:
+                    batch.append((ids, {"packets": outbound}))
 
     def deliver_marker(self, marker):
         self.outbound = []
@@ -18,10 +18,21 @@
 from mg.mmorpg.combats.core import CombatObject
 import mg
 import mg.constructor
+from concurrence import Tasklet, Channel, TimeoutError
 import json
+import time
+import weakref
 from mg.core.tools import utf2str
 
 ENTRIES_PER_PAGE = 1000
+# writer is woken up when so many entries are pending
+FLUSH_ENTRIES = 100
+# pending entries are stored not later than in FLUSH_INTERVAL seconds
+FLUSH_INTERVAL = 5
+# when writer falls behind for more than MAX_QUEUED_PAGES completed pages the combat waits for it
+MAX_QUEUED_PAGES = 3
+# the combat waits for the writer not longer than MAX_WRITER_WAIT seconds. Then the oldest queued pages are dropped
+MAX_WRITER_WAIT = 10
 
 class DBCombatLog(mg.CassandraObject):
     clsname = "CombatLog"
@@ -59,7 +70,96 @@ class CombatLog(CombatObject):
     def flush(self):
         "Flush buffers to the storage"
 
+class CombatLogBuffer(object):
+    """
+    Pending entries of a single DBCombatLog. Entries are appended by the combat
+    and stored page by page in the writer tasklet
+    """
+    def __init__(self, db):
+        self.db = db
+        self.curpage = 0
+        self.entries = []
+        # completed pages not stored yet: [(pageno, entries, sized), ...]
+        self.full_pages = []
+        # number of entries of the current page already stored
+        self.stored = 0
+        # number of entries of the current page already counted in total_size
+        self.sized = 0
+        # number of entries appended since the last store
+        self.pending = 0
+        self.total_size = 256
+        self.dirty = False
+
+    def append(self, entry):
+        self.entries.append(entry)
+        self.pending += 1
+        if len(self.entries) >= ENTRIES_PER_PAGE:
+            self.full_pages.append((self.curpage, self.entries, self.sized))
+            self.curpage += 1
+            self.entries = []
+            self.stored = 0
+            self.sized = 0
+
+    def account(self, entries, sized):
+        "Add size of entries[sized:] to the total size"
+        for i in xrange(sized, len(entries)):
+            self.total_size += len(json.dumps(entries[i])) + 8
+
+    def store_page(self, obj, pageno, entries):
+        page = obj.obj(DBCombatLogPage, "%s-%s" % (self.db.uuid, pageno), data={})
+        page.set("entries", entries)
+        page.store()
+        self.db.set("pages", pageno + 1)
+        self.db.set("entries", pageno * ENTRIES_PER_PAGE + len(entries))
+        self.db.set("size", self.total_size)
+        self.dirty = True
+
+    def store(self, obj):
+        "Store new entries and the log header. obj is used to create database objects"
+        self.pending = 0
+        while self.full_pages:
+            pageno, entries, sized = self.full_pages[0]
+            self.account(entries, sized)
+            self.store_page(obj, pageno, entries)
+            del self.full_pages[0]
+        if self.stored < len(self.entries):
+            pageno = self.curpage
+            entries = list(self.entries)
+            self.account(entries, self.sized)
+            self.sized = len(entries)
+            self.stored = len(entries)
+            try:
+                self.store_page(obj, pageno, entries)
+            except Exception:
+                if self.curpage == pageno:
+                    self.stored = 0
+                raise
+        if self.dirty:
+            self.dirty = False
+            self.db.store()
+
+def combat_log_writer(log_ref, wakeup_channel):
+    "Background writer of CombatDatabaseLog"
+    while True:
+        try:
+            wakeup_channel.receive(FLUSH_INTERVAL)
+        except TimeoutError:
+            pass
+        log = log_ref()
+        if log is None:
+            return
+        log.writer_store()
+        if log.closed:
+            # changes made by close() while the writer was busy
+            log.writer_store()
+            return
+        del log
+
 class CombatDatabaseLog(CombatLog):
+    """
+    Combat log stored in the database. Entries are buffered and written by the
+    background tasklet, so combat loop never waits for the database
+    """
     def __init__(self, combat, fqn="mg.mmorpg.combats.logs.CombatDatabaseLog"):
         CombatLog.__init__(self, combat, fqn)
         now = self.now()
@@ -71,85 +171,93 @@ class CombatDatabaseLog(CombatLog):
         self.db_textlog.set("debug", 0)
         self.db_textlog.set("per_page", ENTRIES_PER_PAGE)
         self.db_textlog.store()
+        self.textlog_buffer = CombatLogBuffer(self.db_textlog)
+        self.buffers = [self.textlog_buffer]
         # create debug log
-        self.db_syslog = self.obj(DBCombatLog, "%s-debug" % combat.uuid, data={})
-        self.db_syslog.set("rules", combat.rules)
-        self.db_syslog.set("keep", 0)
-        self.db_syslog.set("started", now)
-        self.db_syslog.set("debug", 1)
-        self.db_syslog.set("per_page", ENTRIES_PER_PAGE)
-        self.db_syslog.store()
-        # buffer
-        self.textlog_entries = []
-        self.textlog_curpage = 0
-        self.textlog_dirty = False
-        self.textlog_total_entries = 0
-        self.textlog_total_size = 256
-        self.syslog_entries = []
-        self.syslog_curpage = 0
-        self.syslog_dirty = False
-        self.syslog_total_entries = 0
-        self.syslog_total_size = 256
+        if self.conf("combats-history.syslog", True):
+            self.db_syslog = self.obj(DBCombatLog, "%s-debug" % combat.uuid, data={})
+            self.db_syslog.set("rules", combat.rules)
+            self.db_syslog.set("keep", 0)
+            self.db_syslog.set("started", now)
+            self.db_syslog.set("debug", 1)
+            self.db_syslog.set("per_page", ENTRIES_PER_PAGE)
+            self.db_syslog.store()
+            self.syslog_buffer = CombatLogBuffer(self.db_syslog)
+            self.buffers.append(self.syslog_buffer)
+        else:
+            self.db_syslog = None
+            self.syslog_buffer = None
+        # writer
+        self.closed = False
+        self.last_store = time.time()
+        self.wakeup_channel = Channel()
+        # the writer references the log weakly and stops if the log is lost without close()
+        self.writer = Tasklet.new(combat_log_writer)(weakref.ref(self), self.wakeup_channel)
 
     def syslog(self, entry):
-        self.syslog_entries.append(entry)
-        self.syslog_dirty = True
-        self.syslog_total_entries += 1
-        self.syslog_total_size += len(json.dumps(entry)) + 8
-        if len(self.syslog_entries) >= ENTRIES_PER_PAGE:
-            self.syslog_flush()
-            self.syslog_curpage += 1
-            self.syslog_entries = []
-
-    def syslog_flush(self):
-        if not self.syslog_dirty:
-            return
-        page = self.obj(DBCombatLogPage, "%s-%s" % (self.db_syslog.uuid, self.syslog_curpage), data={})
-        page.set("entries", self.syslog_entries)
-        page.store()
-        self.db_syslog.set("pages", self.syslog_curpage + 1)
-        self.db_syslog.set("entries", self.syslog_total_entries)
-        self.db_syslog.set("size", self.syslog_total_size)
-        self.db_syslog.store()
-        self.syslog_dirty = False
+        if self.syslog_buffer:
+            self.syslog_buffer.append(entry)
 
     def textlog(self, entry):
-        self.textlog_entries.append(entry)
-        self.textlog_dirty = True
-        self.textlog_total_entries += 1
-        self.textlog_total_size += len(json.dumps(entry)) + 8
-        if len(self.textlog_entries) >= ENTRIES_PER_PAGE:
-            self.textlog_flush()
-            self.textlog_curpage += 1
-            self.textlog_entries = []
-
-    def textlog_flush(self):
-        if not self.textlog_dirty:
+        self.textlog_buffer.append(entry)
+
+    def queued_pages(self):
+        return sum([len(buf.full_pages) for buf in self.buffers])
+
+    def flush(self):
+        "Wake up writer if there are enough pending entries"
+        if self.closed:
             return
-        page = self.obj(DBCombatLogPage, "%s-%s" % (self.db_textlog.uuid, self.textlog_curpage), data={})
-        page.set("entries", self.textlog_entries)
-        page.store()
-        self.db_textlog.set("pages", self.textlog_curpage + 1)
-        self.db_textlog.set("entries", self.textlog_total_entries)
-        self.db_textlog.set("size", self.textlog_total_size)
-        self.db_textlog.store()
-        self.textlog_dirty = False
+        if self.queued_pages() > MAX_QUEUED_PAGES:
+            # writer is too late. Waiting for it
+            deadline = time.time() + MAX_WRITER_WAIT
+            while self.queued_pages() > MAX_QUEUED_PAGES:
+                if time.time() >= deadline:
+                    # the database is not available. The combat must go on without its log
+                    self.drop_pages()
+                    break
+                self.wakeup()
+                Tasklet.sleep(0.1)
+            return
+        pending = sum([buf.pending for buf in self.buffers])
+        if pending >= FLUSH_ENTRIES or pending and time.time() >= self.last_store + FLUSH_INTERVAL:
+            self.wakeup()
+
+    def drop_pages(self):
+        "Drop the oldest queued pages (except ones being stored by the writer)"
+        for buf in self.buffers:
+            while len(buf.full_pages) > 1 and self.queued_pages() > MAX_QUEUED_PAGES:
+                pageno, entries, sized = buf.full_pages.pop(1)
+                self.warning("Combat log %s: dropped page %d (%d entries) not stored in %d seconds", buf.db.uuid, pageno, len(entries), MAX_WRITER_WAIT)
+
+    def wakeup(self):
+        if self.wakeup_channel.has_receiver():
+            self.wakeup_channel.send(None)
+
+    def store(self):
+        self.last_store = time.time()
+        for buf in self.buffers:
+            buf.store(self)
+
+    def writer_store(self):
+        try:
+            self.store()
+        except Exception as e:
+            self.exception(e)
 
     def close(self):
         now = self.now()
-        self.db_textlog.set("stopped", now)
-        self.db_syslog.set("stopped", now)
-        self.textlog_dirty = True
-        self.syslog_dirty = True
-        self.flush()
-
-    def flush(self):
-        self.syslog_flush()
-        self.textlog_flush()
+        for buf in self.buffers:
+            buf.db.set("stopped", now)
+            buf.dirty = True
+        self.closed = True
+        self.wakeup()
+        Tasklet.join_all([self.writer])
 
     def set_title(self, title):
-        self.db_syslog.set("title", title)
-        self.db_textlog.set("title", title)
+        for buf in self.buffers:
+            buf.db.set("title", title)
+            buf.dirty = True
 
 class CombatLogViewer(mg.constructor.ConstructorModule):
     def __init__(self, app, tp, uuid, fqn="mg.mmorpg.combats.logs.CombatLogViewer"):
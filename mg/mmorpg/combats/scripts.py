@@ -50,27 +50,17 @@ class CombatScriptsAdmin(ConstructorModule):
 
     @property
     def general_parser_spec(self):
-        inst = self.app().inst
-        try:
-            return inst._parser_spec
-        except AttributeError:
-            inst._parser_spec = Parsing.Spec(sys.modules["mg.constructor.script_classes"], skinny=False)
-            return inst._parser_spec
+        return self.app().inst.parser_spec("mg.constructor.script_classes", skinny=False)
 
     @property
     def combat_parser_spec(self):
-        inst = self.app().inst
-        try:
-            return inst._combat_parser_spec
-        except AttributeError:
-            kwargs = {
-                "skinny": False
-            }
-            if parser_debug:
-                kwargs["verbose"] = True
-                kwargs["logFile"] = "CombatParser.log"
-            inst._combat_parser_spec = Parsing.Spec(sys.modules["mg.mmorpg.combats.combat_parser"], **kwargs)
-            return inst._combat_parser_spec
+        kwargs = {
+            "skinny": False
+        }
+        if parser_debug:
+            kwargs["verbose"] = True
+            kwargs["logFile"] = "CombatParser.log"
+        return self.app().inst.parser_spec("mg.mmorpg.combats.combat_parser", **kwargs)
 
     def parse_script(self, text):
         parser = CombatScriptParser(self.app(), self.combat_parser_spec, self.general_parser_spec)
@@ -703,6 +703,7 @@ class CraftingAdmin(ConstructorModule):
                 if rcp.get("image"):
                     self.call("cluster.static_delete", rcp.get("image"))
                 rcp.remove()
+                self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes")
         if req.args:
             if req.args == "new":
@@ -786,6 +787,7 @@ class CraftingAdmin(ConstructorModule):
                     rcp.set("image", self.call("cluster.static_upload", "recipe", ext, content_type, data.getvalue()))
                 # save
                 rcp.store()
+                self.call("web.fragments_invalidate", "library")
                 # delete old image
                 if image_data and old_image:
                     self.call("cluster.static_delete", old_image)
@@ -1138,6 +1140,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("availability", availability)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         if args == "new":
             avail = {
@@ -1170,6 +1173,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("availability", availability)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         val = avail.get("condition")
         if val is not None:
@@ -1217,6 +1221,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("requirements", reqs)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         reqs = recipe.get("requirements", {})
         fields = []
@@ -1249,6 +1254,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("experience", exps)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         exps = recipe.get("experience", {})
         fields = []
@@ -1272,6 +1278,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("ingredients", ingredients)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         if args == "new":
             ing = {
@@ -1312,6 +1319,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("ingredients", ingredients)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         fields = [
             {"name": "item_type", "label": self._("Item type"), "type": "combo", "values": item_type_values, "value": ing.get("item_type")},
@@ -1333,6 +1341,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("production", production)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         if args == "new":
             prod = {
@@ -1379,6 +1388,7 @@ class CraftingAdmin(ConstructorModule):
             recipe.set("production", production)
             recipe.touch()
             recipe.store()
+            self.call("web.fragments_invalidate", "library")
             self.call("admin.redirect", "crafting/recipes/view/%s" % recipe.uuid)
         fields = [
             {"name": "item_type", "label": self._("Item type"), "type": "combo", "values": item_type_values, "value": prod.get("item_type")},
@@ -334,6 +334,7 @@ class InventoryAdmin(ConstructorModule):
                 if uri:
                     obj.delkey("image-%s" % size)
                     obj.store()
+                    self.call("web.fragments_invalidate", "library")
                     self.call("cluster.static_delete", uri)
                 self.call("admin.redirect", "item-types/editor/%s" % uuid)
             if req.args == "new":
@@ -582,6 +583,7 @@ class InventoryAdmin(ConstructorModule):
                 obj.set("order", floatz(req.param("order")))
                 obj.set("library", True if req.param("library") else False)
                 obj.store()
+                self.call("web.fragments_invalidate", "library")
                 # deleting old images
                 for uri in delete_images:
                     if uri:
@@ -1623,46 +1625,44 @@ class InventoryAdmin(ConstructorModule):
     def stats(self):
         today = self.nowdate()
         yesterday = prev_date(today)
-        lst = self.objlist(DBItemTransferList, query_index="performed", query_start=yesterday, query_finish=today)
-        lst.load(silent=True)
         total = {}
         descriptions = {}
-        for ent in lst:
-            item_type = ent.get("type")
-            quantity = ent.get("quantity")
-            # total quantity
-            try:
-                total[item_type] += quantity
-            except KeyError:
-                total[item_type] = quantity
-            # descriptions
-            description = ent.get("description")
-            try:
-                hsh = descriptions[description]
-            except KeyError:
-                hsh = {}
-                descriptions[description] = hsh
-            try:
-                hsh[item_type] += quantity
-            except KeyError:
-                hsh[item_type] = quantity
+        for lst in self.objlist_pages(DBItemTransferList, query_index="performed", query_start=yesterday, query_finish=today, silent=True):
+            for ent in lst:
+                item_type = ent.get("type")
+                quantity = ent.get("quantity")
+                # total quantity
+                try:
+                    total[item_type] += quantity
+                except KeyError:
+                    total[item_type] = quantity
+                # descriptions
+                description = ent.get("description")
+                try:
+                    hsh = descriptions[description]
+                except KeyError:
+                    hsh = {}
+                    descriptions[description] = hsh
+                try:
+                    hsh[item_type] += quantity
+                except KeyError:
+                    hsh[item_type] = quantity
         kwargs = {}
         # this condition may be modified if we need to make remains recalculation more rare
         if True:
             remains = {}
-            lst = self.objlist(DBMemberInventoryList, query_index="all")
-            lst.load(silent=True)
-            for ent in lst:
-                items = ent.get("items")
-                if not items:
-                    continue
-                for item in items:
-                    item_type = item.get("type")
-                    quantity = item.get("quantity")
-                    try:
-                        remains[item_type] += quantity
-                    except KeyError:
-                        remains[item_type] = quantity
+            for lst in self.objlist_pages(DBMemberInventoryList, query_index="all", silent=True):
+                for ent in lst:
+                    items = ent.get("items")
+                    if not items:
+                        continue
+                    for item in items:
+                        item_type = item.get("type")
+                        quantity = item.get("quantity")
+                        try:
+                            remains[item_type] += quantity
+                        except KeyError:
+                            remains[item_type] = quantity
             kwargs["remains"] = remains
         self.call("dbexport.add", "inventory_stats", total=total, descriptions=descriptions, date=yesterday, **kwargs)
 
@@ -1685,6 +1685,7 @@ class MemberInventory(ConstructorModule):
         self.trans = []
         self.expired = {}
         self.worn = set()
+        self._index_invalidate()
 
     def _inv_update(self):
         pass
@@ -1722,7 +1723,6 @@ class MemberInventory(ConstructorModule):
 
     def _give(self, item_type, quantity, description=None, **kwargs):
         items = self._items()
-        found = False
         mod = kwargs.get("mod")
         # expiration time
         if (mod is None or "exp-till" not in mod) and not kwargs.get("no_exp"):
@@ -1741,12 +1741,11 @@ class MemberInventory(ConstructorModule):
                     mod["exp-till"] = exp_till
         # storing item
         dna = dna_make(mod)
-        for item in items:
-            if item.get("type") == item_type and item.get("dna") == dna:
-                item["quantity"] += quantity
-                found = True
-                break
-        if not found:
+        by_type, by_dna = self._items_index()
+        item = by_dna.get((item_type, dna))
+        if item is not None:
+            item["quantity"] += quantity
+        else:
             item = {
                 "type": item_type,
                 "quantity": quantity,
@@ -1756,6 +1755,7 @@ class MemberInventory(ConstructorModule):
             if dna:
                 item["dna"] = dna
             items.append(item)
+            self._index_add(item)
         self.inv.touch()
         if description:
             trans = self.obj(DBItemTransfer)
@@ -1779,7 +1779,98 @@ class MemberInventory(ConstructorModule):
             self.load()
         return self.inv.get("items")
 
+    def _items_index(self):
+        """
+        Returns index of the inventory items: (by_type, by_dna), where
+        by_type is dict type => [item, item, ...] (in the inventory order)
+        and by_dna is dict (type, dna_suffix) => item
+        """
+        items = self._items()
+        try:
+            return self._index
+        except AttributeError:
+            pass
+        self._index = ({}, {})
+        for item in items:
+            self._index_add(item)
+        return self._index
+
+    def _index_add(self, item):
+        by_type, by_dna = self._index
+        item_type = item.get("type")
+        try:
+            by_type[item_type].append(item)
+        except KeyError:
+            by_type[item_type] = [item]
+        key = (item_type, item.get("dna"))
+        if key not in by_dna:
+            by_dna[key] = item
+
+    def _index_invalidate(self):
+        "Drop index and cached items list. Called when the list of items is replaced"
+        try:
+            del self._index
+        except AttributeError:
+            pass
+        try:
+            del self._items_cache
+        except AttributeError:
+            pass
+
+    def _remove_item(self, item):
+        "Remove item from the inventory and from the index"
+        items = self._items()
+        by_type, by_dna = self._items_index()
+        for i in xrange(0, len(items)):
+            if items[i] is item:
+                del items[i]
+                break
+        item_type = item.get("type")
+        stacks = by_type[item_type]
+        for i in xrange(0, len(stacks)):
+            if stacks[i] is item:
+                del stacks[i]
+                break
+        if not stacks:
+            del by_type[item_type]
+        key = (item_type, item.get("dna"))
+        if by_dna.get(key) is item:
+            del by_dna[key]
+            # duplicate stacks with the same dna
+            for stack in stacks:
+                if stack.get("dna") == key[1]:
+                    by_dna[key] = stack
+                    break
+
+    def _stacks_expiration(self, item_type, stacks):
+        """
+        Returns list of (stack, expiration) for the stacks of the given type.
+        Item type object is created only when some stack has no own expiration
+        """
+        res = []
+        type_expiration = None
+        type_loaded = False
+        for item in stacks:
+            mod = item.get("mod")
+            if mod and "exp-till" in mod:
+                expiration = mod["exp-till"]
+            else:
+                if not type_loaded:
+                    type_expiration = self.item_type(item_type).get("exp-till")
+                    type_loaded = True
+                expiration = type_expiration
+            res.append((item, expiration))
+        return res
+
     def items(self, available_only=False):
+        now = self.now()
+        try:
+            retval, valid_till = self._items_cache
+        except AttributeError:
+            pass
+        else:
+            if valid_till is None or now <= valid_till:
+                return list(retval)
         lst = self._items()
         item_types = set()
         item_type_params = set()
@@ -1833,8 +1924,8 @@ class MemberInventory(ConstructorModule):
             db_params=item_params_cache.get(item.get("type"))
         ), item.get("quantity")) for item in lst]
         # removing expired items
-        now = self.now()
         retval = []
+        valid_till = None
         for item_type, quantity in result:
             if item_type.expiration and now > item_type.expiration:
                 self.expired[item_type.dna] = item_type.expiration
@@ -1842,7 +1933,10 @@ class MemberInventory(ConstructorModule):
                 self.worn.add(item_type.dna)
             else:
                 retval.append((item_type, quantity))
-        return retval
+                if item_type.expiration and (valid_till is None or item_type.expiration < valid_till):
+                    valid_till = item_type.expiration
+        self._items_cache = (retval, valid_till)
+        return list(retval)
 
     def take_type(self, *args, **kwargs):
         with self.lock([self.lock_key]):
@@ -1863,14 +1957,11 @@ class MemberInventory(ConstructorModule):
         performed = kwargs.get("performed") or self.now()
         # preparing list of items with given type
         old_items = []
-        i = 0
-        while i < len(items):
-            item = items[i]
-            if item.get("type") == item_type:
-                old_item_type = self.item_type(item.get("type"), item.get("dna"), item.get("mod"))
-                used = old_item_type.mods.get(":used", 0) if old_item_type.mods else 0
-                old_items.append((i, old_item_type.expiration, used, item["quantity"], old_item_type))
-            i += 1
+        by_type, by_dna = self._items_index()
+        for item in by_type.get(item_type, []):
+            old_item_type = self.item_type(item.get("type"), item.get("dna"), item.get("mod"))
+            used = old_item_type.mods.get(":used", 0) if old_item_type.mods else 0
+            old_items.append((item, old_item_type.expiration, used, item["quantity"], old_item_type))
         old_items.sort(cmp=lambda x, y: cmp(x[1] is None, y[1] is None) or cmp(x[1], y[1]) or cmp(y[2], x[2]))
         max_fractions = kwargs.get("fractions")
         deleted = 0
@@ -1960,11 +2051,12 @@ class MemberInventory(ConstructorModule):
             return 0
         # updating quantity field for old items
         for item in old_items:
-            items[item[0]]["quantity"] = item[3]
+            item[0]["quantity"] = item[3]
         # deleting exhausted old items
         items = [item for item in items if item["quantity"] > 0]
         self.inv.set("items", items)
         self.inv.touch()
+        self._index_invalidate()
         # storing log
         for key, quantity in logmessages.iteritems():
             item_type = key[0]
@@ -2007,52 +2099,52 @@ class MemberInventory(ConstructorModule):
         item_type, dna_suffix = dna_parse(dna)
         if not item_type:
             return None, None
-        items = self._items()
-        for i in xrange(0, len(items)):
-            item = items[i]
-            if item.get("type") == item_type and item.get("dna") == dna_suffix:
-                success = False
-                if quantity is None:
-                    quantity = item["quantity"]
-                    del items[i:i+1]
-                    self.inv.touch()
-                    success = True
-                elif item["quantity"] == quantity:
-                    del items[i:i+1]
-                    self.inv.touch()
-                    success = True
-                elif item["quantity"] > quantity:
-                    item["quantity"] -= quantity
-                    self.inv.touch()
-                    success = True
-                if success:
-                    if description:
-                        trans = self.obj(DBItemTransfer)
-                        trans.set("owner", self.uuid)
-                        if self.owtype != "char":
-                            trans.set("owtype", self.owtype)
-                        trans.set("type", item_type)
-                        if dna_suffix:
-                            trans.set("dna", dna_suffix)
-                        trans.set("quantity", -quantity)
-                        trans.set("description", description)
-                        for k, v in kwargs.iteritems():
-                            trans.set(k, v)
-                        trans.set("performed", kwargs.get("performed") or self.now())
-                        self.trans.append(trans)
-                    self._invalidate()
-                    return self.item(self, item_type, dna_suffix, item.get("mod")), quantity
-                return None, None
+        by_type, by_dna = self._items_index()
+        item = by_dna.get((item_type, dna_suffix))
+        if item is None:
+            return None, None
+        success = False
+        if quantity is None:
+            quantity = item["quantity"]
+            self._remove_item(item)
+            self.inv.touch()
+            success = True
+        elif item["quantity"] == quantity:
+            self._remove_item(item)
+            self.inv.touch()
+            success = True
+        elif item["quantity"] > quantity:
+            item["quantity"] -= quantity
+            self.inv.touch()
+            success = True
+        if success:
+            if description:
+                trans = self.obj(DBItemTransfer)
+                trans.set("owner", self.uuid)
+                if self.owtype != "char":
+                    trans.set("owtype", self.owtype)
+                trans.set("type", item_type)
+                if dna_suffix:
+                    trans.set("dna", dna_suffix)
+                trans.set("quantity", -quantity)
+                trans.set("description", description)
+                for k, v in kwargs.iteritems():
+                    trans.set(k, v)
+                trans.set("performed", kwargs.get("performed") or self.now())
+                self.trans.append(trans)
+            self._invalidate()
+            return self.item(self, item_type, dna_suffix, item.get("mod")), quantity
         return None, None
 
     def find_dna(self, dna):
         item_type, dna_suffix = dna_parse(dna)
         if not item_type:
             return None, None
-        for item in self._items():
-            if item.get("type") == item_type and item.get("dna") == dna_suffix:
-                return self.item(self, item_type, dna_suffix, item.get("mod")), item.get("quantity")
-        return None, None
+        by_type, by_dna = self._items_index()
+        item = by_dna.get((item_type, dna_suffix))
+        if item is None:
+            return None, None
+        return self.item(self, item_type, dna_suffix, item.get("mod")), item.get("quantity")
 
     def script_attr(self, attr, handle_exceptions=True):
         # aggregates
@@ -2072,27 +2164,30 @@ class MemberInventory(ConstructorModule):
             del self._item_aggregate_cache
         except AttributeError:
             pass
+        try:
+            del self._items_cache
+        except AttributeError:
+            pass
 
     def _aggregate(self, aggregate, param, handle_exceptions=True):
         if aggregate == "cnt":
             # looking for item types quantity
             value = 0
             now = self.now()
-            for item in self._items():
-                if item.get("type") == param:
-                    item_type = self.item_type(item.get("type"), item.get("dna"), item.get("mod"))
-                    if not item_type.expiration or now <= item_type.expiration:
-                        value += item.get("quantity")
+            by_type, by_dna = self._items_index()
+            for item, expiration in self._stacks_expiration(param, by_type.get(param, [])):
+                if not expiration or now <= expiration:
+                    value += item.get("quantity")
         elif aggregate == "cnt_dna":
             # looking for item dna quantity
             item_type, dna_suffix = dna_parse(param)
             value = 0
             now = self.now()
-            for item in self._items():
-                if item.get("type") == item_type and item.get("dna") == dna_suffix:
-                    item_type = self.item_type(item.get("type"), item.get("dna"), item.get("mod"))
-                    if not item_type.expiration or now <= item_type.expiration:
-                        value += item.get("quantity")
+            by_type, by_dna = self._items_index()
+            stacks = [item for item in by_type.get(item_type, []) if item.get("dna") == dna_suffix]
+            for item, expiration in self._stacks_expiration(item_type, stacks):
+                if not expiration or now <= expiration:
+                    value += item.get("quantity")
         else:
             # looking for items parameters
             if aggregate == "sum":
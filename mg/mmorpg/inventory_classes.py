@@ -26,6 +26,7 @@ re_dna_parse = re.compile(r'^([a-f0-9]+)(?:|_([0-9a-f]+))$')
 
 class DBItemType(CassandraObject):
     clsname = "ItemType"
+    local_cache = 10
     indexes = {
         "all": [[], "name_lower"],
         "name": [["name_lower"]],
@@ -45,6 +46,7 @@ class DBMemberInventoryList(CassandraObjectList):
 
 class DBItemTypeParams(CassandraObject):
     clsname = "ItemTypeParams"
+    local_cache = 10
 
 class DBItemTypeParamsList(CassandraObjectList):
     objcls = DBItemTypeParams
@@ -38,6 +38,7 @@ class ItemTypeParamsAdmin(ParamsAdmin):
         self.rhook("item-types.params-redirect", self.params_redirect)
         self.rhook("item-types.params-obj", self.params_obj)
         self.rhook("item-types.script-globs", self.script_globs)
+        self.rhook("item-types.param-admin-changed", self.param_admin_changed)
         self.rhook("headmenu-admin-item-types.paramview", self.headmenu_paramview)
         self.rhook("ext-admin-item-types.paramview", self.admin_paramview, priv="item-types.params-view")
 
@@ -52,6 +53,10 @@ class ItemTypeParamsAdmin(ParamsAdmin):
             info.store()
         return {"item": item_type}
 
+    def param_admin_changed(self, uuid, param, old_value, new_value, comment):
+        # item parameters are shown in the library
+        self.call("web.fragments_invalidate", "library")
+
     def params_url(self, uuid):
         return "item-types/paramview/%s" % uuid
 
@@ -26,6 +26,7 @@ re_html_attr = re.compile(r'^html_(.+)')
 
 class DBLocation(CassandraObject):
     clsname = "Location"
+    local_cache = 10
     indexes = {
         "all": [[], "name"],
         "name": [["name"]],
@@ -46,6 +47,7 @@ class DBCharacterLocationList(CassandraObjectList):
 
 class DBLocParams(CassandraObject):
     clsname = "LocParams"
+    local_cache = 10
 
 class DBLocParamsList(CassandraObjectList):
     objcls = DBLocParams
@@ -308,6 +308,12 @@ class CharQuest(object):
     def finished(self):
         return self.quests.finished.get(self.qid)
 
+# events indexed by a handler attribute: event => (attribute, event argument compared to it)
+quest_event_discriminators = {
+    "teleported": ("to", lambda kwargs: kwargs["new_loc"].uuid),
+    "money-changed": ("currency", lambda kwargs: kwargs["currency"]),
+}
+
 def parse_quest_tp(qid, tp):
     if tp[0] == "event":
         return "event-%s-%s" % (qid, tp[1])
@@ -620,6 +626,8 @@ class QuestsAdmin(ConstructorModule):
             else:
                 config.delete("qevent-%s.handlers" % event)
         config.set("quests.events", handlers.keys())
+        # invalidating compiled handlers in all processes
+        config.set("quests.handlers_version", uuid4().hex)
 
     def admin_quest_editor(self, qid, cmd):
         req = self.req()
@@ -1495,6 +1503,8 @@ class Quests(ConstructorModule):
         self.rhook("session.character-init", self.character_init)
         self.rhook("ext-quests.activity-end", self.ext_activity_end, priv="logged")
         self.rhook("quests.activity-aborted", self.activity_aborted)
+        self.dispatch_version = None
+        self.dispatch_cache = {}
 
     def activity_aborted(self, char):
         self.qevent("event-:activity-abort", char=char)
@@ -1546,21 +1556,11 @@ class Quests(ConstructorModule):
 
     @property
     def general_parser_spec(self):
-        inst = self.app().inst
-        try:
-            return inst._parser_spec
-        except AttributeError:
-            inst._parser_spec = Parsing.Spec(sys.modules["mg.constructor.script_classes"], skinny=False)
-            return inst._parser_spec
+        return self.app().inst.parser_spec("mg.constructor.script_classes", skinny=False)
 
     @property
     def quest_parser_spec(self):
-        inst = self.app().inst
-        try:
-            return inst._quest_parser_spec
-        except AttributeError:
-            inst._quest_parser_spec = Parsing.Spec(sys.modules["mg.mmorpg.quest_parser"], skinny=False)
-            return inst._quest_parser_spec
+        return self.app().inst.parser_spec("mg.mmorpg.quest_parser", skinny=False)
 
     def parse_script(self, text):
         parser = QuestScriptParser(self.app(), self.quest_parser_spec, self.general_parser_spec)
@@ -1594,6 +1594,85 @@ class Quests(ConstructorModule):
         finally:
             events.discard(key)
 
+    def quest_dispatch(self, event):
+        """
+        Compiled handlers of the event. Returns (any_value, by_value). any_value maps
+        (quest, state) to the list of (position, handler) of handlers whose type matches the event.
+        by_value maps values of the discriminating attribute (see quest_event_discriminators)
+        to such dicts. Result is cached until quest handlers are updated
+        """
+        version = self.conf("quests.handlers_version")
+        if version != self.dispatch_version:
+            self.dispatch_cache = {}
+            self.dispatch_version = version
+        try:
+            return self.dispatch_cache[event]
+        except KeyError:
+            pass
+        quests_states = self.conf("qevent-%s.handlers" % event, [])
+        self.app().config.load_groups(["quest-%s" % ent[0] for ent in quests_states])
+        discriminator = quest_event_discriminators.get(event)
+        any_value = {}
+        by_value = {}
+        for ent in quests_states:
+            quest = ent[0]
+            state_id = ent[1]
+            state = self.conf("quest-%s.states" % quest, {}).get(state_id)
+            if not state:
+                continue
+            script = state.get("script")
+            if not script or script[0] != "state":
+                continue
+            hdls = script[1].get("hdls")
+            if not hdls:
+                continue
+            for pos in xrange(0, len(hdls)):
+                hdl = hdls[pos]
+                if hdl[0] != "hdl":
+                    continue
+                handler = hdl[1]
+                tp = handler.get("type")
+                if not tp or parse_quest_tp(quest, tp) != event:
+                    continue
+                value = None
+                if discriminator:
+                    attrs = handler.get("attrs")
+                    if attrs:
+                        value = attrs.get(discriminator[0])
+                if value:
+                    try:
+                        handlers = by_value[value]
+                    except KeyError:
+                        handlers = {}
+                        by_value[value] = handlers
+                else:
+                    handlers = any_value
+                try:
+                    handlers[(quest, state_id)].append((pos, handler))
+                except KeyError:
+                    handlers[(quest, state_id)] = [(pos, handler)]
+        res = (any_value, by_value)
+        self.dispatch_cache[event] = res
+        return res
+
+    def quest_event_handlers(self, event, kwargs):
+        "Handlers of the event which may match its arguments: (quest, state) => [(position, handler), ...]"
+        any_value, by_value = self.quest_dispatch(event)
+        if not by_value:
+            return any_value
+        try:
+            value = quest_event_discriminators[event][1](kwargs)
+        except (KeyError, AttributeError):
+            return any_value
+        matched = by_value.get(value)
+        if not matched:
+            return any_value
+        handlers = any_value.copy()
+        for key, hdls in matched.iteritems():
+            lst = handlers.get(key)
+            handlers[key] = sorted(lst + hdls) if lst else hdls
+        return handlers
+
     def execute_quest_event(self, event, **kwargs):
         # load list of quests handling this type of event
         char = kwargs.get("char")
@@ -1621,36 +1700,36 @@ class Quests(ConstructorModule):
                 self.call("debug-channel.character", char, event_str, cls="quest-event", indent=indent)
             if not "local" in kwargs:
                 kwargs["local"] = ScriptMemoryObject()
-            # loading list of quest handlers
-            quests_states = self.conf("qevent-%s.handlers" % event, [])
+            # loading compiled quest handlers
+            quests_handlers = self.quest_event_handlers(event, kwargs)
             # checking for character states and choosing quests
             quests = set()
-            for ent in quests_states:
-                quest = ent[0]
-                state = ent[1]
+            for quest, state in quests_handlers.iterkeys():
                 if char.quests.get(quest, "state", "init") == state:
                     quests.add(quest)
             quests = [quest for quest in quests]
             quests.sort()
-            # loading quests configuration
-            self.app().config.load_groups(["quest-%s" % quest for quest in quests])
             # executing quests scripts
             def eval_description():
                 return self._("Quest '{quest}', event '{event}'").format(quest=quest, event=event)
             # check list of handlers for matching events
-            def execute_handlers(hdls, quest, kwargs):
+            # compiled - list of (position, handler) having types matching the event
+            def execute_handlers(hdls, quest, kwargs, compiled=False):
                 if not hdls:
                     return
                 for hdl in hdls:
-                    if hdl[0] != "hdl":
-                        continue
-                    handler = hdl[1]
-                    tp = handler.get("type")
-                    if not tp:
-                        continue
-                    tp = parse_quest_tp(quest, tp)
-                    if event != tp:
-                        continue
+                    if compiled:
+                        handler = hdl[1]
+                    else:
+                        if hdl[0] != "hdl":
+                            continue
+                        handler = hdl[1]
+                        tp = handler.get("type")
+                        if not tp:
+                            continue
+                        tp = parse_quest_tp(quest, tp)
+                        if event != tp:
+                            continue
                     attrs = handler.get("attrs")
                     if event == "teleported":
                         if attrs and attrs.get("to") and kwargs["new_loc"].uuid != attrs.get("to"):
@@ -2485,20 +2564,10 @@ class Quests(ConstructorModule):
                             self.call("debug-channel.character", char, lambda: self._("skipping unavailable quest {quest}").format(quest=quest), cls="quest-handler", indent=indent+1)
                         continue
                     # state availability
-                    states = self.conf("quest-%s.states" % quest, {})
                     state_id = char.quests.get(quest, "state", "init")
-                    state = states.get(state_id)
                     if debug:
                         self.call("debug-channel.character", char, lambda: self._("quest={quest}, state={state}").format(quest=quest, state=state_id), cls="quest-handler", indent=indent+1)
-                    if not state:
-                        continue
-                    script = state.get("script")
-                    if not script:
-                        continue
-                    if script[0] != "state":
-                        continue
-                    script = script[1]
-                    execute_handlers(script.get("hdls"), quest, kwargs)
+                    execute_handlers(quests_handlers.get((quest, state_id)), quest, kwargs, compiled=True)
                 except QuestError as e:
                     raise ScriptError(e.val, env)
                 finally:
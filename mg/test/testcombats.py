@@ -423,6 +423,15 @@ class TestCombats(unittest.TestCase):
             combat.process(0)
             log._syslog = []
 
+    def test_05_visibility(self):
+        self.assertTrue(viewer_independent(1))
+        self.assertTrue(viewer_independent(None))
+        self.assertTrue(viewer_independent([">", [".", ["glob", "member"], "p_hp"], 0]))
+        self.assertFalse(viewer_independent(["==", [".", ["glob", "viewer"], "team"], [".", ["glob", "member"], "team"]]))
+        self.assertFalse(viewer_independent(["<", ["random"], 0.5]))
+        self.assertFalse(viewer_independent(["call", "selrand", 1, 0]))
+        self.assertFalse(viewer_independent(["call", "min", 1, [".", ["glob", "viewer"], "p_level"]]))
+
 def main():
     try:
         unittest.main()
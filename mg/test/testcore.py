@@ -109,6 +109,23 @@ class TestJoin(Module):
     def immed(self, arg):
         raise Hooks.Return("immed")
 
+class FakeHooks(object):
+    dynamic = True
+
+class FakeApp(object):
+    def __init__(self, tag):
+        self.tag = tag
+        self.hooks = FakeHooks()
+
+class TestFactory(ApplicationFactory):
+    def __init__(self, inst):
+        ApplicationFactory.__init__(self, inst)
+        self.loaded = []
+
+    def load(self, tag):
+        self.loaded.append(tag)
+        return FakeApp(tag)
+
 class TestCore(unittest.TestCase):
     def setUp(self):
         self.inst = Instance("test", "test")
@@ -193,5 +210,48 @@ class TestCore(unittest.TestCase):
         self.assertEqual(app.hooks.call("join.filter3", 2), 14)
         self.assertEqual(app.hooks.call("join.immed", 2), "immed")
 
+    def test10(self):
+        app = Application(self.inst, "mgtest")
+        app.modules.load(["mg.test.testcore.TestJoin"])
+        self.assertEqual(app.hooks.call("join.single"), "single")
+        # registering handler must invalidate dispatch cache
+        app.hooks.register("mg.test.testcore.TestJoin", "join.single", lambda: "first", priority=10)
+        app.hooks.register("mg.test.testcore.TestJoin", "join.single", lambda: "last", priority=-10)
+        # the last handler result is returned
+        self.assertEqual(app.hooks.call("join.single"), "last")
+        self.assertRaises(HookFormatError, app.hooks.call, "invalid")
+        # profiling
+        app.hooks.profiling_start()
+        app.hooks.call("join.single")
+        app.hooks.call("join.single")
+        app.hooks.call("join.empty")
+        stats = app.hooks.profiling_stop()
+        self.assertEqual(stats["join.single"].calls, 2)
+        self.assertEqual(stats["join.empty"].calls, 1)
+        self.assertEqual(sum(stats["join.single"].histogram), 2)
+        app.hooks.call("join.single")
+        self.assertEqual(stats["join.single"].calls, 2)
+
+    def test11(self):
+        factory = TestFactory(self.inst)
+        factory.pool_size = 2
+        self.assertEqual(factory.get_by_tag("a").tag, "a")
+        factory.get_by_tag("b")
+        factory.get_by_tag("a")
+        self.assertEqual(factory.loaded, ["a", "b"])
+        # least recently used application is evicted
+        factory.get_by_tag("c")
+        self.assertEqual(factory.get_by_tag("b", False), None)
+        factory.get_by_tag("b")
+        self.assertEqual(factory.loaded, ["a", "b", "c", "b"])
+        # removed application is reloaded
+        factory.remove_by_tag("b")
+        factory.get_by_tag("b")
+        self.assertEqual(factory.loaded, ["a", "b", "c", "b", "b"])
+        # too old application is reloaded
+        factory.pool_max_age = -1
+        factory.get_by_tag("b")
+        self.assertEqual(factory.loaded, ["a", "b", "c", "b", "b", "b"])
+
 if __name__ == "__main__":
     dispatch(unittest.main)
@@ -162,5 +162,41 @@ class TestItems(unittest.TestCase, ConstructorModule):
         self.assertEqual(items[0][0].param("param4"), 40)
         self.assertEqual(items[0][0].param("param5"), 5)
 
+    def test_index(self):
+        db_item_type = self.obj(DBItemType)
+        db_item_type.set("name", "Indexed Item")
+        db_item_type.set("name_lower", "indexed item")
+        db_item_type.store()
+        inv = self.call("inventory.get", "char", uuid4().hex)
+        inv.give(db_item_type.uuid, 3)
+        inv.give(db_item_type.uuid, 2, mod={"param1": 7})
+        items = inv.items()
+        self.assertEqual(len(items), 2)
+        # cached list must not be shared with the caller
+        del items[:]
+        self.assertEqual(len(inv.items()), 2)
+        # aggregates
+        self.assertEqual(inv._aggregate("cnt", db_item_type.uuid), 5)
+        modified = [item_type for item_type, quantity in inv.items() if item_type.dna != db_item_type.uuid][0]
+        self.assertEqual(inv._aggregate("cnt_dna", modified.dna), 2)
+        self.assertEqual(inv._aggregate("cnt_dna", db_item_type.uuid), 3)
+        # lookup by dna
+        item_type, quantity = inv.find_dna(modified.dna)
+        self.assertEqual(item_type.dna, modified.dna)
+        self.assertEqual(quantity, 2)
+        self.assertEqual(inv.find_dna("%s_missing" % db_item_type.uuid), (None, None))
+        # removing the whole stack
+        inv.take_dna(modified.dna, 2)
+        self.assertEqual(inv.find_dna(modified.dna), (None, None))
+        self.assertEqual(len(inv.items()), 1)
+        # stack appears again after giving
+        inv.give(db_item_type.uuid, 1, mod={"param1": 7})
+        self.assertEqual(inv.find_dna(modified.dna)[1], 1)
+        self.assertEqual(inv._aggregate("cnt", db_item_type.uuid), 4)
+        # taking by type drops exhausted stacks
+        inv.take_type(db_item_type.uuid, 4)
+        self.assertEqual(len(inv.items()), 0)
+        self.assertEqual(inv._aggregate("cnt", db_item_type.uuid), 0)
+
 if __name__ == "__main__":
     dispatch(unittest.main)
@@ -39,6 +39,52 @@ class TestMemcached(unittest.TestCase):
         self.assertEqual(res["key1"], "value1")
         self.assertEqual(res["key2"], "value2")
 
+    def testmulti(self):
+        self.mc.set_multi({"key1": "value1", "key2": "value2"})
+        res = self.mc.get_multi(["key1", "key2"])
+        self.assertEqual(res["key1"], "value1")
+        self.assertEqual(res["key2"], "value2")
+        self.mc.set_multi({"cnt1": 1, "cnt2": 5})
+        res = self.mc.incr_multi(["cnt1", "cnt2"], 2)
+        self.assertEqual(res["cnt1"][1], 3)
+        self.assertEqual(res["cnt2"][1], 7)
+        self.mc.delete_multi(["key1", "key2", "cnt1", "cnt2"])
+        self.assertEqual(self.mc.get_multi(["key1", "key2", "cnt1", "cnt2"]), {})
+
+    def testpipeline(self):
+        self.mc.set("key1", "value1")
+        with self.mc.pipeline():
+            self.mc.queue_set("key2", "value2")
+            self.mc.queue_delete("key1")
+            # the same tasklet sees queued values
+            self.assertEqual(self.mc.get("key1"), None)
+            self.assertEqual(self.mc.get("key2"), "value2")
+            # other tasklets don't
+            res = Tasklet.join(Tasklet.new(self.mc.get_multi)(["key1", "key2"]))
+            self.assertEqual(res, {"key1": "value1"})
+        self.assertEqual(self.mc.get_multi(["key1", "key2"]), {"key2": "value2"})
+        self.mc.delete("key2")
+
+    def testpipelineimmediate(self):
+        with self.mc.pipeline():
+            data = {"a": 1}
+            self.mc.queue_add("key1", data)
+            # queued values are copied
+            data["a"] = 2
+            res = self.mc.get("key1")
+            self.assertEqual(res, {"a": 1})
+            res["a"] = 3
+            self.assertEqual(self.mc.get("key1"), {"a": 1})
+            # immediate writes replace queued ones
+            self.mc.set("key1", "tomb")
+            self.assertEqual(self.mc.get("key1"), "tomb")
+        self.assertEqual(self.mc.get("key1"), "tomb")
+        with self.mc.pipeline():
+            self.mc.queue_set("key1", "value1")
+            self.mc.delete("key1")
+            self.assertEqual(self.mc.get("key1"), None)
+        self.assertEqual(self.mc.get("key1"), None)
+
     def testunicode(self):
         self.mc.set("key1", u"проверка")
         self.assertEqual(type(self.mc.get("key1")), unicode)
@@ -63,6 +109,29 @@ class TestMemcached(unittest.TestCase):
             self.mc.delete("key%d" % n)
             self.assertEqual(self.mc.get("key%d" % n), None)
 
+    def testketama(self):
+        hosts = [("10.0.0.%d" % i, 11211) for i in xrange(1, 5)]
+        pool = MemcachedPool(hosts)
+        keys = ["key%d" % i for i in xrange(0, 4000)]
+        placement = dict([(key, pool.node(key).host) for key in keys])
+        # every server gets its share of keys
+        for host in hosts:
+            cnt = len([key for key in keys if placement[key] == host])
+            self.assertTrue(cnt > 500, "%s: %d keys" % (host, cnt))
+        # adding a server moves keys to the new server only
+        pool.set_hosts(hosts + [("10.0.0.5", 11211)])
+        moved = 0
+        for key in keys:
+            host = pool.node(key).host
+            if host != placement[key]:
+                self.assertEqual(host, ("10.0.0.5", 11211))
+                moved += 1
+        self.assertTrue(moved < 1600, "%d keys moved" % moved)
+        # split groups keys by their nodes
+        for node, node_keys in pool.split(keys):
+            for key in node_keys:
+                self.assertTrue(pool.node(key) is node)
+
     def testerrors(self):
         mc = Memcached(pool=MemcachedPool(size=4))
         tasks = []
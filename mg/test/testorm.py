@@ -16,13 +16,14 @@
 # You should have received a copy of the GNU General Public License
 # along with Metagam.  If not, see <http://www.gnu.org/licenses/>.
 
-from mg.core.cass import CassandraConnection, CassandraPool, CassandraObject, CassandraObjectList, ObjectNotFoundException
+from mg.core.cass import CassandraConnection, CassandraPool, CassandraObject, CassandraObjectList, CassandraBatch, ObjectNotFoundException
 from mg.core.memcached import Memcached
 import unittest
 from concurrence import dispatch, Tasklet
 import time
 from cassandra.ttypes import *
 from math import floor
+import mg.core.cass
 import logging
 
 modlogger = logging.getLogger("")
@@ -49,6 +50,13 @@ class TestObject(CassandraObject):
 class TestObjectList(CassandraObjectList):
     objcls = TestObject
 
+class CachedObject(CassandraObject):
+    clsname = "CachedObject"
+    local_cache = 60
+
+class CachedObjectList(CassandraObjectList):
+    objcls = CachedObject
+
 def cleanup():
     mc = Memcached(prefix="mgtest-")
     db = CassandraPool().dbget("mgtest", mc)
@@ -61,6 +69,7 @@ def cleanup():
     mc.delete("Cassandra-KS-mgtest")
     mc.delete("Cassandra-CF-mgtest-Data")
     mc.delete("Cassandra-CF-mgtest-SimpleObject_Objects")
+    mc.delete("Cassandra-CF-mgtest-CachedObject_Objects")
     mc.delete("Cassandra-CF-mgtest-TestObject_Objects")
     mc.delete("Cassandra-CF-mgtest-TestObject_Index_topic")
     mc.delete("Cassandra-CF-mgtest-TestObject_Index_created")
@@ -316,6 +325,122 @@ class TestORM(unittest.TestCase):
         lst.load(True)
         self.assertEqual(len(lst), 1)
 
+    def test08(self):
+        # write-behind batch
+        lst = TestObjectList(self.db, query_index="topic", query_equal="batch")
+        lst.remove()
+        with CassandraBatch(self.db) as batch:
+            obj1 = TestObject(self.db)
+            obj1.set("topic", "batch")
+            obj1.store()
+            with CassandraBatch(self.db) as nested:
+                self.assertTrue(nested is batch)
+                obj2 = TestObject(self.db)
+                obj2.set("topic", "batch")
+                obj2.store()
+            self.assertFalse(obj1.dirty)
+            self.assertEqual(len(TestObjectList(self.db, query_index="topic", query_equal="batch")), 0)
+        self.assertEqual(self.db.current_batch(), None)
+        lst = TestObjectList(self.db, query_index="topic", query_equal="batch")
+        self.assertEqual(len(lst), 2)
+        lst.load()
+        self.assertEqual(set(lst.uuids()), set([obj1.uuid, obj2.uuid]))
+
+    def test09(self):
+        # local object cache
+        obj = CachedObject(self.db)
+        obj.set("key", "value1")
+        obj.store()
+        obj = CachedObject(self.db, obj.uuid)
+        self.assertEqual(obj.get("key"), "value1")
+        # cached data must not be shared between objects
+        obj.data["key"] = "garbage"
+        obj = CachedObject(self.db, obj.uuid)
+        self.assertEqual(obj.get("key"), "value1")
+        obj.set("key", "value2")
+        obj.store()
+        lst = CachedObjectList(self.db, [obj.uuid])
+        lst.load()
+        self.assertEqual(lst[0].get("key"), "value2")
+        obj.remove()
+        self.assertRaises(ObjectNotFoundException, CachedObject, self.db, obj.uuid)
+
+    def test10(self):
+        # concurrent index misses
+        lst = TestObjectList(self.db, query_index="topic", query_equal="coalesce")
+        lst.remove()
+        uuids = set()
+        for i in xrange(0, 5):
+            obj = TestObject(self.db, data={"topic": "coalesce"})
+            obj.store()
+            uuids.add(obj.uuid)
+        results = []
+        def query():
+            lst = TestObjectList(self.db, query_index="topic", query_equal="coalesce")
+            results.append(set([obj.uuid for obj in lst]))
+        Tasklet.join_all([Tasklet.new(query)() for i in xrange(0, 20)])
+        self.assertEqual(len(results), 20)
+        for res in results:
+            self.assertEqual(res, uuids)
+        lst = TestObjectList(self.db, query_index="topic", query_equal=["coalesce", "nothing"])
+        self.assertEqual(set([obj.uuid for obj in lst]), uuids)
+
+    def test11(self):
+        # chunked parallel load
+        lst = TestObjectList(self.db, query_index="topic", query_equal="chunked")
+        lst.remove()
+        uuids = []
+        for i in xrange(0, 10):
+            obj = TestObject(self.db, data={"topic": "chunked", "index": i})
+            obj.store()
+            uuids.append(obj.uuid)
+        saved_chunk_size = mg.core.cass.max_chunk_size
+        mg.core.cass.max_chunk_size = 3
+        try:
+            lst = TestObjectList(self.db, uuids + ["not-existent-object"])
+            lst.load(silent=True)
+            self.assertEqual([obj.uuid for obj in lst], uuids)
+            self.assertEqual([obj.get("index") for obj in lst], range(0, 10))
+            lst = TestObjectList(self.db, uuids)
+            self.assertEqual([obj.uuid for obj in lst.iter_load()], uuids)
+            self.assertEqual([obj.uuid for obj in lst], uuids)
+        finally:
+            mg.core.cass.max_chunk_size = saved_chunk_size
+
+    def test12(self):
+        # index paging
+        lst = TestObjectList(self.db, query_index="topic", query_equal="paging")
+        lst.remove()
+        uuids = set()
+        for i in xrange(0, 7):
+            obj = TestObject(self.db, data={"topic": "paging"})
+            obj.store()
+            uuids.add(obj.uuid)
+        pages = [[obj.uuid for obj in lst] for lst in TestObjectList.pages(self.db, "topic", "paging", page_size=3)]
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(set(sum(pages, [])), uuids)
+        pages = [[obj.uuid for obj in lst] for lst in TestObjectList.pages(self.db, "topic", "paging", page_size=7)]
+        self.assertEqual([len(page) for page in pages], [7])
+        self.assertEqual(list(TestObjectList.pages(self.db, "topic", "nothing")), [])
+
+    def test13(self):
+        # in-flight index reads are joined, not replaced
+        reads = mg.core.cass.IndexReads()
+        self.assertTrue(reads.begin(self.db, "row"))
+        self.assertFalse(reads.begin(self.db, "row"))
+        waiter = Tasklet.new(reads.wait)(self.db, "row")
+        Tasklet.yield_()
+        reads.finish(self.db, "row", [["col", "uuid"]])
+        self.assertEqual(Tasklet.join(waiter), [["col", "uuid"]])
+        # waiting is limited
+        saved_wait = mg.core.cass.index_read_wait
+        mg.core.cass.index_read_wait = 0.1
+        try:
+            reads.begin(self.db, "row")
+            self.assertEqual(reads.wait(self.db, "row"), None)
+        finally:
+            mg.core.cass.index_read_wait = saved_wait
+
 def main():
     cleanup()
     unittest.main()
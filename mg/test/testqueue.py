@@ -0,0 +1,101 @@
+#!/usr/bin/python2.6
+
+# This file is a part of Metagam project.
+#
+# Metagam is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# Metagam is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Metagam.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from concurrence import dispatch, Tasklet
+import mg.core.queue
+from mg.core.queue import QueueRunner
+
+class FakeInst(object):
+    instid = "inst1"
+    cls = "metagam"
+
+class FakeApp(object):
+    def __init__(self):
+        self.inst = FakeInst()
+
+class TestQueueRunner(QueueRunner):
+    "QueueRunner keeping tasks in memory instead of the queue_tasks table"
+    def __init__(self, app, tasks):
+        QueueRunner.__init__(self, app, "mg.test.testqueue.TestQueueRunner")
+        self.tasks = tasks
+        self.queue_running = {}
+        self.queue_pending = []
+        self.queue_abandoned = set()
+        self.started = []
+
+    def queue_lock_tasks(self, limit, skip_apps):
+        cnt = 0
+        for task in sorted(self.tasks, key=lambda task: -task["priority"]):
+            if cnt >= limit:
+                break
+            if task["locked"] == "" and task["app"] not in skip_apps:
+                task["locked"] = "inst1"
+                cnt += 1
+        return cnt
+
+    def queue_locked_tasks(self):
+        return [task for task in sorted(self.tasks, key=lambda task: -task["priority"]) if task["locked"] == "inst1"]
+
+    def queue_release(self, task_ids):
+        for task in self.tasks:
+            if task["id"] in task_ids:
+                task["locked"] = ""
+
+    def queue_task_worker(self, task):
+        self.started.append(task["id"])
+
+def make_tasks(app_tag, cnt, priority=100):
+    return [{"id": "%s-%d" % (app_tag, i), "app": app_tag, "priority": priority, "locked": ""} for i in xrange(cnt)]
+
+class TestQueue(unittest.TestCase):
+    def setUp(self):
+        self.app = FakeApp()
+
+    def test01(self):
+        # busy application doesn't take all slots
+        runner = TestQueueRunner(self.app, make_tasks("a", 10, 200) + make_tasks("b", 3) + make_tasks("c", 1))
+        claimed = runner.queue_claim(mg.core.queue.queue_workers)
+        per_app = {}
+        for task in claimed:
+            per_app[task["app"]] = per_app.get(task["app"], 0) + 1
+        self.assertEqual(per_app, {"a": 2, "b": 2, "c": 1})
+        # surplus tasks are released
+        self.assertEqual(len([task for task in runner.tasks if task["locked"]]), 5)
+
+    def test02(self):
+        # abandoned tasks are not claimed again
+        runner = TestQueueRunner(self.app, make_tasks("a", 1))
+        runner.tasks[0]["locked"] = "inst1"
+        runner.queue_abandoned.add("a-0")
+        self.assertEqual(runner.queue_claim(mg.core.queue.queue_workers), [])
+        # running and pending tasks are counted
+        runner = TestQueueRunner(self.app, make_tasks("a", 3))
+        runner.queue_running["x"] = "a"
+        claimed = runner.queue_claim(mg.core.queue.queue_workers)
+        self.assertEqual([task["id"] for task in claimed], ["a-0"])
+
+    def test03(self):
+        runner = TestQueueRunner(self.app, [])
+        runner.queue_running["x"] = "a"
+        runner.queue_pending = make_tasks("a", 2) + make_tasks("b", 1)
+        runner.queue_dispatch()
+        self.assertEqual([task["id"] for task in runner.queue_pending], ["a-1"])
+        self.assertEqual(runner.queue_running, {"x": "a", "a-0": "a", "b-0": "b"})
+
+if __name__ == "__main__":
+    dispatch(unittest.main)
@@ -21,7 +21,8 @@ from concurrence import dispatch, Tasklet, Timeout, TimeoutError
 from mg.core import *
 from mg.core.cass import CassandraPool
 from mg.core.memcached import MemcachedPool
-from mg.constructor.script_classes import ScriptParserError, Vec3
+from mg.constructor.script_classes import ScriptParserError, ScriptRuntimeError, Vec3
+from mg.constructor.params import formula_dependencies
 from mg.mmorpg.combats.core import *
 from mg.mmorpg.combats.simulation import SimulationCombat
 from cassandra.ttypes import *
@@ -561,6 +562,40 @@ class TestScript(unittest.TestCase):
         self.assertEqual(type(self.evaluate(['.', ['now'], 'utc_minute'])), int)
         self.assertEqual(type(self.evaluate(['.', ['now'], 'utc_second'])), int)
 
+    def test_compiled(self):
+        # compiled expression is reused with different environments
+        expr = self.app.call("script.parse-expression", "g1 * 2 + (g2 > 1 ? g2 : 10)")
+        used_globs = set()
+        self.assertEqual(self.app.call("script.evaluate-expression", expr, globs={"g1": 1, "g2": 2}, used_globs=used_globs), 4)
+        self.assertEqual(used_globs, set(["g1", "g2"]))
+        self.assertEqual(self.app.call("script.evaluate-expression", expr, globs={"g1": 3, "g2": 0}), 16)
+        evalres = self.app.call("script.evaluate-expression", expr, globs={"g1": 1, "g2": 2}, keep_globs={"g2": True})
+        self.assertEqual(evalres, ["+", 2, ["?", [">", ["glob", "g2"], 1], ["glob", "g2"], 10]])
+        # errors are raised when the failing branch is evaluated only
+        expr = self.app.call("script.parse-expression", "g1 ? 1 : lc(1, 2)")
+        self.assertEqual(self.app.call("script.evaluate-expression", expr, globs={"g1": 1}), 1)
+        self.assertRaises(ScriptRuntimeError, self.app.call, "script.evaluate-expression", expr, globs={"g1": 0})
+        # equal expressions built separately share the compiled function
+        expr = ["+", ["glob", "g1"], 1]
+        self.assertEqual(self.app.call("script.evaluate-expression", expr, globs={"g1": 1}), 2)
+        self.assertEqual(self.app.call("script.evaluate-expression", ["+", ["glob", "g1"], 1], globs={"g1": 2}), 3)
+        # too deep expressions raise script errors
+        expr = 1
+        for i in xrange(5000):
+            expr = ["+", expr, 1]
+        self.assertRaises(ScriptRuntimeError, self.app.call, "script.evaluate-expression", expr)
+
+    def test_param_dependencies(self):
+        def deps(text):
+            deps, pure = formula_dependencies(self.app.call("script.parse-expression", text), "char")
+            return sorted(deps), pure
+        self.assertEqual(deps("1 + 2"), ([], True))
+        self.assertEqual(deps("char.p_str * 2 + max(char.p_dex, char.p_str)"), (["dex", "str"], True))
+        self.assertEqual(deps("char.p_str + char.money"), (["str"], False))
+        self.assertEqual(deps("char.p_str + item.p_str"), (["str"], False))
+        self.assertEqual(deps("char.p_str * t"), (["str"], False))
+        self.assertEqual(deps("random"), ([], False))
+
 def main():
     try:
         unittest.main()